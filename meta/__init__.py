@@ -0,0 +1,67 @@
+"""
+meta: statistical engine behind the meta-analysis notebooks.
+
+Submodules are imported lazily, so ``import meta`` is cheap and only the
+subsystems actually used pull in SciPy / statsmodels:
+
+    import meta
+    tau_sq, info = meta.heterogeneity.calculate_tau_squared(df, 'yi', 'vi')
+    estimates, _, _ = meta.three_level.run_three_level_reml(df, 'yi', 'vi')
+
+Subsystems:
+    data           table readers, cleaning / column mapping
+    effect_sizes   lnRR, Hedges' g, Cohen's d, log OR and SD imputation
+    overall        fixed/random-effects pooling and heterogeneity
+    heterogeneity  τ² estimators (DL, REML, ML, PM, SJ), Knapp-Hartung CI
+    three_level    three-level REML engine
+    bootstrap      cluster (study-level) bootstrap intervals for the three-level model
+    robust         cluster-robust variance (CR0/CR1/CR2), Satterthwaite df, HTZ Wald tests
+    regression     cluster-robust and three-level meta-regression, splines
+    bias           Egger's test, trim-and-fill
+    sensitivity    leave-one-out, cumulative meta-analysis
+    subgroups      three-level subgroup analysis
+    plotting       funnel, forest, leave-one-out and cumulative figures
+    export         background figure export with a content-addressed cache
+    fit_cache      memoized model fits (in-memory LRU, optional disk tier)
+    perf           fit / stage timings, optimizer diagnostics, profiling summaries
+    benchmark      synthetic-data benchmarks of every engine against stored baselines
+    pipeline       headless batch runner (``python -m meta CONFIG INPUT``)
+"""
+
+import importlib
+
+__version__ = '4.0.0'
+
+_SUBMODULES = (
+    'data',
+    'effect_sizes',
+    'overall',
+    'heterogeneity',
+    'three_level',
+    'bootstrap',
+    'robust',
+    'regression',
+    'bias',
+    'sensitivity',
+    'subgroups',
+    'plotting',
+    'export',
+    'fit_cache',
+    'perf',
+    'benchmark',
+    'pipeline',
+)
+
+__all__ = list(_SUBMODULES)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        module = importlib.import_module(f'.{name}', __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_SUBMODULES))
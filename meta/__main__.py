@@ -0,0 +1,8 @@
+"""Allow ``python -m meta CONFIG INPUT ...`` (see meta.pipeline)."""
+
+import sys
+
+from .pipeline import main
+
+if __name__ == '__main__':
+    sys.exit(main())
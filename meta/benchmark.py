@@ -0,0 +1,507 @@
+"""
+Synthetic-data benchmarks for the statistical engines.
+
+Every engine (tau-squared estimators, three-level REML, three-level and
+cluster-robust meta-regression, splines, moderator screening,
+trim-and-fill, leave-one-out, cumulative) is run on seeded three-level
+datasets of increasing size, recording per engine and scenario:
+
+    seconds        best wall time over `repeat` runs
+    lik_evals      likelihood evaluations (meta.perf; 0 for closed-form engines)
+    iterations     optimizer iterations, where the engine reports them
+    peak_mb        peak traced memory (tracemalloc) during one run
+
+Counts and memory are deterministic for a given seed, so any change in
+them flags a behavioural change even across machines; wall times are
+compared with a tolerance and only mean something against a baseline
+recorded on the same machine. The fit cache is bypassed so every run fits.
+
+Command line:
+    python -m meta.benchmark --suite quick -o bench.json
+    python -m meta.benchmark --suite quick --baseline benchmarks/baseline_quick.json
+    python -m meta.benchmark --suite full --save-baseline benchmarks/baseline_full.json
+
+    python -m meta.benchmark --check
+
+Exit status is 1 when the comparison finds a regression (or --check
+finds a batched estimate that disagrees with its single-dataset fit).
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    'SCENARIOS',
+    'BENCHMARK_ENGINES',
+    'simulate_three_level',
+    'run_benchmarks',
+    'save_baseline',
+    'load_baseline',
+    'compare_to_baseline',
+    'check_tau_batch',
+    'main',
+]
+
+# k effects in n_studies studies; skew 0 = equal cluster sizes, larger =
+# a few large studies and many single-effect ones
+SCENARIOS = {
+    'quick': [
+        {'name': 'k10_m5', 'k': 10, 'n_studies': 5, 'skew': 0.0, 'tau_sq': 0.05, 'sigma_sq': 0.02},
+        {'name': 'k100_m20', 'k': 100, 'n_studies': 20, 'skew': 0.0, 'tau_sq': 0.05, 'sigma_sq': 0.02},
+        {'name': 'k100_m20_skew', 'k': 100, 'n_studies': 20, 'skew': 1.5, 'tau_sq': 0.05, 'sigma_sq': 0.02},
+        {'name': 'k1000_m200', 'k': 1000, 'n_studies': 200, 'skew': 0.0, 'tau_sq': 0.05, 'sigma_sq': 0.02},
+        {'name': 'k1000_m200_skew', 'k': 1000, 'n_studies': 200, 'skew': 1.5, 'tau_sq': 0.05, 'sigma_sq': 0.02},
+        {'name': 'k1000_m200_tau0', 'k': 1000, 'n_studies': 200, 'skew': 0.0, 'tau_sq': 0.0, 'sigma_sq': 0.02},
+    ],
+}
+SCENARIOS['full'] = SCENARIOS['quick'] + [
+    {'name': 'k1000_m200_het', 'k': 1000, 'n_studies': 200, 'skew': 0.0, 'tau_sq': 0.5, 'sigma_sq': 0.2},
+    {'name': 'k10000_m2000', 'k': 10_000, 'n_studies': 2000, 'skew': 0.0, 'tau_sq': 0.05, 'sigma_sq': 0.02},
+    {'name': 'k10000_m2000_skew', 'k': 10_000, 'n_studies': 2000, 'skew': 1.5, 'tau_sq': 0.05, 'sigma_sq': 0.02},
+    {'name': 'k100000_m10000', 'k': 100_000, 'n_studies': 10_000, 'skew': 0.0, 'tau_sq': 0.05, 'sigma_sq': 0.02},
+    {'name': 'k100000_m10000_skew', 'k': 100_000, 'n_studies': 10_000, 'skew': 1.5, 'tau_sq': 0.05, 'sigma_sq': 0.02},
+]
+
+# --- 1. SYNTHETIC DATA ---
+
+def simulate_three_level(k, n_studies, tau_sq=0.05, sigma_sq=0.02, mu=0.2, slope=0.1,
+                         skew=0.0, seed=0):
+    """
+    Seeded three-level dataset: effects nested in studies.
+
+    Parameters:
+    -----------
+    k : int
+        Number of effect sizes
+    n_studies : int
+        Number of studies (capped at k)
+    tau_sq, sigma_sq : float
+        True between-study (level 3) and within-study (level 2) variances
+    mu, slope : float
+        True intercept and slope on the continuous moderator 'x'
+    skew : float
+        Cluster-size skew: study j gets effects in proportion to j^-skew
+        (every study has at least one effect)
+    seed : int
+        Random seed
+
+    Returns:
+    --------
+    DataFrame : 'id', 'yi', 'vi', 'se', 'x' (continuous moderator),
+                'group' (study-level factor), 'year'
+    """
+    rng = np.random.default_rng(seed)
+    n_studies = int(min(n_studies, k))
+    weights = np.arange(1, n_studies + 1, dtype=float) ** -skew
+    sizes = 1 + rng.multinomial(k - n_studies, weights / weights.sum())
+    study = np.repeat(np.arange(n_studies), sizes)
+
+    # lnRR-like sampling variances from arm sizes and coefficients of variation
+    n_arm = rng.integers(3, 31, size=(k, 2))
+    cv = rng.uniform(0.1, 0.6, size=(k, 2))
+    vi = (cv ** 2 / n_arm).sum(axis=1)
+
+    x = rng.normal(0.0, 1.0, n_studies)[study] + rng.normal(0.0, 0.5, k)
+    yi = (mu + slope * x
+          + rng.normal(0.0, np.sqrt(tau_sq), n_studies)[study]
+          + rng.normal(0.0, np.sqrt(sigma_sq), k)
+          + rng.normal(0.0, np.sqrt(vi)))
+    return pd.DataFrame({
+        'id': pd.Series([f'S{j:05d}' for j in range(n_studies)]).values[study],
+        'yi': yi,
+        'vi': vi,
+        'se': np.sqrt(vi),
+        'x': x,
+        'group': np.array(['A', 'B', 'C'])[rng.integers(0, 3, n_studies)][study],
+        'year': rng.integers(1990, 2025, n_studies)[study],
+    })
+
+
+# --- 2. ENGINES ---
+# Each engine takes a simulated dataset and returns its optimizer
+# iteration count (None if it does not report one). Cached entry points
+# are called through .uncached so every run really fits.
+
+def _uncached(func):
+    return getattr(func, 'uncached', func)
+
+
+def _tau_engine(method):
+    def engine(data):
+        from . import heterogeneity
+        func = getattr(heterogeneity, f'calculate_tau_squared_{method}')
+        if method in ('DL', 'SJ'):
+            func(data, 'yi', 'vi')
+            return None
+        _, diagnostics = func(data, 'yi', 'vi', return_diagnostics=True)
+        return diagnostics.get('iterations')
+    return engine
+
+
+def _three_level_engine(data):
+    from .three_level import run_three_level_reml
+    _, _, optimizer_result = _uncached(run_three_level_reml)(data, 'yi', 'vi')
+    return getattr(optimizer_result, 'nit', None)
+
+
+def _three_level_regression_engine(data):
+    from .regression import run_three_level_reml_regression
+    _, _, optimizer_result = _uncached(run_three_level_reml_regression)(
+        data, ['x', 'group'], 'yi', 'vi', categorical=['group']
+    )
+    return getattr(optimizer_result, 'nit', None)
+
+
+def _cluster_robust_engine(data):
+    from .heterogeneity import calculate_tau_squared_DL
+    from .regression import run_cluster_robust_regression
+    _uncached(run_cluster_robust_regression)(
+        data.copy(), 'x', 'yi', 'vi', 'id', calculate_tau_squared_DL(data, 'yi', 'vi')
+    )
+    return None
+
+
+def _spline_engine(data):
+    from .heterogeneity import calculate_tau_squared_DL
+    from .regression import run_cluster_robust_spline
+    _uncached(run_cluster_robust_spline)(
+        data.copy(), 'x', 'yi', 'vi', 'id', calculate_tau_squared_DL(data, 'yi', 'vi'), 3
+    )
+    return None
+
+
+def _screening_engine(data, n_moderators=20):
+    from .heterogeneity import calculate_tau_squared_DL
+    from .regression import screen_moderators
+    rng = np.random.default_rng(0)
+    candidates = {f'm{i}': data['x'].to_numpy() * rng.uniform(-1, 1) + rng.normal(size=len(data))
+                  for i in range(n_moderators)}
+    screening_data = data[['id', 'yi', 'vi']].assign(**candidates)
+    _uncached(screen_moderators)(
+        screening_data, list(candidates), 'yi', 'vi', 'id', calculate_tau_squared_DL(data, 'yi', 'vi')
+    )
+    return None
+
+
+def _trimfill_engine(data):
+    from .bias import trimfill_analysis
+    result = _uncached(trimfill_analysis)(data, 'yi', 'vi', model='random')
+    return result.get('n_iter')
+
+
+def _loo_engine(data):
+    from .heterogeneity import calculate_tau_squared_DL
+    from .three_level import build_study_segments
+    from .sensitivity import run_three_level_loo
+    y_sorted, v_sorted, seg_starts, _ = build_study_segments(data, 'yi', 'vi')
+    tau_sq = calculate_tau_squared_DL(data, 'yi', 'vi')
+    _uncached(run_three_level_loo)(y_sorted, v_sorted, seg_starts, (tau_sq, tau_sq))
+    return None
+
+
+def _cumulative_engine(data):
+    from .sensitivity import aggregate_by_study, run_cumulative_engine
+    units = aggregate_by_study(data, 'yi', 'vi').sort_values('year', kind='mergesort')
+    _uncached(run_cumulative_engine)(units['yi'].values, units['vi'].values,
+                                     units['year'].values, units['id'].values)
+    return None
+
+
+# max_k skips scenarios an engine is not meant for (LOO refits once per study)
+BENCHMARK_ENGINES = {
+    'tau_DL': {'run': _tau_engine('DL'), 'max_k': None},
+    'tau_REML': {'run': _tau_engine('REML'), 'max_k': None},
+    'tau_ML': {'run': _tau_engine('ML'), 'max_k': None},
+    'tau_PM': {'run': _tau_engine('PM'), 'max_k': None},
+    'tau_SJ': {'run': _tau_engine('SJ'), 'max_k': None},
+    'three_level_reml': {'run': _three_level_engine, 'max_k': None},
+    'three_level_regression': {'run': _three_level_regression_engine, 'max_k': None},
+    'cluster_robust_regression': {'run': _cluster_robust_engine, 'max_k': None},
+    'cluster_robust_spline': {'run': _spline_engine, 'max_k': None},
+    'moderator_screening': {'run': _screening_engine, 'max_k': None},
+    'trimfill': {'run': _trimfill_engine, 'max_k': None},
+    'loo': {'run': _loo_engine, 'max_k': 10_000},
+    'cumulative': {'run': _cumulative_engine, 'max_k': None},
+}
+
+
+# --- 3. RUNNER ---
+
+def _measure(engine, data, repeat, time_budget):
+    """
+    Best wall time over the timed runs, then counts and peak memory from
+    one traced run (after the timed runs, so lazy imports are not traced).
+    """
+    from .perf import enable_perf, perf_enabled, perf_section
+
+    timings = []
+    while len(timings) < repeat and (not timings or sum(timings) < time_budget):
+        start = time.perf_counter()
+        engine(data)
+        timings.append(time.perf_counter() - start)
+
+    previous = perf_enabled()
+    enable_perf()
+    tracemalloc.start()
+    try:
+        with perf_section('benchmark', keep=False) as record:
+            iterations = engine(data)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        enable_perf(previous)
+    return {
+        'seconds': min(timings),
+        'lik_evals': record['likelihood_evals'],
+        'iterations': None if iterations is None else int(iterations),
+        'peak_mb': peak_bytes / 2**20,
+    }
+
+
+def run_benchmarks(suite='quick', engines=None, repeat=5, time_budget=5.0, seed=0, verbose=True):
+    """
+    Run every engine on every scenario of a suite.
+
+    Parameters:
+    -----------
+    suite : str or list of dict
+        Key of SCENARIOS, or a list of scenario dicts with 'name', 'k',
+        'n_studies', 'skew', 'tau_sq', 'sigma_sq'
+    engines : list of str or None
+        Keys of BENCHMARK_ENGINES (None = all)
+    repeat : int
+        Timed runs per engine and scenario (best is kept)
+    time_budget : float
+        Stop repeating once this many seconds have been spent timing
+    seed : int
+        Seed for simulate_three_level (offset per scenario)
+    verbose : bool
+        Print one line per measurement
+
+    Returns:
+    --------
+    DataFrame : One row per scenario x engine with 'status' ('ok',
+                'skipped', 'failed'), the scenario settings and the
+                measurements
+    """
+    scenarios = SCENARIOS[suite] if isinstance(suite, str) else list(suite)
+    engines = list(BENCHMARK_ENGINES) if engines is None else list(engines)
+    unknown = set(engines) - set(BENCHMARK_ENGINES)
+    if unknown:
+        raise ValueError(f"Unknown engine(s): {sorted(unknown)}")
+
+    rows = []
+    for s, scenario in enumerate(scenarios):
+        data = simulate_three_level(scenario['k'], scenario['n_studies'], tau_sq=scenario['tau_sq'],
+                                    sigma_sq=scenario['sigma_sq'], skew=scenario['skew'],
+                                    seed=seed + s)
+        for name in engines:
+            spec = BENCHMARK_ENGINES[name]
+            row = {'scenario': scenario['name'], 'engine': name, 'k': scenario['k'],
+                   'n_studies': scenario['n_studies'], 'skew': scenario['skew'],
+                   'tau_sq': scenario['tau_sq'], 'sigma_sq': scenario['sigma_sq']}
+            if spec['max_k'] is not None and scenario['k'] > spec['max_k']:
+                row['status'] = 'skipped'
+            else:
+                try:
+                    with warnings.catch_warnings():
+                        warnings.simplefilter('ignore')
+                        row.update(_measure(spec['run'], data, repeat, time_budget))
+                    row['status'] = 'ok'
+                except Exception as e:
+                    row.update(status='failed', error=f"{type(e).__name__}: {e}")
+            rows.append(row)
+            if verbose:
+                if row['status'] == 'ok':
+                    print(f"  {scenario['name']:<22} {name:<26} {row['seconds'] * 1000:10.1f} ms "
+                          f"{row['lik_evals']:7d} evals {row['peak_mb']:8.1f} MB")
+                else:
+                    print(f"  {scenario['name']:<22} {name:<26} {row['status']} {row.get('error', '')}")
+    return pd.DataFrame(rows)
+
+
+# --- 4. BASELINES ---
+
+def _environment():
+    import scipy
+    from . import __version__
+    return {
+        'meta': __version__,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+    }
+
+
+def save_baseline(results, path):
+    """Write benchmark results plus the software environment to a JSON file."""
+    payload = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'environment': _environment(),
+        'results': json.loads(results.to_json(orient='records')),
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, indent=2)
+
+
+def load_baseline(path):
+    """Read a file written by save_baseline(); returns (results DataFrame, environment dict)."""
+    with open(path, encoding='utf-8') as f:
+        payload = json.load(f)
+    return pd.DataFrame(payload['results']), payload.get('environment', {})
+
+
+def compare_to_baseline(results, baseline, time_tolerance=0.5, memory_tolerance=0.25,
+                        min_seconds=0.01, min_mb=1.0):
+    """
+    Compare benchmark results with a baseline.
+
+    Parameters:
+    -----------
+    results, baseline : DataFrame
+        Outputs of run_benchmarks() (baseline e.g. from load_baseline())
+    time_tolerance : float
+        Relative slowdown allowed before 'slower' is flagged (0.5 = 50%)
+    memory_tolerance : float
+        Relative peak-memory growth allowed before 'more_memory' is flagged
+    min_seconds, min_mb : float
+        Absolute growth below which time / memory changes are noise
+
+    Returns:
+    --------
+    DataFrame : One row per scenario x engine measured in both, with the
+                baseline values, ratios, one flag per check and
+                'regressed' (any flag set)
+    """
+    keys = ['scenario', 'engine']
+    columns = ['seconds', 'lik_evals', 'iterations', 'peak_mb']
+    current = results[results['status'] == 'ok'][keys + columns]
+    reference = baseline[baseline['status'] == 'ok'][keys + columns]
+    merged = current.merge(reference, on=keys, suffixes=('', '_baseline'))
+
+    merged['time_ratio'] = merged['seconds'] / merged['seconds_baseline']
+    merged['memory_ratio'] = merged['peak_mb'] / merged['peak_mb_baseline']
+    merged['slower'] = ((merged['time_ratio'] > 1 + time_tolerance)
+                        & (merged['seconds'] - merged['seconds_baseline'] > min_seconds))
+    merged['more_memory'] = ((merged['memory_ratio'] > 1 + memory_tolerance)
+                             & (merged['peak_mb'] - merged['peak_mb_baseline'] > min_mb))
+    merged['evals_changed'] = merged['lik_evals'] != merged['lik_evals_baseline']
+    merged['iterations_changed'] = ~(
+        (merged['iterations'] == merged['iterations_baseline'])
+        | (merged['iterations'].isna() & merged['iterations_baseline'].isna())
+    )
+    merged['regressed'] = merged[['slower', 'more_memory', 'evals_changed',
+                                  'iterations_changed']].any(axis=1)
+    return merged
+
+
+# --- 5. AGREEMENT CHECKS ---
+
+def check_tau_batch(n_datasets=2000, seed=0, max_iter=1000, tol=1e-6):
+    """
+    Check tau_squared_batch() against fit_tau_squared() on random datasets.
+
+    The datasets (2-30 effects, sampling variances over two orders of
+    magnitude) are estimated as groups of one batch call; about half have
+    true tau² = 0, where REML / ML are often at or near the boundary.
+
+    Returns:
+    --------
+    DataFrame : One row per dataset and method ('dataset', 'method', 'k',
+                'true_tau_sq', 'batch', 'single', 'batch_converged',
+                'rel_error', 'mismatch': rel_error > tol or not converged)
+    """
+    from .heterogeneity import fit_tau_squared, tau_squared_batch
+
+    rng = np.random.default_rng(seed)
+    k = rng.integers(2, 31, n_datasets)
+    true_tau_sq = np.where(rng.random(n_datasets) < 0.5, 0.0, rng.uniform(0.0, 0.5, n_datasets))
+    groups = np.repeat(np.arange(n_datasets), k)
+    vi = rng.uniform(0.001, 0.5, groups.size) ** rng.uniform(0.5, 2.0, n_datasets)[groups]
+    yi = rng.normal(0.0, np.sqrt(vi + true_tau_sq[groups]))
+    bounds = np.concatenate(([0], np.cumsum(k)))
+
+    batch = tau_squared_batch(yi, vi, groups=groups, methods=('REML', 'ML', 'PM'), max_iter=max_iter)
+    rows = []
+    for method in ('REML', 'ML', 'PM'):
+        for i in range(n_datasets):
+            lo, hi = bounds[i], bounds[i + 1]
+            single, _ = fit_tau_squared(yi[lo:hi], vi[lo:hi], method=method, max_iter=max_iter)
+            rows.append({'dataset': i, 'method': method, 'k': int(k[i]),
+                         'true_tau_sq': true_tau_sq[i], 'batch': batch[method][i], 'single': single,
+                         'batch_converged': bool(batch[f'{method}_converged'][i])})
+    table = pd.DataFrame(rows)
+    table['rel_error'] = (table['batch'] - table['single']).abs() / np.maximum(1.0, table['single'])
+    table['mismatch'] = (table['rel_error'] > tol) | ~table['batch_converged']
+    return table
+
+
+# --- 6. COMMAND LINE ---
+
+def main(argv=None):
+    """Command-line entry point; returns the process exit status."""
+    parser = argparse.ArgumentParser(prog='python -m meta.benchmark',
+                                     description="Benchmark the statistical engines on synthetic data.")
+    parser.add_argument('--suite', default='quick', choices=sorted(SCENARIOS))
+    parser.add_argument('--engines', nargs='+', choices=list(BENCHMARK_ENGINES))
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs per measurement (best is kept)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help="Write the results to this JSON file")
+    parser.add_argument('--baseline', help="Compare against this baseline file")
+    parser.add_argument('--save-baseline', help="Write the results as a new baseline file")
+    parser.add_argument('--time-tolerance', type=float, default=0.5)
+    parser.add_argument('--memory-tolerance', type=float, default=0.25)
+    parser.add_argument('--min-seconds', type=float, default=0.01,
+                        help="Ignore slowdowns smaller than this many seconds")
+    parser.add_argument('--check', action='store_true',
+                        help="Only check batched tau-squared estimates against single-dataset fits")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        table = check_tau_batch(seed=args.seed)
+        for method, rows in table.groupby('method', sort=False):
+            print(f"  tau_squared_batch {method:<5} {len(rows)} datasets, "
+                  f"{int(rows['mismatch'].sum())} mismatches, "
+                  f"max relative error {rows['rel_error'].max():.1e}")
+        return int(table['mismatch'].any())
+
+    results = run_benchmarks(args.suite, engines=args.engines, repeat=args.repeat, seed=args.seed)
+    for path in (args.output, args.save_baseline):
+        if path:
+            save_baseline(results, path)
+
+    if args.baseline:
+        baseline, environment = load_baseline(args.baseline)
+        comparison = compare_to_baseline(results, baseline, time_tolerance=args.time_tolerance,
+                                         memory_tolerance=args.memory_tolerance,
+                                         min_seconds=args.min_seconds)
+        print(f"\nBaseline: {args.baseline} (meta {environment.get('meta', '?')}, "
+              f"numpy {environment.get('numpy', '?')}, scipy {environment.get('scipy', '?')})")
+        regressed = comparison[comparison['regressed']]
+        if regressed.empty:
+            print(f"  no regressions in {len(comparison)} measurements")
+            return 0
+        for row in regressed.itertuples():
+            flags = [flag for flag in ('slower', 'more_memory', 'evals_changed', 'iterations_changed')
+                     if getattr(row, flag)]
+            print(f"  REGRESSION {row.scenario:<22} {row.engine:<26} {', '.join(flags)} "
+                  f"(time x{row.time_ratio:.2f}, evals {row.lik_evals_baseline} -> {row.lik_evals}, "
+                  f"memory x{row.memory_ratio:.2f})")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
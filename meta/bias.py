@@ -0,0 +1,379 @@
+"""
+Publication bias assessment.
+
+- egger_test_three_level: Egger regression test for funnel asymmetry
+  using the three-level meta-regression (effect ~ SE).
+- trimfill_analysis: Duval & Tweedie (2000) trim-and-fill (L0, R0 and Q0
+  estimators, fixed- or random-effects). This is a SENSITIVITY ANALYSIS,
+  not a correction.
+- trimfill_batch: the trim-and-fill grid over estimators, sides and
+  models, optionally for every group of a column.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm, t
+
+from .fit_cache import cached_fit
+from .perf import instrumented_fit
+from .heterogeneity import fit_tau_squared
+from .regression import run_three_level_reml_regression
+
+__all__ = [
+    'egger_test_three_level',
+    'TRIMFILL_ESTIMATORS',
+    'trimfill_analysis',
+    'trimfill_batch',
+]
+
+
+# --- 1. EGGER'S TEST (THREE-LEVEL) ---
+
+@instrumented_fit('egger')
+@cached_fit('egger')
+def egger_test_three_level(data, effect_col, var_col, se_col, start_params=None):
+    """
+    Robust Egger's test: three-level meta-regression of the effect on its
+    standard error. The intercept measures funnel-plot asymmetry.
+
+    Model: effect = β₀ + β₁*SE + (u_i + r_ij + e_ij)
+
+    Parameters:
+    -----------
+    data : DataFrame
+        Data with 'id', effect size, variance and SE columns
+    effect_col, var_col, se_col : str
+        Column names for effect sizes, variances and standard errors
+    start_params : tuple, optional
+        Starting (τ², σ²), typically the unconditional three-level estimates
+
+    Returns:
+    --------
+    dict : 'intercept', 'se_intercept', 'slope', 'p_value', 'df',
+           'k_obs', 'M_studies', 'converged'
+    """
+    estimates, dims, _ = run_three_level_reml_regression(
+        analysis_data=data,
+        moderator_col=se_col, # Use SE as the moderator
+        effect_col=effect_col,
+        var_col=var_col,
+        start_params=start_params
+    )
+
+    if estimates is None:
+        return {'intercept': np.nan, 'se_intercept': np.nan, 'slope': np.nan,
+                'p_value': np.nan, 'df': np.nan, 'k_obs': len(data),
+                'M_studies': data['id'].nunique(), 'converged': False}
+
+    N_total, M_studies, p_params = dims
+    b0_intercept, b1_slope = estimates['betas'][0], estimates['betas'][1]
+    se0_intercept = estimates['se_betas'][0]
+
+    t_stat_intercept = b0_intercept / se0_intercept
+    df_robust = M_studies - p_params
+    p_value = 2 * (1 - t.cdf(np.abs(t_stat_intercept), df=df_robust))
+
+    return {
+        'intercept': b0_intercept,
+        'se_intercept': se0_intercept,
+        'slope': b1_slope,
+        'p_value': p_value,
+        'df': df_robust,
+        'k_obs': N_total,
+        'M_studies': M_studies,
+        'converged': True
+    }
+
+
+# --- 2. TRIM-AND-FILL ---
+
+TRIMFILL_ESTIMATORS = ('L0', 'R0', 'Q0')
+
+def _tau_squared(y, v, tau_method):
+    if tau_method != 'DL':
+        return fit_tau_squared(y, v, method=tau_method)[0]
+    w = 1.0 / v
+    sum_w = w.sum()
+    Q = w @ (y - (w @ y) / sum_w)**2
+    C = sum_w - (w @ w) / sum_w
+    return max(0.0, (Q - (len(y) - 1)) / C) if C > 0 else 0.0
+
+def _pooled_fit(y, v, model, tau_method):
+    """Inverse-variance pooled estimate: (estimate, SE, tau²)."""
+    tau_sq = _tau_squared(y, v, tau_method) if model == 'random' else 0.0
+    w = 1.0 / (v + tau_sq)
+    sum_w = w.sum()
+    return (w @ y) / sum_w, np.sqrt(1.0 / sum_w), tau_sq
+
+def _funnel_side(y, v, model, tau_method):
+    """
+    Side the missing studies are imputed on: the sign of the slope of the
+    weighted regression of the effects on their standard errors (a
+    positive slope, small studies with larger effects, puts them on the
+    left).
+    """
+    tau_sq = _tau_squared(y, v, tau_method) if model == 'random' else 0.0
+    w = 1.0 / (v + tau_sq)
+    x = np.sqrt(v)
+    x_c = x - (w @ x) / w.sum()
+    slope = (w * x_c) @ y / ((w * x_c) @ x_c) if np.any(x_c != 0) else 0.0
+    return 'right' if slope < 0 else 'left'
+
+def _trimfill_core(y, v, estimator, model, tau_method, max_iter):
+    """
+    Iterative trim step on effects sorted ascending, with the missing
+    studies on the left (the right tail is trimmed).
+
+    The trimmed fit uses the first k - k0 effects (prefix sums for the
+    fixed-effect mean). The signed ranks of |y - b| need no sort: the
+    effects below and above b are each already ordered by |y - b|, so the
+    rank of an effect above b is its position among them plus the number
+    of effects below b with a smaller (or tied, ties.method='first')
+    deviation, found with one searchsorted.
+
+    Returns:
+    --------
+    tuple : (k0, se_k0, trimmed estimate b, iterations, converged)
+    """
+    k = len(y)
+    cum_w = np.cumsum(1.0 / v)
+    cum_wy = np.cumsum(y / v)
+    positions = np.arange(1, k + 1)
+
+    k0, converged = 0, False
+    for n_iter in range(1, max_iter + 1):
+        m = k - k0
+        if model == 'fixed':
+            b = cum_wy[m - 1] / cum_w[m - 1]
+        else:
+            b = _pooled_fit(y[:m], v[:m], model, tau_method)[0]
+
+        split = np.searchsorted(y, b, side='right')
+        below = (b - y[:split])[::-1]      # ascending |y - b|, y <= b
+        above = y[split:] - b              # ascending |y - b|, y > b
+        ranks_above = positions[:k - split] + np.searchsorted(below, above, side='right')
+
+        if estimator == 'R0':
+            # Run of positive ranks at the top: k minus the largest negative rank
+            negative = y[:split] < b
+            if negative.any():
+                largest = b - y[0]
+                max_negative_rank = split + np.searchsorted(above, largest, side='left')
+            else:
+                max_negative_rank = 0
+            k0_est = k - max_negative_rank - 1
+            se_k0 = np.sqrt(2 * max(0, k0_est) + 2)
+        else:
+            S_r = ranks_above.sum()
+            if estimator == 'L0':
+                k0_est = (4 * S_r - k * (k + 1)) / (2 * k - 1)
+            else:
+                k0_est = k - 0.5 - np.sqrt(max(2 * k**2 - 4 * S_r + 0.25, 0.0))
+            var_S_r = (k * (k + 1) * (2 * k + 1) + 10 * k0_est**3 + 27 * k0_est**2
+                       + 17 * k0_est - 18 * k * k0_est**2 - 18 * k * k0_est
+                       + 6 * k**2 * k0_est) / 24
+            if estimator == 'L0':
+                se_k0 = 4 * np.sqrt(max(var_S_r, 0.0)) / (2 * k - 1)
+            else:
+                denom = (k - 0.5)**2 - k0_est * (2 * k - k0_est - 1)
+                se_k0 = 2 * np.sqrt(max(var_S_r, 0.0)) / np.sqrt(denom) if denom > 0 else np.nan
+
+        k0_new = int(min(max(0, np.round(k0_est)), k - 1))
+        if k0_new == k0:
+            converged = True
+            break
+        k0 = k0_new
+
+    return k0, np.maximum(0.0, se_k0), b, n_iter, converged
+
+def _trimfill_arrays(y, v, estimator, side, model, tau_method, max_iter, original=None):
+    """trimfill_analysis() on validated arrays (original: precomputed _pooled_fit)."""
+    if estimator not in TRIMFILL_ESTIMATORS:
+        raise ValueError(f"Unknown estimator '{estimator}' (expected one of {TRIMFILL_ESTIMATORS})")
+    if model not in ('fixed', 'random'):
+        raise ValueError(f"Unknown model '{model}' (expected 'fixed' or 'random')")
+    k = len(y)
+    if k < 3:
+        raise ValueError("Trim-and-fill needs at least 3 studies")
+
+    if side == 'auto':
+        side = _funnel_side(y, v, model, tau_method)
+    sign = -1.0 if side == 'right' else 1.0
+    order = np.argsort(sign * y, kind='stable')
+    y_work, v_work = sign * y[order], v[order]
+
+    k0, se_k0, b, n_iter, converged = _trimfill_core(y_work, v_work, estimator, model,
+                                                     tau_method, max_iter)
+
+    trimmed_index = order[k - k0:]
+    yi_filled = sign * (2 * b - y_work[k - k0:])
+    vi_filled = v_work[k - k0:]
+    yi_combined = np.concatenate([y, yi_filled])
+    vi_combined = np.concatenate([v, vi_filled])
+
+    if original is None:
+        original = _pooled_fit(y, v, model, tau_method)
+    pooled_original, se_original, tau_sq_original = original
+    if k0 > 0:
+        pooled_filled, se_filled, tau_sq_filled = _pooled_fit(yi_combined, vi_combined,
+                                                              model, tau_method)
+    else:
+        pooled_filled, se_filled, tau_sq_filled = original
+    z_crit = norm.ppf(0.975)
+
+    return {
+        'k0': k0,
+        'se_k0': se_k0,
+        'side': side,
+        'k_original': k,
+        'k_filled': k + k0,
+        'pooled_original': pooled_original,
+        'se_original': se_original,
+        'ci_lower_original': pooled_original - z_crit * se_original,
+        'ci_upper_original': pooled_original + z_crit * se_original,
+        'pooled_filled': pooled_filled,
+        'se_filled': se_filled,
+        'ci_lower_filled': pooled_filled - z_crit * se_filled,
+        'ci_upper_filled': pooled_filled + z_crit * se_filled,
+        'tau_squared_original': tau_sq_original,
+        'tau_squared_filled': tau_sq_filled,
+        'trimmed_index': trimmed_index,
+        'yi_filled': yi_filled,
+        'vi_filled': vi_filled,
+        'yi_combined': yi_combined,
+        'vi_combined': vi_combined,
+        'estimator': estimator,
+        'model': model,
+        'n_iter': n_iter,
+        'converged': converged
+    }
+
+@instrumented_fit('trimfill')
+@cached_fit('trimfill')
+def trimfill_analysis(data, effect_col, var_col, estimator='L0', side='auto', max_iter=100,
+                      model='fixed', tau_method='REML'):
+    """
+    Duval & Tweedie (2000) Trim-and-Fill Method
+
+    This is a SENSITIVITY ANALYSIS to assess potential publication bias impact.
+    DO NOT use the "adjusted" estimate as your final result!
+
+    The effects are sorted once; each iteration refits the model on the
+    untrimmed part, ranks |y - b| and re-estimates k0 until k0 stops
+    changing (as in metafor's trimfill). The k0 most extreme effects on
+    the side opposite the missing studies are then mirrored around the
+    trimmed estimate and the model is refitted on the filled data.
+
+    Parameters:
+    -----------
+    data : DataFrame
+        Data with effect sizes and variances
+    effect_col : str
+        Column name for effect sizes
+    var_col : str
+        Column name for variances
+    estimator : str
+        'L0' (linear), 'R0' (rank), or 'Q0' (quadratic)
+    side : str
+        Side the missing studies are imputed on: 'left', 'right', or
+        'auto' (from the sign of the effect-vs-SE regression slope)
+    max_iter : int
+        Maximum iterations
+    model : str
+        'fixed' or 'random' effects for the trimming, original and filled fits
+    tau_method : str
+        tau² estimator for model='random': 'DL', 'REML', 'ML' or 'PM'
+
+    Returns:
+    --------
+    dict : Results including k0 (# studies to trim) and its SE, filled data,
+           original and filled estimates, and trimmed_index (positions in
+           data of the studies that were mirrored). Rows with a non-finite
+           effect or variance, or a variance <= 0, are left out.
+    """
+    y = np.asarray(data[effect_col].values, dtype=float)
+    v = np.asarray(data[var_col].values, dtype=float)
+    valid = np.isfinite(y) & np.isfinite(v) & (v > 0)
+    if valid.all():
+        return _trimfill_arrays(y, v, estimator, side, model, tau_method, max_iter)
+    results = _trimfill_arrays(y[valid], v[valid], estimator, side, model, tau_method, max_iter)
+    results['trimmed_index'] = np.flatnonzero(valid)[results['trimmed_index']]
+    return results
+
+@instrumented_fit('trimfill_batch')
+@cached_fit('trimfill_batch')
+def trimfill_batch(data, effect_col, var_col, group_col=None, estimators=TRIMFILL_ESTIMATORS,
+                   sides=('auto', 'left', 'right'), models=('fixed', 'random'),
+                   tau_method='REML', max_iter=100, min_k=3):
+    """
+    Trim-and-fill sensitivity grid: every estimator x side x model, for
+    the whole data set or for every group of group_col, in one call.
+
+    The data are partitioned by group once; per group and model the
+    original fit (and the automatic side) is computed once and shared by
+    all estimator/side runs.
+
+    Parameters:
+    -----------
+    data : DataFrame
+        Data with effect sizes and variances
+    effect_col, var_col : str
+        Column names for effect sizes and variances
+    group_col : str or None
+        Grouping column (e.g. outcome or moderator); None for all data
+    estimators, sides, models : sequence of str
+        Values passed to trimfill_analysis()
+    tau_method : str
+        tau² estimator for the random-effects runs
+    max_iter : int
+        Maximum iterations per run
+    min_k : int
+        Groups with fewer valid effects are left out (at least 3)
+
+    Returns:
+    --------
+    DataFrame : One row per group x estimator x side x model with the
+                scalar results of trimfill_analysis() ('side' is the side
+                used, 'side_requested' what was asked for)
+    """
+    y_all = np.asarray(data[effect_col].values, dtype=float)
+    v_all = np.asarray(data[var_col].values, dtype=float)
+    valid = np.isfinite(y_all) & np.isfinite(v_all) & (v_all > 0)
+
+    if group_col is None:
+        codes, groups = np.zeros(len(data), dtype=np.intp), ['All']
+    else:
+        codes, groups = pd.factorize(data[group_col], sort=True)
+        valid &= codes >= 0
+    codes, y_all, v_all = codes[valid], y_all[valid], v_all[valid]
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(groups) + 1))
+
+    scalar_keys = ('k0', 'se_k0', 'side', 'k_original', 'k_filled', 'pooled_original',
+                   'se_original', 'ci_lower_original', 'ci_upper_original', 'pooled_filled',
+                   'se_filled', 'ci_lower_filled', 'ci_upper_filled', 'tau_squared_original',
+                   'tau_squared_filled', 'n_iter', 'converged')
+    rows = []
+    for g, group in enumerate(groups):
+        index = order[bounds[g]:bounds[g + 1]]
+        if len(index) < max(min_k, 3):
+            continue
+        y, v = y_all[index], v_all[index]
+        for model in models:
+            original = _pooled_fit(y, v, model, tau_method)
+            auto_side = _funnel_side(y, v, model, tau_method) if 'auto' in sides else None
+            for side in sides:
+                for estimator in estimators:
+                    result = _trimfill_arrays(y, v, estimator,
+                                              auto_side if side == 'auto' else side,
+                                              model, tau_method, max_iter, original=original)
+                    row = {'group': group, 'estimator': estimator, 'model': model,
+                           'side_requested': side}
+                    row.update({key: result[key] for key in scalar_keys})
+                    rows.append(row)
+
+    columns = ['group', 'estimator', 'model', 'side_requested'] + list(scalar_keys)
+    results_df = pd.DataFrame(rows, columns=columns)
+    if group_col is not None:
+        results_df = results_df.rename(columns={'group': group_col})
+    return results_df
@@ -0,0 +1,302 @@
+"""
+Cluster (study-level) bootstrap for the three-level model.
+
+Studies are resampled with replacement by `id`. Because the data are
+sorted once by study (three_level.build_study_segments), a replicate is
+just an index array into the sorted effect sizes/variances plus new
+segment offsets: no DataFrame is copied or regrouped. Every replicate is
+refitted with the Fisher scoring engine, warm-started from the full-data
+(τ², σ²), and replicates are spread over a process pool. Each replicate
+draws from its own child of one SeedSequence, so results depend only on
+the seed, not on n_jobs or chunking.
+
+Intervals are percentile and BCa (bias-corrected and accelerated; the
+acceleration comes from the leave-one-study-out jackknife) for μ, τ², σ²
+and I² = (τ² + σ²) / (τ² + σ² + mean vᵢⱼ).
+
+Usage:
+    boot = run_three_level_bootstrap(data, 'lnRR', 'var_lnRR', n_boot=2000,
+                                     seed=1, n_jobs=16)
+    boot['intervals']
+"""
+
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from .fit_cache import cached_fit
+from .perf import instrumented_fit
+from .three_level import (build_study_segments, get_three_level_estimates,
+                          fit_three_level_fisher, fit_three_level_segments)
+from .sensitivity import run_three_level_loo
+
+__all__ = [
+    'BOOTSTRAP_PARAMETERS',
+    'resample_studies',
+    'cluster_bootstrap_three_level',
+    'bootstrap_intervals',
+    'run_three_level_bootstrap',
+]
+
+BOOTSTRAP_PARAMETERS = ('mu', 'tau_sq', 'sigma_sq', 'I_squared')
+
+
+# --- 1. RESAMPLING ---
+
+def resample_studies(seg_starts, counts, rng):
+    """
+    Draw studies with replacement and return the rows of the replicate.
+
+    Each drawn study keeps its whole block of rows; a study drawn twice
+    becomes two separate clusters.
+
+    Parameters:
+    -----------
+    seg_starts, counts : ndarray
+        Start offset and number of rows of every study block
+    rng : numpy.random.Generator
+        Random source
+
+    Returns:
+    --------
+    ndarray : Row indices into the sorted arrays
+    ndarray : Segment offsets of the replicate
+    """
+    drawn = rng.integers(0, len(seg_starts), len(seg_starts))
+    drawn_counts = counts[drawn]
+    new_starts = np.concatenate(([0], np.cumsum(drawn_counts)[:-1])).astype(np.intp)
+    rows = np.arange(drawn_counts.sum()) + np.repeat(seg_starts[drawn] - new_starts, drawn_counts)
+    return rows, new_starts
+
+
+def _i_squared(tau_sq, sigma_sq, mean_v):
+    total = tau_sq + sigma_sq + mean_v
+    return (tau_sq + sigma_sq) / total * 100 if total > 0 else 0.0
+
+
+def _fit_replicate(y_sorted, v_sorted, seg_starts, counts, start_params, entropy, replicate,
+                   fit_kwargs):
+    """
+    Resample and refit replicate number `replicate`.
+
+    Returns:
+    --------
+    ndarray : (μ, τ², σ², I²), all NaN if the fit failed
+    """
+    rng = np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(replicate,)))
+    rows, new_starts = resample_studies(seg_starts, counts, rng)
+    y_b, v_b = y_sorted[rows], v_sorted[rows]
+    args = (y_b, v_b, new_starts, len(rows), len(new_starts))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        result = fit_three_level_fisher(start_params, *args, **fit_kwargs)
+        if not result.success:
+            return np.full(len(BOOTSTRAP_PARAMETERS), np.nan)
+        estimates = get_three_level_estimates(result.x, *args)
+    tau_sq, sigma_sq = result.x
+    return np.array([estimates['mu'], tau_sq, sigma_sq, _i_squared(tau_sq, sigma_sq, v_b.mean())])
+
+# --- Parallel bootstrap workers ---
+# Each worker receives the sorted arrays once (initializer); each task is a
+# replicate number, from which the worker derives that replicate's seed.
+
+_BOOT_SHARED = {}
+
+def _init_bootstrap_worker(y_sorted, v_sorted, seg_starts, counts, start_params, entropy,
+                           fit_kwargs):
+    _BOOT_SHARED.update(y_sorted=y_sorted, v_sorted=v_sorted, seg_starts=seg_starts,
+                        counts=counts, start_params=start_params, entropy=entropy,
+                        fit_kwargs=fit_kwargs)
+
+def _bootstrap_worker(replicate):
+    return _fit_replicate(_BOOT_SHARED['y_sorted'], _BOOT_SHARED['v_sorted'],
+                          _BOOT_SHARED['seg_starts'], _BOOT_SHARED['counts'],
+                          _BOOT_SHARED['start_params'], _BOOT_SHARED['entropy'],
+                          replicate, _BOOT_SHARED['fit_kwargs'])
+
+def cluster_bootstrap_three_level(y_sorted, v_sorted, seg_starts, start_params, n_boot=2000,
+                                  seed=None, n_jobs=1, info_type='expected', log_scale=False):
+    """
+    Refit the three-level model on n_boot study-level resamples.
+
+    Parameters:
+    -----------
+    y_sorted, v_sorted, seg_starts : ndarray
+        Output of build_study_segments()
+    start_params : tuple
+        Full-data (τ², σ²), used as the warm start of every refit
+    n_boot : int
+        Number of replicates
+    seed : int or None
+        Seed of the SeedSequence (None: fresh entropy, reported back)
+    n_jobs : int
+        Worker processes (1 = run in this process)
+    info_type, log_scale :
+        Passed to fit_three_level_fisher
+
+    Returns:
+    --------
+    ndarray : (n_boot, 4) replicates of (μ, τ², σ², I²); failed fits are NaN
+    int : Entropy of the SeedSequence (pass as seed to reproduce)
+    """
+    entropy = np.random.SeedSequence(seed).entropy
+    counts = np.diff(np.append(seg_starts, len(y_sorted)))
+    start_params = (max(start_params[0], 1e-8), max(start_params[1], 1e-8))
+    fit_kwargs = {'info_type': info_type, 'log_scale': log_scale}
+    shared = (y_sorted, v_sorted, seg_starts, counts, start_params, entropy, fit_kwargs)
+
+    replicates = range(n_boot)
+    if n_jobs > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=_init_bootstrap_worker,
+                                     initargs=shared) as pool:
+                chunksize = max(1, n_boot // (4 * n_jobs))
+                return np.array(list(pool.map(_bootstrap_worker, replicates,
+                                              chunksize=chunksize))), entropy
+        except (OSError, RuntimeError) as e:
+            warnings.warn(f"Process pool unavailable ({e}), running sequentially")
+    y_sorted, v_sorted, seg_starts, counts, start_params, entropy, fit_kwargs = shared
+    return np.array([_fit_replicate(y_sorted, v_sorted, seg_starts, counts, start_params,
+                                    entropy, b, fit_kwargs) for b in replicates]), entropy
+
+
+# --- 2. INTERVALS ---
+
+def bootstrap_intervals(point, replicates, jackknife=None, alpha=0.05,
+                        parameters=BOOTSTRAP_PARAMETERS):
+    """
+    Percentile and BCa intervals from bootstrap replicates.
+
+    BCa: z0 = Φ⁻¹(share of replicates below the estimate, ties counted
+    half), a = Σd³ / (6 (Σd²)^1.5) with d the jackknife deviations from
+    their mean, and the percentile levels are moved to
+    Φ(z0 + (z0 + z_α) / (1 - a (z0 + z_α))). Without a jackknife a = 0
+    (bias-corrected percentile interval).
+
+    Parameters:
+    -----------
+    point : array-like
+        Full-data estimates, one per parameter
+    replicates : ndarray
+        (n_boot, n_parameters) replicates; NaN rows (failed fits) are ignored
+    jackknife : ndarray, optional
+        (n_studies, n_parameters) leave-one-study-out estimates
+    alpha : float
+        1 - confidence level
+    parameters : sequence of str
+        Row labels
+
+    Returns:
+    --------
+    DataFrame : One row per parameter: estimate, se_boot, bias_boot,
+                ci_lower_pct, ci_upper_pct, ci_lower_bca, ci_upper_bca, n_boot
+    """
+    point = np.asarray(point, dtype=float)
+    replicates = np.asarray(replicates, dtype=float)
+    replicates = replicates[np.all(np.isfinite(replicates), axis=1)]
+    n_boot = len(replicates)
+    levels = np.array([alpha / 2, 1 - alpha / 2])
+
+    rows = []
+    for j, name in enumerate(parameters):
+        theta = replicates[:, j]
+        row = {'parameter': name, 'estimate': point[j], 'n_boot': n_boot}
+        if n_boot < 2:
+            rows.append({**row, 'se_boot': np.nan, 'bias_boot': np.nan,
+                         'ci_lower_pct': np.nan, 'ci_upper_pct': np.nan,
+                         'ci_lower_bca': np.nan, 'ci_upper_bca': np.nan})
+            continue
+        pct = np.quantile(theta, levels)
+
+        share_below = (np.sum(theta < point[j]) + 0.5 * np.sum(theta == point[j])) / n_boot
+        z0 = norm.ppf(np.clip(share_below, 0.5 / n_boot, 1 - 0.5 / n_boot))
+        accel = 0.0
+        if jackknife is not None:
+            jack = np.asarray(jackknife, dtype=float)[:, j]
+            d = np.nanmean(jack) - jack[np.isfinite(jack)]
+            denom = 6.0 * np.sum(d**2)**1.5
+            accel = np.sum(d**3) / denom if denom > 0 else 0.0
+        z = z0 + norm.ppf(levels)
+        bca = np.quantile(theta, norm.cdf(z0 + z / (1 - accel * z)))
+
+        rows.append({**row, 'se_boot': np.std(theta, ddof=1), 'bias_boot': theta.mean() - point[j],
+                     'ci_lower_pct': pct[0], 'ci_upper_pct': pct[1],
+                     'ci_lower_bca': bca[0], 'ci_upper_bca': bca[1]})
+    return pd.DataFrame(rows).set_index('parameter')
+
+
+# --- 3. DRIVER ---
+
+@instrumented_fit('three_level_bootstrap')
+@cached_fit('three_level_bootstrap')
+def run_three_level_bootstrap(analysis_data, effect_col, var_col, n_boot=2000, seed=None,
+                              n_jobs=1, alpha=0.05, bca=True, fit_method='fisher',
+                              info_type='expected', log_scale=False):
+    """
+    Three-level fit plus cluster bootstrap intervals for μ, τ², σ² and I².
+
+    Parameters:
+    -----------
+    analysis_data : DataFrame
+        Data with 'id', effect size and variance columns
+    effect_col, var_col : str
+        Column names for effect sizes and variances
+    n_boot : int
+        Number of bootstrap replicates
+    seed : int or None
+        Seed for reproducible replicates
+    n_jobs : int
+        Worker processes for the replicates (and the BCa jackknife)
+    alpha : float
+        1 - confidence level
+    bca : bool
+        Also run the leave-one-study-out jackknife for BCa acceleration
+    fit_method, info_type, log_scale :
+        Passed to the three-level engine for the full-data fit
+
+    Returns:
+    --------
+    dict : 'estimates' (full-data fit), 'intervals' (DataFrame),
+           'replicates' (ndarray), 'n_failed', 'seed' (entropy used)
+    """
+    y_sorted, v_sorted, seg_starts, _ = build_study_segments(analysis_data, effect_col, var_col)
+    estimates, _, _ = fit_three_level_segments(y_sorted, v_sorted, seg_starts, fit_method=fit_method,
+                                               info_type=info_type, log_scale=log_scale,
+                                               ci_method=None)
+    if estimates is None:
+        raise RuntimeError("Three-level REML fit failed; nothing to bootstrap.")
+
+    tau_sq, sigma_sq = estimates['tau_sq'], estimates['sigma_sq']
+    point = [estimates['mu'], tau_sq, sigma_sq, _i_squared(tau_sq, sigma_sq, v_sorted.mean())]
+
+    replicates, entropy = cluster_bootstrap_three_level(
+        y_sorted, v_sorted, seg_starts, (tau_sq, sigma_sq), n_boot=n_boot, seed=seed,
+        n_jobs=n_jobs, info_type=info_type, log_scale=log_scale
+    )
+
+    jackknife = None
+    if bca:
+        counts = np.diff(np.append(seg_starts, len(y_sorted)))
+        v_total = np.add.reduceat(v_sorted, seg_starts)
+        jack_rows = []
+        for j, est in enumerate(run_three_level_loo(y_sorted, v_sorted, seg_starts,
+                                                    (tau_sq, sigma_sq), n_jobs=n_jobs)):
+            if est is None:
+                jack_rows.append([np.nan] * len(BOOTSTRAP_PARAMETERS))
+                continue
+            mean_v = (v_sorted.sum() - v_total[j]) / (len(y_sorted) - counts[j])
+            jack_rows.append([est['mu'], est['tau_sq'], est['sigma_sq'],
+                              _i_squared(est['tau_sq'], est['sigma_sq'], mean_v)])
+        jackknife = np.array(jack_rows)
+
+    return {
+        'estimates': estimates,
+        'intervals': bootstrap_intervals(point, replicates, jackknife, alpha=alpha),
+        'replicates': replicates,
+        'n_failed': int(np.sum(~np.all(np.isfinite(replicates), axis=1))),
+        'seed': entropy,
+    }
@@ -0,0 +1,383 @@
+"""
+Data loading and cleaning.
+
+Data sources: local CSV / TSV, Parquet and Excel files are read directly
+(readers are looked up by file extension and more can be added with
+register_reader()); Google Sheets is an optional backend via gspread.
+Either way the raw table is converted once to typed columns (numeric
+columns become numbers, text is stripped) and the typed frame is cached
+on disk, keyed by a hash of the file contents or the sheet revision, so
+repeat loads skip reading and parsing.
+
+Cleaning mirrors the notebook's "APPLY CONFIGURATION & PREPARE DATA" step:
+rename the mapped columns to their roles (id, xe, sde, ne, xc, sdc, nc),
+convert them to numbers, drop unusable rows and apply the optional
+pre-filter.
+
+Usage:
+    raw, source_info = load_table('outcome.csv')
+    raw, source_info = load_gsheet(spreadsheet, 'Sheet1')
+    data_filtered, load_metadata = clean_data(raw, col_map)
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    'NUMERIC_COLUMNS',
+    'DEFAULT_CACHE_DIR',
+    'register_reader',
+    'read_table',
+    'coerce_types',
+    'file_fingerprint',
+    'load_table',
+    'load_gsheet',
+    'clean_data',
+]
+
+NUMERIC_COLUMNS = ['xe', 'sde', 'ne', 'xc', 'sdc', 'nc']
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'META_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'meta', 'data')
+)
+
+# Bump when coerce_types() changes so stale cache entries are not reused
+_CACHE_VERSION = 1
+
+
+# --- 1. READERS ---
+
+def _read_csv(path, sheet_name=0):
+    return pd.read_csv(path, skipinitialspace=True)
+
+def _read_tsv(path, sheet_name=0):
+    return pd.read_csv(path, sep='\t', skipinitialspace=True)
+
+def _read_parquet(path, sheet_name=0):
+    return pd.read_parquet(path)
+
+def _read_excel(path, sheet_name=0):
+    return pd.read_excel(path, sheet_name=sheet_name)
+
+_READERS = {
+    '.csv': _read_csv,
+    '.txt': _read_csv,
+    '.tsv': _read_tsv,
+    '.parquet': _read_parquet,
+    '.pq': _read_parquet,
+    '.xlsx': _read_excel,
+    '.xls': _read_excel,
+}
+
+
+def register_reader(extensions, reader):
+    """
+    Register a reader for one or more file extensions.
+
+    reader(path, sheet_name=0) must return a DataFrame; its output goes
+    through coerce_types() and the cache like the built-in readers.
+    """
+    if isinstance(extensions, str):
+        extensions = [extensions]
+    for ext in extensions:
+        ext = ext.lower()
+        _READERS[ext if ext.startswith('.') else f'.{ext}'] = reader
+
+
+def read_table(path, sheet_name=0):
+    """
+    Read a local file into a DataFrame (no typing, no cache).
+
+    Parameters:
+    -----------
+    path : str
+        File path; the format is taken from the extension
+    sheet_name : str or int
+        Worksheet to read for Excel files
+
+    Returns:
+    --------
+    DataFrame
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in _READERS:
+        raise ValueError(f"Unsupported input format '{ext}' "
+                         f"(expected one of {sorted(_READERS)})")
+    return _READERS[ext](path, sheet_name=sheet_name)
+
+
+# --- 2. TYPING ---
+
+def coerce_types(raw_data):
+    """
+    Convert a raw table to typed columns in one pass.
+
+    Text columns are stripped and empty strings become NaN. A column whose
+    non-missing values all parse as numbers becomes numeric; anything
+    else stays text (object dtype), so categorical moderators are still
+    found by the `dtype == 'object'` checks.
+    """
+    typed = {}
+    for col in raw_data.columns:
+        series = raw_data[col]
+        if series.dtype == 'object' or pd.api.types.is_string_dtype(series.dtype):
+            missing = series.isna()
+            series = series.astype(str).str.strip().astype(object)
+            series = series.mask(missing | (series == ''))
+            numeric = pd.to_numeric(series, errors='coerce')
+            if numeric.notna().sum() == series.notna().sum() and series.notna().any():
+                series = numeric
+        typed[col] = series
+    return pd.DataFrame(typed, index=raw_data.index)
+
+
+# --- 3. CACHED LOADING ---
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    """SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cache_key(*parts):
+    payload = json.dumps([_CACHE_VERSION] + [str(part) for part in parts])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _cache_read(cache_dir, key):
+    path = os.path.join(cache_dir, f'{key}.pkl')
+    if not os.path.exists(path):
+        return None
+    try:
+        return pd.read_pickle(path)
+    except Exception:
+        # Corrupt or incompatible entry: treat as a miss and overwrite
+        return None
+
+
+def _cache_write(cache_dir, key, data):
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file and rename so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        data.to_pickle(tmp_path)
+        os.replace(tmp_path, os.path.join(cache_dir, f'{key}.pkl'))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _load_cached(key, load_raw, cache_dir, use_cache):
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    if use_cache:
+        data = _cache_read(cache_dir, key)
+        if data is not None:
+            return data, True
+    data = coerce_types(load_raw())
+    if use_cache:
+        try:
+            _cache_write(cache_dir, key, data)
+        except OSError:
+            # A read-only or full cache directory must not break loading
+            pass
+    return data, False
+
+
+def load_table(path, sheet_name=0, cache_dir=None, use_cache=True):
+    """
+    Load a local CSV, Parquet or Excel file as a typed DataFrame.
+
+    The typed frame is cached under cache_dir keyed by the SHA-256 of the
+    file contents (plus the sheet name), so an unchanged file loads
+    straight from the cache and an edited one is re-read.
+
+    Parameters:
+    -----------
+    path : str
+        File path; the format is taken from the extension
+    sheet_name : str or int
+        Worksheet to read for Excel files
+    cache_dir : str or None
+        Cache directory (default DEFAULT_CACHE_DIR, or $META_CACHE_DIR)
+    use_cache : bool
+        Read from and write to the cache
+
+    Returns:
+    --------
+    tuple : (raw_data, source_info)
+    """
+    fingerprint = file_fingerprint(path)
+    key = _cache_key('file', fingerprint, sheet_name)
+    data, cache_hit = _load_cached(key, lambda: read_table(path, sheet_name=sheet_name),
+                                   cache_dir, use_cache)
+    source_info = {
+        'source': 'file',
+        'path': os.path.abspath(path),
+        'sheet_name': sheet_name,
+        'fingerprint': fingerprint,
+        'cache_hit': cache_hit,
+    }
+    return data, source_info
+
+
+def _sheet_revision(spreadsheet):
+    """Last-modified time of a gspread Spreadsheet, or None if unavailable."""
+    try:
+        if hasattr(spreadsheet, 'get_lastUpdateTime'):  # gspread >= 6
+            return spreadsheet.get_lastUpdateTime()
+        return spreadsheet.lastUpdateTime
+    except Exception:
+        return None
+
+
+def load_gsheet(spreadsheet, worksheet_name, cache_dir=None, use_cache=True):
+    """
+    Load a Google Sheets worksheet (gspread) as a typed DataFrame.
+
+    When the spreadsheet's revision time is available the cache is checked
+    before any cell values are downloaded; otherwise the values are fetched
+    and hashed, which still skips re-typing an unchanged sheet.
+
+    Parameters:
+    -----------
+    spreadsheet : gspread.Spreadsheet
+        Opened spreadsheet
+    worksheet_name : str
+        Worksheet title
+    cache_dir : str or None
+        Cache directory (default DEFAULT_CACHE_DIR, or $META_CACHE_DIR)
+    use_cache : bool
+        Read from and write to the cache
+
+    Returns:
+    --------
+    tuple : (raw_data, source_info)
+    """
+    revision = _sheet_revision(spreadsheet)
+    rows = None
+
+    def fetch_rows():
+        values = spreadsheet.worksheet(worksheet_name).get_all_values()
+        if not values or len(values) < 2:
+            raise ValueError("Worksheet has no data or no header row.")
+        return values
+
+    if revision is not None:
+        fingerprint = f"rev:{revision}"
+    else:
+        rows = fetch_rows()
+        fingerprint = hashlib.sha256(json.dumps(rows).encode('utf-8')).hexdigest()
+
+    def load_raw():
+        values = rows if rows is not None else fetch_rows()
+        return pd.DataFrame.from_records(values[1:], columns=values[0])
+
+    key = _cache_key('gsheet', spreadsheet.id, worksheet_name, fingerprint)
+    data, cache_hit = _load_cached(key, load_raw, cache_dir, use_cache)
+    source_info = {
+        'source': 'gsheet',
+        'spreadsheet_id': spreadsheet.id,
+        'worksheet': worksheet_name,
+        'fingerprint': fingerprint,
+        'cache_hit': cache_hit,
+    }
+    return data, source_info
+
+
+# --- 4. CLEANING ---
+
+
+def clean_data(raw_data_from_sheet, col_map, prefilter_col='None', prefilter_values='All'):
+    """
+    Rename, type-convert and filter the raw data.
+
+    Parameters:
+    -----------
+    raw_data_from_sheet : DataFrame
+        Raw data as loaded (strings or numbers)
+    col_map : dict
+        Source column name -> role ('id', 'xe', 'sde', 'ne', 'xc', 'sdc', 'nc'),
+        as stored in ANALYSIS_CONFIG['col_map']
+    prefilter_col : str
+        Column to pre-filter on, or 'None'
+    prefilter_values : list or 'All'
+        Values of prefilter_col to keep
+
+    Returns:
+    --------
+    tuple : (data_filtered, load_metadata)
+    """
+    mapped_cols = list(col_map.keys())
+    missing = [col for col in mapped_cols if col not in raw_data_from_sheet.columns]
+    if missing:
+        raise ValueError(f"Mapped column(s) not found in data: {missing}")
+    other_cols = [col for col in raw_data_from_sheet.columns if col not in mapped_cols]
+
+    raw_data = raw_data_from_sheet[mapped_cols + other_cols].copy()
+    raw_data.rename(columns=col_map, inplace=True)
+
+    original_rows = len(raw_data)
+    cleaning_log = []
+
+    # Convert numeric columns (already numeric when loaded through load_table/load_gsheet)
+    for col in NUMERIC_COLUMNS:
+        if col not in raw_data.columns:
+            raise ValueError(f"Mapped column '{col}' not found after loading.")
+        if not pd.api.types.is_numeric_dtype(raw_data[col]):
+            raw_data[col] = raw_data[col].astype(str).str.strip().replace('', np.nan)
+            raw_data[col] = pd.to_numeric(raw_data[col], errors='coerce')
+
+    # Ensure ID is string (numeric ids are typed as numbers on load)
+    if pd.api.types.is_float_dtype(raw_data['id']) and (raw_data['id'].dropna() % 1 == 0).all():
+        raw_data['id'] = raw_data['id'].astype('Int64')
+    raw_data['id'] = raw_data['id'].astype(str).str.strip()
+
+    # Drop rows with missing essential values
+    essential_cols = ['xe', 'ne', 'xc', 'nc']
+    missing_essential = raw_data[essential_cols].isna().any(axis=1).sum()
+    raw_data.dropna(subset=essential_cols, inplace=True)
+    if missing_essential > 0:
+        cleaning_log.append(f"Dropped {missing_essential} rows (missing xe/ne/xc/nc)")
+
+    # Ensure N >= 1
+    invalid_n_count = 0
+    for col in ['ne', 'nc']:
+        raw_data[col] = raw_data[col].fillna(0).astype(int)
+        invalid_n = (raw_data[col] < 1).sum()
+        if invalid_n > 0:
+            raw_data = raw_data[raw_data[col] >= 1]
+            invalid_n_count += invalid_n
+    if invalid_n_count > 0:
+        cleaning_log.append(f"Dropped {invalid_n_count} rows (n < 1)")
+
+    final_rows = len(raw_data)
+
+    # Potential moderators: every remaining text column
+    excluded_cols = ['id'] + NUMERIC_COLUMNS
+    available_moderators = [col for col in raw_data.columns
+                            if col not in excluded_cols
+                            and raw_data[col].dtype == 'object']
+
+    # Apply pre-filter (if selected)
+    data_filtered = raw_data.copy()
+    if prefilter_col not in (None, 'None'):
+        data_filtered = data_filtered[data_filtered[prefilter_col].isin(prefilter_values)]
+
+    load_metadata = {
+        'original_rows': original_rows,
+        'final_rows_cleaned': final_rows,
+        'final_rows_filtered': len(data_filtered),
+        'cleaning_log': cleaning_log,
+        'available_moderators': available_moderators,
+        'column_map': col_map
+    }
+    return data_filtered, load_metadata
@@ -0,0 +1,402 @@
+"""
+Effect size calculation.
+
+Mirrors the notebook's "CALCULATE EFFECT SIZES" step: median-CV imputation
+of missing/zero standard deviations, zero/negative handling for ratio
+measures, the effect size itself (lnRR, Hedges' g, Cohen's d or log OR)
+with its variance, SE and 95% CI, and fixed-effects weights.
+
+compute_effect_sizes() is the vectorized core: every effect type is
+computed in one pass over contiguous float arrays, sharing the log ratio
+and pooled SD between the measures that use them, with no per-row Python
+and no temporary DataFrame columns. effect_size_table() returns all
+types side by side for sensitivity runs.
+
+Usage:
+    data, calculation_log = calculate_effect_sizes(data_filtered, 'lnRR')
+    es_config = ES_CONFIGS['lnRR']
+    all_types = effect_size_table(data_filtered)
+"""
+
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    'ES_CONFIGS',
+    'ZERO_CONSTANT',
+    'EFFECT_SIZE_COLUMNS',
+    'impute_missing_sds',
+    'compute_effect_sizes',
+    'effect_size_table',
+    'calculate_effect_sizes',
+]
+
+# Small constant added to zero means so log ratios stay finite
+ZERO_CONSTANT = 0.001
+
+# Configuration for each effect size type (ANALYSIS_CONFIG['es_config'])
+ES_CONFIGS = {
+    'lnRR': {
+        'effect_col': 'lnRR',
+        'var_col': 'var_lnRR',
+        'se_col': 'SE_lnRR',
+        'ci_lower_col': 'CI_lower_lnRR',
+        'ci_upper_col': 'CI_upper_lnRR',
+        'effect_label': 'log Response Ratio',
+        'effect_label_short': 'lnRR',
+        'has_fold_change': True,
+        'fold_change_col': 'Response_Ratio',
+        'percent_change_col': 'Percent_Change',
+        'null_value': 0,
+        'scale': 'log',
+        'allows_negative': False,
+        'allows_zero': False
+    },
+    'hedges_g': {
+        'effect_col': 'hedges_g',
+        'var_col': 'Vg',
+        'se_col': 'SE_g',
+        'ci_lower_col': 'CI_lower_g',
+        'ci_upper_col': 'CI_upper_g',
+        'effect_label': "Hedges' g",
+        'effect_label_short': 'g',
+        'has_fold_change': False,
+        'null_value': 0,
+        'scale': 'standardized',
+        'allows_negative': True,
+        'allows_zero': True,
+        'correction_factor': 'J'
+    },
+    'cohen_d': {
+        'effect_col': 'cohen_d',
+        'var_col': 'Vd',
+        'se_col': 'SE_d',
+        'ci_lower_col': 'CI_lower_d',
+        'ci_upper_col': 'CI_upper_d',
+        'effect_label': "Cohen's d",
+        'effect_label_short': 'd',
+        'has_fold_change': False,
+        'null_value': 0,
+        'scale': 'standardized',
+        'allows_negative': True,
+        'allows_zero': True,
+        'correction_factor': None
+    },
+    'log_or': {
+        'effect_col': 'log_OR',
+        'var_col': 'var_log_OR',
+        'se_col': 'SE_log_OR',
+        'ci_lower_col': 'CI_lower_log_OR',
+        'ci_upper_col': 'CI_upper_log_OR',
+        'effect_label': 'log Odds Ratio',
+        'effect_label_short': 'logOR',
+        'has_fold_change': True,
+        'fold_change_col': 'Odds_Ratio',
+        'null_value': 0,
+        'scale': 'log',
+        'allows_negative': False,
+        'allows_zero': False,
+        'requires_binary': True
+    }
+}
+
+
+# Output columns written for each effect size type (effect, variance, SE, CI first)
+EFFECT_SIZE_COLUMNS = {
+    'lnRR': ['lnRR', 'var_lnRR', 'SE_lnRR', 'CI_lower_lnRR', 'CI_upper_lnRR',
+             'Response_Ratio', 'RR_CI_lower', 'RR_CI_upper', 'fold_change', 'Percent_Change'],
+    'hedges_g': ['hedges_g', 'Vg', 'SE_g', 'CI_lower_g', 'CI_upper_g', 'cohen_d'],
+    'cohen_d': ['cohen_d', 'Vd', 'SE_d', 'CI_lower_d', 'CI_upper_d'],
+    'log_or': ['log_OR', 'var_log_OR', 'SE_log_OR', 'CI_lower_log_OR', 'CI_upper_log_OR',
+               'Odds_Ratio', 'OR_CI_lower', 'OR_CI_upper'],
+}
+
+
+def impute_missing_sds(data_filtered):
+    """
+    Impute zero/missing SDs as median CV × mean (per group).
+
+    Adds 'cv_e', 'cv_c', 'sde_imputed', 'sdc_imputed', 'sde_was_imputed'
+    and 'sdc_was_imputed'; rows whose SD is still invalid are removed.
+
+    Returns:
+    --------
+    tuple : (data_filtered, imputation_log)
+    """
+    data_filtered = data_filtered.copy()
+
+    imputation_log = {
+        'method': 'median_cv',
+        'sde_zeros': (data_filtered['sde'] == 0).sum(),
+        'sdc_zeros': (data_filtered['sdc'] == 0).sum(),
+        'sde_missing': data_filtered['sde'].isna().sum(),
+        'sdc_missing': data_filtered['sdc'].isna().sum(),
+        'sde_imputed': 0,
+        'sdc_imputed': 0
+    }
+
+    # Replace zeros with NaN for proper imputation
+    data_filtered['sde'] = data_filtered['sde'].replace(0, np.nan)
+    data_filtered['sdc'] = data_filtered['sdc'].replace(0, np.nan)
+
+    # Coefficient of Variation (CV = SD/Mean), only for valid entries
+    data_filtered['cv_e'] = np.nan
+    data_filtered['cv_c'] = np.nan
+
+    valid_cv_e = (data_filtered['sde'] > 0) & (data_filtered['xe'] > 0)
+    valid_cv_c = (data_filtered['sdc'] > 0) & (data_filtered['xc'] > 0)
+
+    data_filtered.loc[valid_cv_e, 'cv_e'] = data_filtered.loc[valid_cv_e, 'sde'] / data_filtered.loc[valid_cv_e, 'xe']
+    data_filtered.loc[valid_cv_c, 'cv_c'] = data_filtered.loc[valid_cv_c, 'sdc'] / data_filtered.loc[valid_cv_c, 'xc']
+
+    # Use MEDIAN CV for robustness (less sensitive to outliers than mean)
+    median_cv_e = data_filtered['cv_e'].median()
+    median_cv_c = data_filtered['cv_c'].median()
+
+    imputation_log['median_cv_e'] = median_cv_e
+    imputation_log['median_cv_c'] = median_cv_c
+    imputation_log['mean_cv_e'] = data_filtered['cv_e'].mean()
+    imputation_log['mean_cv_c'] = data_filtered['cv_c'].mean()
+    imputation_log['n_valid_cv_e'] = valid_cv_e.sum()
+    imputation_log['n_valid_cv_c'] = valid_cv_c.sum()
+
+    data_filtered['sde_imputed'] = data_filtered['sde'].copy()
+    data_filtered['sdc_imputed'] = data_filtered['sdc'].copy()
+    data_filtered['sde_was_imputed'] = False
+    data_filtered['sdc_was_imputed'] = False
+
+    # Impute experimental group
+    impute_e = (data_filtered['sde_imputed'].isna()) & (data_filtered['xe'] > 0)
+    n_imputed_e = impute_e.sum()
+    if n_imputed_e > 0 and pd.notna(median_cv_e):
+        data_filtered.loc[impute_e, 'sde_imputed'] = median_cv_e * data_filtered.loc[impute_e, 'xe']
+        data_filtered.loc[impute_e, 'sde_was_imputed'] = True
+        imputation_log['sde_imputed'] = n_imputed_e
+
+    # Impute control group
+    impute_c = (data_filtered['sdc_imputed'].isna()) & (data_filtered['xc'] > 0)
+    n_imputed_c = impute_c.sum()
+    if n_imputed_c > 0 and pd.notna(median_cv_c):
+        data_filtered.loc[impute_c, 'sdc_imputed'] = median_cv_c * data_filtered.loc[impute_c, 'xc']
+        data_filtered.loc[impute_c, 'sdc_was_imputed'] = True
+        imputation_log['sdc_imputed'] = n_imputed_c
+
+    # Remove rows that still have invalid SDs
+    remaining_issues = ((data_filtered['sde_imputed'].isna()) | (data_filtered['sde_imputed'] <= 0) |
+                        (data_filtered['sdc_imputed'].isna()) | (data_filtered['sdc_imputed'] <= 0))
+    imputation_log['removed_after_imputation'] = remaining_issues.sum()
+    if remaining_issues.any():
+        data_filtered = data_filtered[~remaining_issues].copy()
+
+    return data_filtered, imputation_log
+
+
+def compute_effect_sizes(xe, sde, ne, xc, sdc, nc, types=None, z_crit=1.96):
+    """
+    Vectorized effect sizes for one or more types in a single pass.
+
+    Ratio measures (lnRR, log OR) use ZERO_CONSTANT for zero means and are
+    NaN where a mean is negative; the standardized measures share the
+    pooled SD.
+
+    Parameters:
+    -----------
+    xe, sde, ne, xc, sdc, nc : array-like
+        Means, (imputed) SDs and sample sizes of both groups
+    types : iterable of str or None
+        Effect size types to compute (default: all of ES_CONFIGS)
+    z_crit : float
+        Critical value for the CIs
+
+    Returns:
+    --------
+    dict : Column name -> ndarray for every column in EFFECT_SIZE_COLUMNS
+           of the requested types, plus the intermediates 'df', 'sp' and
+           'hedges_j' when a standardized measure was requested
+    """
+    types = list(ES_CONFIGS) if types is None else list(types)
+    unknown = [es_type for es_type in types if es_type not in ES_CONFIGS]
+    if unknown:
+        raise ValueError(f"Unknown effect size type(s): {unknown}")
+
+    xe = np.asarray(xe, dtype=np.float64)
+    xc = np.asarray(xc, dtype=np.float64)
+    sde = np.asarray(sde, dtype=np.float64)
+    sdc = np.asarray(sdc, dtype=np.float64)
+    ne = np.asarray(ne, dtype=np.float64)
+    nc = np.asarray(nc, dtype=np.float64)
+    out = {}
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # --- Ratio measures: lnRR and log OR share ln(xe/xc) and its delta-method variance ---
+        if 'lnRR' in types or 'log_or' in types:
+            invalid = (xe < 0) | (xc < 0)
+            xe_r = np.where(xe == 0, ZERO_CONSTANT, xe)
+            xc_r = np.where(xc == 0, ZERO_CONSTANT, xc)
+            log_ratio = np.log(xe_r / xc_r)
+            log_ratio[invalid] = np.nan
+            var_ratio = sde**2 / (ne * xe_r**2) + sdc**2 / (nc * xc_r**2)
+            var_ratio[invalid] = np.nan
+            se_ratio = np.sqrt(var_ratio)
+            ci_lower_ratio = log_ratio - z_crit * se_ratio
+            ci_upper_ratio = log_ratio + z_crit * se_ratio
+            ratio = np.exp(log_ratio)
+
+            if 'lnRR' in types:
+                out['lnRR'] = log_ratio
+                out['var_lnRR'] = var_ratio
+                out['SE_lnRR'] = se_ratio
+                out['CI_lower_lnRR'] = ci_lower_ratio
+                out['CI_upper_lnRR'] = ci_upper_ratio
+                out['Response_Ratio'] = ratio
+                out['RR_CI_lower'] = np.exp(ci_lower_ratio)
+                out['RR_CI_upper'] = np.exp(ci_upper_ratio)
+                # Fold-change with sign for direction
+                out['fold_change'] = np.where(log_ratio >= 0, ratio, -1.0 / ratio)
+                out['Percent_Change'] = (ratio - 1.0) * 100
+            if 'log_or' in types:
+                out['log_OR'] = log_ratio.copy()
+                out['var_log_OR'] = var_ratio.copy()
+                out['SE_log_OR'] = se_ratio.copy()
+                out['CI_lower_log_OR'] = ci_lower_ratio.copy()
+                out['CI_upper_log_OR'] = ci_upper_ratio.copy()
+                out['Odds_Ratio'] = ratio.copy()
+                out['OR_CI_lower'] = np.exp(ci_lower_ratio)
+                out['OR_CI_upper'] = np.exp(ci_upper_ratio)
+
+        # --- Standardized mean differences share the pooled SD ---
+        if 'hedges_g' in types or 'cohen_d' in types:
+            df = ne + nc - 2
+            sp = np.sqrt(((ne - 1) * sde**2 + (nc - 1) * sdc**2) / df)
+            cohen_d = (xe - xc) / sp
+            n_sum = ne + nc
+            n_term = n_sum / (ne * nc)
+            out['df'] = df
+            out['sp'] = sp
+            out['cohen_d'] = cohen_d
+
+            if 'cohen_d' in types:
+                Vd = n_term + cohen_d**2 / (2 * n_sum)
+                SE_d = np.sqrt(Vd)
+                out['Vd'] = Vd
+                out['SE_d'] = SE_d
+                out['CI_lower_d'] = cohen_d - z_crit * SE_d
+                out['CI_upper_d'] = cohen_d + z_crit * SE_d
+            if 'hedges_g' in types:
+                # Small-sample correction J ≈ 1 - 3/(4*df - 1)
+                hedges_j = 1 - 3 / (4 * df - 1)
+                hedges_g = cohen_d * hedges_j
+                Vg = (n_term + hedges_g**2 / (2 * n_sum)) * hedges_j**2
+                SE_g = np.sqrt(Vg)
+                out['hedges_j'] = hedges_j
+                out['hedges_g'] = hedges_g
+                out['Vg'] = Vg
+                out['SE_g'] = SE_g
+                out['CI_lower_g'] = hedges_g - z_crit * SE_g
+                out['CI_upper_g'] = hedges_g + z_crit * SE_g
+
+    return out
+
+
+def effect_size_table(data_filtered, types=None, impute=True):
+    """
+    All requested effect size types side by side, for sensitivity runs.
+
+    Parameters:
+    -----------
+    data_filtered : DataFrame
+        Cleaned data with 'id', 'xe', 'sde', 'ne', 'xc', 'sdc', 'nc'
+    types : iterable of str or None
+        Effect size types (default: all of ES_CONFIGS)
+    impute : bool
+        Impute missing/zero SDs first (impute_missing_sds); otherwise
+        'sde' and 'sdc' are used as they are
+
+    Returns:
+    --------
+    DataFrame : 'id' plus the EFFECT_SIZE_COLUMNS of every type, aligned
+                with the (imputed) input rows; invalid rows hold NaN
+    """
+    types = list(ES_CONFIGS) if types is None else list(types)
+    if impute:
+        data_filtered, _ = impute_missing_sds(data_filtered)
+        sde, sdc = data_filtered['sde_imputed'], data_filtered['sdc_imputed']
+    else:
+        sde, sdc = data_filtered['sde'], data_filtered['sdc']
+
+    arrays = compute_effect_sizes(data_filtered['xe'], sde, data_filtered['ne'],
+                                  data_filtered['xc'], sdc, data_filtered['nc'], types=types)
+    columns = {'id': data_filtered['id'].values}
+    for es_type in types:
+        for col in EFFECT_SIZE_COLUMNS[es_type]:
+            columns.setdefault(col, arrays[col])
+    return pd.DataFrame(columns, index=data_filtered.index)
+
+
+def calculate_effect_sizes(data_filtered, effect_size_type):
+    """
+    Calculate effect sizes, variances, SEs, CIs and fixed-effects weights.
+
+    Parameters:
+    -----------
+    data_filtered : DataFrame
+        Cleaned data with 'id', 'xe', 'sde', 'ne', 'xc', 'sdc', 'nc'
+    effect_size_type : str
+        'lnRR', 'hedges_g', 'cohen_d' or 'log_or'
+
+    Returns:
+    --------
+    tuple : (data_filtered, calculation_log); the columns named in
+            ES_CONFIGS[effect_size_type] plus 'w_fixed' are added
+    """
+    if effect_size_type not in ES_CONFIGS:
+        raise ValueError(f"Unknown effect size type: {effect_size_type}")
+
+    data_filtered, imputation_log = impute_missing_sds(data_filtered)
+
+    # Ratio measures need strictly positive means
+    if effect_size_type in ['lnRR', 'log_or']:
+        negative_mask = (data_filtered['xe'] < 0) | (data_filtered['xc'] < 0)
+        if negative_mask.any():
+            data_filtered = data_filtered[~negative_mask].copy()
+        data_filtered.loc[data_filtered['xe'] == 0, 'xe'] = ZERO_CONSTANT
+        data_filtered.loc[data_filtered['xc'] == 0, 'xc'] = ZERO_CONSTANT
+
+    calculation_log = {
+        'type': effect_size_type,
+        'n_observations': len(data_filtered),
+        'imputation': imputation_log
+    }
+
+    arrays = compute_effect_sizes(
+        data_filtered['xe'], data_filtered['sde_imputed'], data_filtered['ne'],
+        data_filtered['xc'], data_filtered['sdc_imputed'], data_filtered['nc'],
+        types=[effect_size_type]
+    )
+    columns_created = EFFECT_SIZE_COLUMNS[effect_size_type]
+    # Assign all new columns at once instead of one column at a time
+    data_filtered = data_filtered.drop(columns=[col for col in columns_created if col in data_filtered.columns])
+    data_filtered = pd.concat(
+        [data_filtered, pd.DataFrame({col: arrays[col] for col in columns_created}, index=data_filtered.index)],
+        axis=1
+    )
+    calculation_log['columns_created'] = list(columns_created)
+
+    es_config = ES_CONFIGS[effect_size_type]
+    effect_col, var_col, se_col = es_config['effect_col'], es_config['var_col'], es_config['se_col']
+
+    # Fixed-effects weights; infinite weights (variance = 0) become NaN
+    data_filtered['w_fixed'] = 1 / data_filtered[var_col]
+    data_filtered['w_fixed'] = data_filtered['w_fixed'].replace([np.inf, -np.inf], np.nan)
+
+    # Remove rows with NaN in critical columns
+    initial_n = len(data_filtered)
+    data_filtered = data_filtered.dropna(subset=[effect_col, var_col, se_col, 'w_fixed']).copy()
+
+    calculation_log['effect_col'] = effect_col
+    calculation_log['var_col'] = var_col
+    calculation_log['se_col'] = se_col
+    calculation_log['final_n'] = len(data_filtered)
+    calculation_log['removed_in_cleaning'] = initial_n - len(data_filtered)
+
+    return data_filtered, calculation_log
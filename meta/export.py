@@ -0,0 +1,404 @@
+"""
+Background figure export with a content-addressed cache.
+
+A figure is identified by the SHA-256 of its pickled state together with
+the export settings (format, dpi, ...). Rendered files are stored in the
+cache under that hash, so exporting an unchanged figure again, even under
+a new file name, is a file copy instead of a re-render. Rendering runs in
+a process pool and the submit_* functions return a Future immediately, so
+a notebook kernel is not blocked by 600 dpi PNGs.
+
+export_bundle() writes every figure of a run at once: one multi-page PDF
+(one page per figure) plus a zip of the PNGs.
+
+Usage:
+    future = submit_figure(fig, 'out/funnel_RE', formats=('pdf', 'png'), dpi=300)
+    future.result()['files']
+    bundle = export_bundle({'funnel': fig1, 'loo': fig2}, 'out/all_figures')
+"""
+
+import hashlib
+import io
+import os
+import pickle
+import shutil
+import tempfile
+import warnings
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.cbook import CallbackRegistry
+from matplotlib.figure import Figure
+from matplotlib.path import Path
+from matplotlib.transforms import TransformNode
+
+__all__ = [
+    'DEFAULT_FIGURE_CACHE_DIR',
+    'figure_digest',
+    'export_figure',
+    'submit_figure',
+    'export_bundle',
+    'submit_bundle',
+    'shutdown_export_pool',
+]
+
+DEFAULT_FIGURE_CACHE_DIR = os.environ.get(
+    'META_FIGURE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'meta', 'figures')
+)
+
+# Bump when the rendering path changes so stale cache entries are not reused
+_CACHE_VERSION = 1
+
+
+# --- 1. FIGURE HASHING ---
+
+class _CanonicalPickler(pickle.Pickler):
+    """
+    Pickler whose output depends only on what a figure draws.
+
+    A plain pickle of the same figure differs between calls and processes:
+    callback registries pickle a running counter, transforms key their
+    parents by id() and figures carry their pyplot number. Shared unit
+    paths (every Rectangle uses one) also get their interpolation steps
+    overwritten by axvspan() in unrelated figures. Those parts are dropped
+    here; the stream is only hashed, never loaded.
+    """
+
+    def reducer_override(self, obj):
+        if isinstance(obj, CallbackRegistry):
+            return (CallbackRegistry, ())
+        if isinstance(obj, Figure):
+            state = {key: value for key, value in obj.__getstate__().items()
+                     if key not in ('_number', '_restore_to_pylab')}
+            return (Figure, (), state)
+        if isinstance(obj, Path):
+            state = {key: value for key, value in obj.__dict__.items()
+                     if key != '_interpolation_steps'}
+            return (Path, (obj.vertices,), state)
+        if isinstance(obj, TransformNode):
+            state = {key: value for key, value in obj.__getstate__().items()
+                     if key != '_parents'}
+            return (type(obj), (), state)
+        return NotImplemented
+
+
+def figure_digest(fig):
+    """
+    SHA-256 of a figure's drawable state (None if the figure cannot be pickled,
+    e.g. because a formatter holds a lambda).
+    """
+    buffer = io.BytesIO()
+    try:
+        _CanonicalPickler(buffer, protocol=4).dump(fig)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+    return hashlib.sha256(buffer.getvalue()).hexdigest()
+
+
+def _export_key(digest, ext, savefig_kwargs):
+    payload = repr((_CACHE_VERSION, matplotlib.__version__, digest, ext,
+                    sorted(savefig_kwargs.items())))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# --- 2. RENDERING ---
+
+def _copy_file(source, destination):
+    if os.path.abspath(source) == os.path.abspath(destination):
+        return
+    directory = os.path.dirname(destination)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    shutil.copyfile(source, destination)
+
+
+def _write_atomic(path, write):
+    # Write to a temporary file and rename so readers never see a partial file
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _render_figure(fig, targets, savefig_kwargs, digest=None):
+    """
+    Save fig once per (ext, cache_path, destination) target. Targets with a
+    cache path are rendered into the cache (if missing) and copied out;
+    targets without one are rendered straight to the destination.
+    """
+    result = {'files': [], 'rendered': [], 'cached': [], 'hash': digest}
+    for ext, cache_path, destination in targets:
+        if cache_path is not None and os.path.exists(cache_path):
+            result['cached'].append(ext)
+        elif cache_path is not None:
+            try:
+                _write_atomic(cache_path, lambda path: fig.savefig(path, format=ext,
+                                                                   **savefig_kwargs))
+            except OSError:
+                # A read-only or full cache directory must not break exporting
+                cache_path = None
+            result['rendered'].append(ext)
+        else:
+            result['rendered'].append(ext)
+
+        if cache_path is None:
+            fig.savefig(destination, format=ext, **savefig_kwargs)
+        else:
+            _copy_file(cache_path, destination)
+        result['files'].append(destination)
+    return result
+
+
+def _init_export_worker():
+    matplotlib.use('Agg')
+
+
+def _export_worker(payload, targets, savefig_kwargs, digest=None):
+    fig = pickle.loads(payload)
+    try:
+        return _render_figure(fig, targets, savefig_kwargs, digest)
+    finally:
+        plt.close(fig)
+
+
+def _bundle_pdf_worker(payloads, cache_path, savefig_kwargs):
+    figures = [pickle.loads(payload) for payload in payloads]
+
+    def write(path):
+        with PdfPages(path) as pdf:
+            for fig in figures:
+                pdf.savefig(fig, **savefig_kwargs)
+
+    try:
+        _write_atomic(cache_path, write)
+    finally:
+        for fig in figures:
+            plt.close(fig)
+    return cache_path
+
+
+# --- 3. WORKER POOL ---
+
+_EXPORT_POOL = {'pool': None, 'n_jobs': 0}
+_BUNDLE_THREAD = ThreadPoolExecutor(max_workers=1, thread_name_prefix='meta-bundle')
+
+
+def _export_pool(n_jobs):
+    """Shared process pool, created on first use and kept for later exports."""
+    if _EXPORT_POOL['pool'] is None or _EXPORT_POOL['n_jobs'] != n_jobs:
+        shutdown_export_pool(wait=False)
+        _EXPORT_POOL['pool'] = ProcessPoolExecutor(max_workers=n_jobs,
+                                                   initializer=_init_export_worker)
+        _EXPORT_POOL['n_jobs'] = n_jobs
+    return _EXPORT_POOL['pool']
+
+
+def _submit(n_jobs, function, *args):
+    """Submit to the export pool; run in-process if no pool can be started."""
+    try:
+        return _export_pool(n_jobs).submit(function, *args)
+    except (OSError, RuntimeError) as e:
+        warnings.warn(f"Process pool unavailable ({e}), running sequentially")
+        shutdown_export_pool(wait=False)
+    future = Future()
+    try:
+        future.set_result(function(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def shutdown_export_pool(wait=True):
+    """Stop the background export workers (a new pool starts on the next export)."""
+    pool = _EXPORT_POOL['pool']
+    _EXPORT_POOL['pool'], _EXPORT_POOL['n_jobs'] = None, 0
+    if pool is not None:
+        pool.shutdown(wait=wait)
+
+
+# --- 4. SINGLE FIGURES ---
+
+def _cache_path(cache_dir, digest, ext, savefig_kwargs):
+    if digest is None:
+        return None
+    return os.path.join(cache_dir, f"{_export_key(digest, ext, savefig_kwargs)}.{ext}")
+
+
+def _pickle_figure(fig):
+    try:
+        return pickle.dumps(fig)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+
+
+def export_figure(fig, base_filename, formats=('pdf', 'png'), dpi=300, transparent=False,
+                  bbox_inches='tight', cache_dir=None):
+    """
+    Save a figure as base_filename.<ext> for every format, reusing cached
+    renders of an identical figure. Blocks until the files are written.
+
+    Returns:
+    --------
+    dict : 'files' (paths written), 'rendered' / 'cached' (formats by source),
+           'hash' (figure digest, None if the figure could not be hashed)
+    """
+    cache_dir = cache_dir or DEFAULT_FIGURE_CACHE_DIR
+    savefig_kwargs = {'dpi': dpi, 'transparent': transparent, 'bbox_inches': bbox_inches}
+    digest = figure_digest(fig)
+    targets = [(ext, _cache_path(cache_dir, digest, ext, savefig_kwargs), f"{base_filename}.{ext}")
+               for ext in formats]
+    return _render_figure(fig, targets, savefig_kwargs, digest)
+
+
+def submit_figure(fig, base_filename, formats=('pdf', 'png'), dpi=300, transparent=False,
+                  bbox_inches='tight', cache_dir=None, n_jobs=2):
+    """
+    Background version of export_figure().
+
+    The figure is hashed and pickled before returning, so it can be shown,
+    changed or closed right away. Cache hits are copied immediately and
+    return a finished Future; misses are rendered in the export pool.
+
+    Returns:
+    --------
+    Future : resolves to the export_figure() dict
+    """
+    cache_dir = cache_dir or DEFAULT_FIGURE_CACHE_DIR
+    savefig_kwargs = {'dpi': dpi, 'transparent': transparent, 'bbox_inches': bbox_inches}
+    digest = figure_digest(fig)
+    targets = [(ext, _cache_path(cache_dir, digest, ext, savefig_kwargs), f"{base_filename}.{ext}")
+               for ext in formats]
+
+    if any(cache_path is None or not os.path.exists(cache_path)
+           for _, cache_path, _ in targets):
+        payload = _pickle_figure(fig)
+        if payload is not None:
+            return _submit(n_jobs, _export_worker, payload, targets, savefig_kwargs, digest)
+
+    # Everything cached (or the figure cannot be pickled): finish in-process
+    future = Future()
+    future.set_result(_render_figure(fig, targets, savefig_kwargs, digest))
+    return future
+
+
+# --- 5. BUNDLES ---
+
+def _snapshot_figures(figures):
+    """Digest and pickle every figure: {name: (digest, payload)} in page order."""
+    snapshot = {}
+    for name, fig in figures.items():
+        payload = _pickle_figure(fig)
+        if payload is None:
+            raise TypeError(f"Figure '{name}' cannot be pickled for export")
+        snapshot[name] = (figure_digest(fig), payload)
+    return snapshot
+
+
+def _export_snapshot(snapshot, base_filename, formats, savefig_kwargs, cache_dir, n_jobs):
+    cache_dir = cache_dir or DEFAULT_FIGURE_CACHE_DIR
+    names = list(snapshot)
+    summary = {'files': [], 'rendered': 0, 'cached': 0}
+    pending = []
+    scratch_dir = None
+
+    if 'pdf' in formats:
+        pdf_path = f"{base_filename}.pdf"
+        digests = tuple((name, snapshot[name][0]) for name in names)
+        pdf_cache = (None if any(digest is None for _, digest in digests) else
+                     _cache_path(cache_dir, _export_key(digests, 'bundle', {}), 'pdf',
+                                 savefig_kwargs))
+        if pdf_cache is not None and os.path.exists(pdf_cache):
+            summary['cached'] += 1
+        else:
+            summary['rendered'] += 1
+            pending.append(_submit(n_jobs, _bundle_pdf_worker,
+                                   [snapshot[name][1] for name in names],
+                                   pdf_cache or pdf_path, savefig_kwargs))
+
+    raster_files = {}
+    for ext in formats:
+        if ext == 'pdf':
+            continue
+        for name in names:
+            digest, payload = snapshot[name]
+            cache_path = _cache_path(cache_dir, digest, ext, savefig_kwargs)
+            if cache_path is None:
+                scratch_dir = scratch_dir or tempfile.mkdtemp(prefix='meta_bundle_')
+                cache_path = os.path.join(scratch_dir, f"{name}.{ext}")
+            raster_files[(ext, name)] = cache_path
+            if os.path.exists(cache_path):
+                summary['cached'] += 1
+            else:
+                summary['rendered'] += 1
+                pending.append(_submit(n_jobs, _export_worker, payload,
+                                       [(ext, cache_path, cache_path)], savefig_kwargs))
+
+    for future in pending:
+        future.result()
+
+    if 'pdf' in formats:
+        if pdf_cache is not None:
+            _copy_file(pdf_cache, pdf_path)
+        summary['files'].append(pdf_path)
+    for ext in formats:
+        if ext == 'pdf':
+            continue
+        zip_path = f"{base_filename}_{ext}.zip"
+        # Rasters are already compressed; storing them keeps zipping instant
+        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for name in names:
+                archive.write(raster_files[(ext, name)], f"{name}.{ext}")
+        summary['files'].append(zip_path)
+
+    if scratch_dir is not None:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return summary
+
+
+def export_bundle(figures, base_filename, formats=('pdf', 'png'), dpi=300, transparent=False,
+                  bbox_inches='tight', cache_dir=None, n_jobs=2):
+    """
+    Export every figure of a run as one bundle.
+
+    'pdf' becomes a single multi-page base_filename.pdf (one page per figure,
+    in the order of figures); every other format becomes
+    base_filename_<ext>.zip with one <name>.<ext> per figure. The rasters
+    and the whole PDF are cached by content, so re-exporting after changing
+    one figure only renders that figure's rasters and the PDF.
+
+    Parameters:
+    -----------
+    figures : dict
+        {name: matplotlib Figure}, in page order
+
+    Returns:
+    --------
+    dict : 'files' (bundle paths), 'rendered' / 'cached' (number of renders by source)
+    """
+    savefig_kwargs = {'dpi': dpi, 'transparent': transparent, 'bbox_inches': bbox_inches}
+    return _export_snapshot(_snapshot_figures(figures), base_filename, formats,
+                            savefig_kwargs, cache_dir, n_jobs)
+
+
+def submit_bundle(figures, base_filename, formats=('pdf', 'png'), dpi=300, transparent=False,
+                  bbox_inches='tight', cache_dir=None, n_jobs=2):
+    """
+    Background version of export_bundle(). The figures are hashed and
+    pickled before returning, so later changes do not leak into the bundle.
+
+    Returns:
+    --------
+    Future : resolves to the export_bundle() dict
+    """
+    savefig_kwargs = {'dpi': dpi, 'transparent': transparent, 'bbox_inches': bbox_inches}
+    return _BUNDLE_THREAD.submit(_export_snapshot, _snapshot_figures(figures), base_filename,
+                                 formats, savefig_kwargs, cache_dir, n_jobs)
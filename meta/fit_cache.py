@@ -0,0 +1,350 @@
+"""
+Memoized model fits.
+
+The notebook cells and the pipeline refit the same models over and over
+(the funnel cell refits the three-level Egger regression on every colour
+change, re-running the subgroup cell refits every group). Fitting
+functions decorated with @cached_fit look their result up first, keyed
+on:
+
+    - the model (function) name and the package version,
+    - a fingerprint of the input data: for a DataFrame, the values and
+      index of the columns the call refers to (effect, variance,
+      moderators, cluster...) plus 'id', or of every column for fits
+      whose result contains the input frame (whole_frame=True); arrays
+      are hashed whole,
+    - every other argument (estimator, options), after applying defaults.
+
+Results are stored pickled, so every hit returns an independent copy.
+The in-memory tier is an LRU bounded by entry count and bytes; an
+optional disk tier (disk_dir, or the META_FIT_CACHE_DIR environment
+variable) persists fits across sessions and evicts least recently used
+files beyond disk_max_bytes.
+
+Calls that are not reproducible (seed=None, or an argument without a
+stable value such as a Generator) and arguments that do not change the
+result (n_jobs, verbose) are handled automatically: the former bypass the
+cache, the latter are left out of the key.
+
+Usage:
+    configure_fit_cache(max_entries=128, disk_dir='~/.cache/meta/fits')
+    fit_cache_info()        # hits, misses, entries, bytes
+    clear_fit_cache(disk=True)
+"""
+
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    'cached_fit',
+    'data_fingerprint',
+    'configure_fit_cache',
+    'clear_fit_cache',
+    'fit_cache_info',
+]
+
+# Bump when a cached function's results change so stale entries are not reused
+_CACHE_VERSION = 1
+
+# Arguments that never change a fit's result
+_IGNORED_ARGS = frozenset({'n_jobs', 'verbose'})
+
+_FIT_CACHE = {
+    'enabled': os.environ.get('META_FIT_CACHE', '1') != '0',
+    'max_entries': 256,
+    'max_bytes': 256 * 2**20,
+    'disk_dir': os.environ.get('META_FIT_CACHE_DIR') or None,
+    'disk_max_bytes': 2**30,
+    'entries': OrderedDict(),
+    'bytes': 0,
+    'hits': 0,
+    'disk_hits': 0,
+    'misses': 0,
+    'bypassed': 0,
+}
+# The pipeline runs independent stages on threads
+_FIT_CACHE_LOCK = threading.RLock()
+
+
+class _Uncacheable(Exception):
+    """Raised while building a key for a call whose result is not reproducible."""
+
+
+# --- 1. KEYS ---
+
+def data_fingerprint(data, columns=None):
+    """
+    SHA-256 of a DataFrame's index and the given columns (all if None),
+    or of an array / Series.
+    """
+    digest = hashlib.sha256()
+    if isinstance(data, pd.DataFrame):
+        columns = list(data.columns) if columns is None else [c for c in columns if c in data.columns]
+        digest.update(repr([(str(c), str(data[c].dtype)) for c in columns]).encode('utf-8'))
+        digest.update(pd.util.hash_pandas_object(data[columns], index=True).values.tobytes())
+    elif isinstance(data, pd.Series):
+        digest.update(str(data.dtype).encode('utf-8'))
+        digest.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+    else:
+        array = np.asarray(data)
+        digest.update(repr((array.dtype.str, array.shape)).encode('utf-8'))
+        if array.dtype == object:
+            digest.update(pd.util.hash_array(array.ravel()).tobytes())
+        else:
+            digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def _column_names(value):
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return [item for item in value if isinstance(item, str)]
+    return []
+
+
+def _argument_token(value):
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return data_fingerprint(value)
+    if isinstance(value, dict):
+        return repr(sorted((repr(k), _argument_token(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return repr([_argument_token(item) for item in value])
+    token = repr(value)
+    if ' at 0x' in token:
+        raise _Uncacheable(token)
+    return token
+
+
+def _fit_key(model, func, signature, columns, args, kwargs, whole_frame=False):
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = dict(bound.arguments)
+    for name, parameter in signature.parameters.items():
+        if parameter.kind is inspect.Parameter.VAR_KEYWORD:
+            arguments.update(arguments.pop(name))
+    if 'seed' in arguments and arguments['seed'] is None:
+        raise _Uncacheable('seed=None')
+
+    # DataFrames are fingerprinted on the columns the call names
+    referenced = set(columns)
+    for value in arguments.values():
+        referenced.update(_column_names(value))
+
+    parts = [_CACHE_VERSION, model, f"{func.__module__}.{func.__qualname__}"]
+    for name in sorted(arguments):
+        if name in _IGNORED_ARGS:
+            continue
+        value = arguments[name]
+        if isinstance(value, pd.DataFrame):
+            token = data_fingerprint(value, None if whole_frame else
+                                     sorted(c for c in referenced if c in value.columns))
+        else:
+            token = _argument_token(value)
+        parts.append((name, token))
+    from . import __version__
+    parts.append(__version__)
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+# --- 2. STORAGE ---
+
+def _memory_put(key, payload):
+    with _FIT_CACHE_LOCK:
+        entries = _FIT_CACHE['entries']
+        if key in entries:
+            _FIT_CACHE['bytes'] -= len(entries.pop(key))
+        if len(payload) > _FIT_CACHE['max_bytes']:
+            return
+        entries[key] = payload
+        _FIT_CACHE['bytes'] += len(payload)
+        _evict_memory()
+
+
+def _evict_memory():
+    with _FIT_CACHE_LOCK:
+        entries = _FIT_CACHE['entries']
+        while entries and (len(entries) > _FIT_CACHE['max_entries']
+                           or _FIT_CACHE['bytes'] > _FIT_CACHE['max_bytes']):
+            _, payload = entries.popitem(last=False)
+            _FIT_CACHE['bytes'] -= len(payload)
+
+
+def _disk_path(key):
+    return os.path.join(os.path.expanduser(_FIT_CACHE['disk_dir']), f'{key}.fit.pkl')
+
+
+def _disk_get(key):
+    if not _FIT_CACHE['disk_dir']:
+        return None
+    path = _disk_path(key)
+    try:
+        with open(path, 'rb') as f:
+            payload = f.read()
+        # Touch so eviction sees this entry as recently used
+        os.utime(path)
+        return payload
+    except OSError:
+        return None
+
+
+def _disk_put(key, payload):
+    if not _FIT_CACHE['disk_dir']:
+        return
+    directory = os.path.expanduser(_FIT_CACHE['disk_dir'])
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file and rename so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, _disk_path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        _evict_disk(directory)
+    except OSError:
+        # A read-only or full cache directory must not break fitting
+        pass
+
+
+def _disk_entries(directory):
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.fit.pkl'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+
+def _evict_disk(directory):
+    entries = _disk_entries(directory)
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= _FIT_CACHE['disk_max_bytes']:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+# --- 3. DECORATOR ---
+
+def cached_fit(model, columns=('id',), whole_frame=False):
+    """
+    Decorator memoizing a fitting function.
+
+    Parameters:
+    -----------
+    model : str
+        Model type recorded in the key (e.g. 'three_level', 'egger')
+    columns : tuple
+        DataFrame columns the function reads without naming them in its
+        arguments; always part of the data fingerprint when present
+    whole_frame : bool
+        Fingerprint every column of DataFrame arguments. Needed when the
+        result holds (a copy of) the input frame, which would otherwise
+        be returned stale after an unreferenced column changes
+
+    The undecorated function stays available as func.uncached.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _FIT_CACHE['enabled']:
+                return func(*args, **kwargs)
+            try:
+                key = _fit_key(model, func, signature, columns, args, kwargs, whole_frame)
+            except _Uncacheable:
+                _FIT_CACHE['bypassed'] += 1
+                return func(*args, **kwargs)
+
+            with _FIT_CACHE_LOCK:
+                payload = _FIT_CACHE['entries'].get(key)
+                if payload is not None:
+                    _FIT_CACHE['entries'].move_to_end(key)
+                    _FIT_CACHE['hits'] += 1
+            if payload is not None:
+                return pickle.loads(payload)
+            payload = _disk_get(key)
+            if payload is not None:
+                _memory_put(key, payload)
+                _FIT_CACHE['disk_hits'] += 1
+                return pickle.loads(payload)
+
+            _FIT_CACHE['misses'] += 1
+            result = func(*args, **kwargs)
+            try:
+                payload = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                return result
+            _memory_put(key, payload)
+            _disk_put(key, payload)
+            return result
+
+        wrapper.uncached = func
+        return wrapper
+    return decorator
+
+
+# --- 4. CONFIGURATION ---
+
+def configure_fit_cache(enabled=None, max_entries=None, max_bytes=None, disk_dir=None,
+                        disk_max_bytes=None):
+    """
+    Change cache limits; None leaves a setting unchanged. disk_dir=False
+    turns the disk tier off. Shrinking a limit evicts immediately.
+    """
+    if enabled is not None:
+        _FIT_CACHE['enabled'] = bool(enabled)
+    if max_entries is not None:
+        _FIT_CACHE['max_entries'] = int(max_entries)
+    if max_bytes is not None:
+        _FIT_CACHE['max_bytes'] = int(max_bytes)
+    if disk_dir is not None:
+        _FIT_CACHE['disk_dir'] = disk_dir or None
+    if disk_max_bytes is not None:
+        _FIT_CACHE['disk_max_bytes'] = int(disk_max_bytes)
+    _evict_memory()
+    if _FIT_CACHE['disk_dir'] and os.path.isdir(os.path.expanduser(_FIT_CACHE['disk_dir'])):
+        _evict_disk(os.path.expanduser(_FIT_CACHE['disk_dir']))
+
+
+def clear_fit_cache(disk=False):
+    """Drop every in-memory fit (and the disk tier's files if disk=True)."""
+    with _FIT_CACHE_LOCK:
+        _FIT_CACHE['entries'].clear()
+        _FIT_CACHE['bytes'] = 0
+    if disk and _FIT_CACHE['disk_dir']:
+        directory = os.path.expanduser(_FIT_CACHE['disk_dir'])
+        if os.path.isdir(directory):
+            for _, _, path in _disk_entries(directory):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def fit_cache_info():
+    """Current limits, usage and hit / miss counters."""
+    info = {key: value for key, value in _FIT_CACHE.items() if key != 'entries'}
+    info['entries'] = len(_FIT_CACHE['entries'])
+    if _FIT_CACHE['disk_dir'] and os.path.isdir(os.path.expanduser(_FIT_CACHE['disk_dir'])):
+        disk_entries = _disk_entries(os.path.expanduser(_FIT_CACHE['disk_dir']))
+        info['disk_entries'] = len(disk_entries)
+        info['disk_bytes'] = sum(size for _, size, _ in disk_entries)
+    return info
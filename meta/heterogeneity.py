@@ -0,0 +1,1048 @@
+"""
+Heterogeneity (tau-squared) estimators for random-effects meta-analysis.
+
+Estimators: DerSimonian-Laird (DL), REML, ML, Paule-Mandel (PM) and
+Sidik-Jonkman (SJ), plus the Knapp-Hartung adjusted confidence interval
+for the random-effects pooled estimate.
+
+fit_tau_squared() is the scoring (REML/ML) / Newton (PM) core behind
+the iterative estimators and q_profile_ci() gives the Q-profile confidence
+interval for tau² and I².
+
+tau_squared_batch() computes all five estimators together from one set of
+validated arrays, optionally for every group of a grouping key at once.
+
+Usage:
+    tau_sq, info = calculate_tau_squared(df, 'effect_size', 'variance', method='REML')
+    comparison = compare_tau_estimators(df, 'effect_size', 'variance')
+    by_group = calculate_tau_squared_all(df, 'effect_size', 'variance', group_col='crop')
+"""
+
+import warnings
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from scipy.stats import t, chi2
+
+from .perf import timed_likelihood
+
+__all__ = [
+    'calculate_tau_squared_DL',
+    'calculate_tau_squared_REML',
+    'calculate_tau_squared_ML',
+    'calculate_tau_squared_PM',
+    'calculate_tau_squared_SJ',
+    'calculate_tau_squared',
+    'TAU_METHODS',
+    'tau_squared_batch',
+    'calculate_tau_squared_all',
+    'compare_tau_estimators',
+    'calculate_knapp_hartung_ci',
+    'fit_tau_squared',
+    'q_profile_ci',
+]
+
+
+# --- 1. DERSIMONIAN-LAIRD ---
+
+def calculate_tau_squared_DL(df, effect_col, var_col):
+    """
+    DerSimonian-Laird estimator for tau-squared
+
+    Advantages:
+    - Simple, fast
+    - Non-iterative
+    - Always converges
+
+    Disadvantages:
+    - Can underestimate tau² in small samples
+    - Negative values truncated to 0
+    - Less efficient than ML methods
+
+    Parameters:
+    -----------
+    df : DataFrame
+        Data with effect sizes and variances
+    effect_col : str
+        Name of effect size column
+    var_col : str
+        Name of variance column
+
+    Returns:
+    --------
+    float : tau-squared estimate
+    """
+    k = len(df)
+    if k < 2:
+        return 0.0
+
+    try:
+        # Fixed-effects weights
+        w = 1 / df[var_col]
+        sum_w = w.sum()
+
+        if sum_w <= 0:
+            return 0.0
+
+        # Fixed-effects pooled estimate
+        pooled_effect = (w * df[effect_col]).sum() / sum_w
+
+        # Q statistic
+        Q = (w * (df[effect_col] - pooled_effect)**2).sum()
+        df_Q = k - 1
+
+        # C constant
+        sum_w_sq = (w**2).sum()
+        C = sum_w - (sum_w_sq / sum_w)
+
+        # Tau-squared
+        if C > 0 and Q > df_Q:
+            tau_sq = (Q - df_Q) / C
+        else:
+            tau_sq = 0.0
+
+        return max(0.0, tau_sq)
+
+    except Exception as e:
+        warnings.warn(f"Error in DL estimator: {e}")
+        return 0.0
+
+
+# --- 2. RESTRICTED MAXIMUM LIKELIHOOD (REML) ---
+
+def calculate_tau_squared_REML(df, effect_col, var_col, max_iter=100, tol=1e-10, return_diagnostics=False):
+    """
+    REML estimator for tau-squared (RECOMMENDED - Gold Standard)
+
+    Advantages:
+    - Unbiased for tau²
+    - Accounts for uncertainty in estimating mu
+    - Better performance in small samples
+    - Generally preferred in literature
+
+    Disadvantages:
+    - Iterative (scoring with step halving, usually 3-6 iterations)
+
+    Reference:
+    Viechtbauer, W. (2005). Bias and efficiency of meta-analytic variance
+    estimators in the random-effects model. Journal of Educational and
+    Behavioral Statistics, 30(3), 261-293.
+
+    Parameters:
+    -----------
+    df : DataFrame
+        Data with effect sizes and variances
+    effect_col : str
+        Name of effect size column
+    var_col : str
+        Name of variance column
+    max_iter : int
+        Maximum iterations for optimization
+    tol : float
+        Convergence tolerance
+    return_diagnostics : bool
+        Also return the iteration diagnostics of fit_tau_squared()
+
+    Returns:
+    --------
+    float : tau-squared estimate (and dict of diagnostics if requested)
+    """
+    try:
+        tau_sq, diagnostics = fit_tau_squared(df[effect_col].values, df[var_col].values,
+                                              method='REML', max_iter=max_iter, tol=tol)
+        if not diagnostics['converged']:
+            warnings.warn(f"REML did not converge in {diagnostics['iterations']} iterations "
+                          f"(last step {diagnostics['last_step']:.2e})")
+    except Exception as e:
+        warnings.warn(f"Error in REML estimator: {e}, using DL fallback")
+        tau_sq = calculate_tau_squared_DL(df, effect_col, var_col)
+        diagnostics = {'method': 'DL', 'converged': False, 'fallback': True, 'error': str(e)}
+
+    return (tau_sq, diagnostics) if return_diagnostics else tau_sq
+
+
+# --- 3. MAXIMUM LIKELIHOOD (ML) ---
+
+def calculate_tau_squared_ML(df, effect_col, var_col, max_iter=100, tol=1e-10, return_diagnostics=False):
+    """
+    Maximum Likelihood estimator for tau-squared
+
+    Advantages:
+    - Efficient asymptotically
+    - Produces valid estimates
+
+    Disadvantages:
+    - Biased downward (underestimates tau²)
+    - Less preferred than REML
+    - REML is generally recommended instead
+
+    Parameters:
+    -----------
+    df : DataFrame
+        Data with effect sizes and variances
+    effect_col : str
+        Name of effect size column
+    var_col : str
+        Name of variance column
+    max_iter : int
+        Maximum iterations
+    tol : float
+        Convergence tolerance
+    return_diagnostics : bool
+        Also return the iteration diagnostics of fit_tau_squared()
+
+    Returns:
+    --------
+    float : tau-squared estimate (and dict of diagnostics if requested)
+    """
+    try:
+        tau_sq, diagnostics = fit_tau_squared(df[effect_col].values, df[var_col].values,
+                                              method='ML', max_iter=max_iter, tol=tol)
+        if not diagnostics['converged']:
+            warnings.warn(f"ML did not converge in {diagnostics['iterations']} iterations "
+                          f"(last step {diagnostics['last_step']:.2e})")
+    except Exception as e:
+        warnings.warn(f"Error in ML estimator: {e}, using DL fallback")
+        tau_sq = calculate_tau_squared_DL(df, effect_col, var_col)
+        diagnostics = {'method': 'DL', 'converged': False, 'fallback': True, 'error': str(e)}
+
+    return (tau_sq, diagnostics) if return_diagnostics else tau_sq
+
+
+# --- 4. PAULE-MANDEL (PM) ---
+
+def calculate_tau_squared_PM(df, effect_col, var_col, max_iter=100, tol=1e-10, return_diagnostics=False):
+    """
+    Paule-Mandel estimator for tau-squared
+
+    Advantages:
+    - Exact solution to Q = k-1 equation
+    - Non-iterative in principle
+    - Good performance
+
+    Disadvantages:
+    - Can be unstable with few studies
+    - Requires iterative solution in practice (Newton's method on Q)
+
+    Reference:
+    Paule, R. C., & Mandel, J. (1982). Consensus values and weighting factors.
+    Journal of Research of the National Bureau of Standards, 87(5), 377-385.
+
+    Parameters:
+    -----------
+    df : DataFrame
+        Data with effect sizes and variances
+    effect_col : str
+        Name of effect size column
+    var_col : str
+        Name of variance column
+    max_iter : int
+        Maximum iterations
+    tol : float
+        Convergence tolerance
+    return_diagnostics : bool
+        Also return the iteration diagnostics of fit_tau_squared()
+
+    Returns:
+    --------
+    float : tau-squared estimate (and dict of diagnostics if requested)
+    """
+    try:
+        tau_sq, diagnostics = fit_tau_squared(df[effect_col].values, df[var_col].values,
+                                              method='PM', max_iter=max_iter, tol=tol)
+        if not diagnostics['converged']:
+            warnings.warn(f"PM did not converge in {diagnostics['iterations']} iterations "
+                          f"(last step {diagnostics['last_step']:.2e})")
+    except Exception as e:
+        warnings.warn(f"Error in PM estimator: {e}, using DL fallback")
+        tau_sq = calculate_tau_squared_DL(df, effect_col, var_col)
+        diagnostics = {'method': 'DL', 'converged': False, 'fallback': True, 'error': str(e)}
+
+    return (tau_sq, diagnostics) if return_diagnostics else tau_sq
+
+
+# --- 5. SIDIK-JONKMAN (SJ) ---
+
+def calculate_tau_squared_SJ(df, effect_col, var_col):
+    """
+    Sidik-Jonkman estimator for tau-squared
+
+    Advantages:
+    - Simple, non-iterative
+    - Good performance with few studies
+    - Conservative (tends to produce larger estimates)
+
+    Disadvantages:
+    - Can be overly conservative
+    - Less commonly used
+
+    Reference:
+    Sidik, K., & Jonkman, J. N. (2005). Simple heterogeneity variance
+    estimation for meta-analysis. Journal of the Royal Statistical Society,
+    Series C, 54(2), 367-384.
+
+    Parameters:
+    -----------
+    df : DataFrame
+        Data with effect sizes and variances
+    effect_col : str
+        Name of effect size column
+    var_col : str
+        Name of variance column
+
+    Returns:
+    --------
+    float : tau-squared estimate
+    """
+    k = len(df)
+    if k < 3:  # Need at least 3 studies for SJ
+        return calculate_tau_squared_DL(df, effect_col, var_col)
+
+    try:
+        yi = df[effect_col].values
+        vi = df[var_col].values
+
+        valid_mask = np.isfinite(vi) & (vi > 0)
+        if not valid_mask.all():
+            yi = yi[valid_mask]
+            vi = vi[valid_mask]
+            k = len(yi)
+
+        if k < 3:
+            return calculate_tau_squared_DL(df, effect_col, var_col)
+
+        # Weights for typical average
+        wi = 1 / vi
+        sum_wi = wi.sum()
+
+        # Typical average (weighted mean)
+        y_bar = (wi * yi).sum() / sum_wi
+
+        # SJ estimator
+        numerator = ((yi - y_bar)**2 / vi).sum()
+        denominator = k - 1
+
+        tau_sq = (numerator / denominator) - (k / sum_wi)
+
+        return max(0.0, tau_sq)
+
+    except Exception as e:
+        warnings.warn(f"Error in SJ estimator: {e}, using DL fallback")
+        return calculate_tau_squared_DL(df, effect_col, var_col)
+
+
+# --- 6. UNIFIED ESTIMATOR FUNCTION ---
+
+def calculate_tau_squared(df, effect_col, var_col, method='REML', **kwargs):
+    """
+    Unified function to calculate tau-squared using specified method
+
+    Parameters:
+    -----------
+    df : DataFrame
+        Data with effect sizes and variances
+    effect_col : str
+        Name of effect size column
+    var_col : str
+        Name of variance column
+    method : str
+        Estimation method: 'DL', 'REML', 'ML', 'PM', 'SJ'
+        Default: 'REML' (recommended)
+    **kwargs : dict
+        Additional arguments passed to estimator
+
+    Returns:
+    --------
+    float : tau-squared estimate
+    dict : additional information (method used, convergence, etc.)
+    """
+    method = method.upper()
+
+    estimators = {
+        'DL': calculate_tau_squared_DL,
+        'REML': calculate_tau_squared_REML,
+        'ML': calculate_tau_squared_ML,
+        'PM': calculate_tau_squared_PM,
+        'SJ': calculate_tau_squared_SJ
+    }
+
+    if method not in estimators:
+        warnings.warn(f"Unknown method '{method}', using REML")
+        method = 'REML'
+
+    try:
+        if method in ('REML', 'ML', 'PM'):
+            tau_sq, diagnostics = estimators[method](df, effect_col, var_col,
+                                                     return_diagnostics=True, **kwargs)
+        else:
+            tau_sq, diagnostics = estimators[method](df, effect_col, var_col, **kwargs), None
+
+        info = {
+            'method': method,
+            'tau_squared': tau_sq,
+            'tau': np.sqrt(tau_sq),
+            'success': True
+        }
+        if diagnostics is not None:
+            info['success'] = bool(diagnostics['converged'])
+            info['diagnostics'] = diagnostics
+
+        return tau_sq, info
+
+    except Exception as e:
+        warnings.warn(f"Error with {method}, falling back to DL: {e}")
+        tau_sq = calculate_tau_squared_DL(df, effect_col, var_col)
+
+        info = {
+            'method': 'DL',
+            'tau_squared': tau_sq,
+            'tau': np.sqrt(tau_sq),
+            'success': False,
+            'fallback': True,
+            'error': str(e)
+        }
+
+        return tau_sq, info
+
+
+# --- 7. BATCHED ESTIMATORS (ALL METHODS, ALL GROUPS) ---
+
+TAU_METHODS = ('DL', 'REML', 'ML', 'PM', 'SJ')
+
+
+def _segment_sums(values, seg_starts):
+    """Per-group sums of an id-sorted array."""
+    return np.add.reduceat(values, seg_starts)
+
+
+def tau_squared_batch(yi, vi, groups=None, methods=TAU_METHODS, max_iter=100, tol=1e-10):
+    """
+    All requested tau-squared estimators, for one dataset or every group.
+
+    The arrays are validated once and sorted by group; every per-group sum
+    is a segment reduction, so all groups are estimated together. DL and SJ
+    are closed form; REML and ML share fit_tau_squared()'s safeguarded
+    scoring iterations (step halving on each group's log-likelihood) and PM
+    Newton's method on Q(tau²) = k - 1, all started from the DL estimate
+    and truncated at 0.
+
+    Parameters:
+    -----------
+    yi, vi : array-like
+        Effect sizes and sampling variances
+    groups : array-like or None
+        Group label per observation (None = one group)
+    methods : iterable of str
+        Estimators to compute (subset of TAU_METHODS)
+    max_iter : int
+        Maximum iterations for the iterative estimators
+    tol : float
+        Convergence tolerance on tau² (relative to max(1, tau²))
+
+    Returns:
+    --------
+    dict : 'group' (labels), 'k' (valid observations per group), one array
+           of estimates per method and '<method>_converged' flags for
+           REML, ML and PM
+    """
+    methods = [method.upper() for method in methods]
+    unknown = [method for method in methods if method not in TAU_METHODS]
+    if unknown:
+        raise ValueError(f"Unknown tau-squared method(s): {unknown}")
+
+    yi = np.asarray(yi, dtype=np.float64)
+    vi = np.asarray(vi, dtype=np.float64)
+    if groups is None:
+        codes = np.zeros(len(yi), dtype=np.intp)
+        labels = np.array([None], dtype=object)
+    else:
+        codes, labels = pd.factorize(pd.Series(groups), sort=True)
+
+    # --- 1. Shared validation and sort by group ---
+    valid_mask = np.isfinite(yi) & np.isfinite(vi) & (vi > 0) & (codes >= 0)
+    order = np.argsort(codes[valid_mask], kind='stable')
+    y = yi[valid_mask][order]
+    v = vi[valid_mask][order]
+    group_codes = codes[valid_mask][order]
+
+    n_groups = len(labels)
+    k = np.bincount(group_codes, minlength=n_groups)
+    present = k > 0
+    seg_starts = np.concatenate(([0], np.cumsum(k[present])[:-1])).astype(np.intp)
+    k_seg = k[present].astype(np.float64)
+
+    # --- 2. Shared fixed-effects quantities ---
+    w = 1.0 / v
+    sum_w = _segment_sums(w, seg_starts)
+    sum_w2 = _segment_sums(w * w, seg_starts)
+    mu_fe = _segment_sums(w * y, seg_starts) / sum_w
+    resid_fe = y - np.repeat(mu_fe, k[present])
+    Q = _segment_sums(w * resid_fe**2, seg_starts)
+    C = sum_w - sum_w2 / sum_w
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau_dl = np.where((k_seg >= 2) & (C > 0) & (Q > k_seg - 1), (Q - (k_seg - 1)) / C, 0.0)
+    tau_dl = np.maximum(tau_dl, 0.0)
+
+    estimates = {}
+    converged = {}
+
+    def fill(values):
+        out = np.full(n_groups, np.nan)
+        out[present] = values
+        return out
+
+    if 'DL' in methods:
+        estimates['DL'] = tau_dl
+
+    if 'SJ' in methods:
+        # SJ moment estimator around the weighted mean; DL for k < 3
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tau_sj = Q / (k_seg - 1) - k_seg / sum_w
+        estimates['SJ'] = np.where(k_seg >= 3, np.maximum(tau_sj, 0.0), tau_dl)
+
+    # --- 3. Iterative estimators, all groups at once ---
+    counts = k[present]
+    for method in ('REML', 'ML'):
+        if method in methods:
+            tau, diagnostics = _segment_scoring(y, v, tau_dl, counts, seg_starts,
+                                                reml=method == 'REML', max_iter=max_iter, tol=tol,
+                                                active=k_seg >= 2)
+            estimates[method] = np.where(k_seg >= 2, tau, 0.0)
+            converged[method] = diagnostics['converged']
+
+    if 'PM' in methods:
+        # Newton on Q(tau²) - (k - 1); dQ/dtau² = -sum(w² r²)
+        tau = tau_dl.copy()
+        active = k_seg >= 2
+        done = ~active
+        for _ in range(max_iter):
+            if not active.any():
+                break
+            w_re = 1.0 / (v + np.repeat(tau, counts))
+            sw = _segment_sums(w_re, seg_starts)
+            mu = _segment_sums(w_re * y, seg_starts) / sw
+            r2 = (y - np.repeat(mu, counts))**2
+            sum_w2r2 = _segment_sums(w_re * w_re * r2, seg_starts)
+            Q_re = _segment_sums(w_re * r2, seg_starts)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                step = (Q_re - (k_seg - 1)) / sum_w2r2
+            step = np.where(active & np.isfinite(step), step, 0.0)
+            tau_new = np.maximum(tau + step, 0.0)
+            newly_done = active & (np.abs(tau_new - tau) <= tol * np.maximum(1.0, tau))
+            tau = tau_new
+            done |= newly_done
+            active &= ~newly_done
+        estimates['PM'], converged['PM'] = np.where(k_seg >= 2, tau, 0.0), done
+
+    results = {'group': labels, 'k': k}
+    for method in methods:
+        results[method] = fill(estimates[method])
+        if method in converged:
+            results[f'{method}_converged'] = fill(converged[method]).astype(bool)
+    return results
+
+
+def calculate_tau_squared_all(df, effect_col, var_col, group_col=None, methods=TAU_METHODS, **kwargs):
+    """
+    All tau-squared estimators as a table, one row per group.
+
+    Parameters:
+    -----------
+    df : DataFrame
+        Data with effect sizes and variances
+    effect_col : str
+        Name of effect size column
+    var_col : str
+        Name of variance column
+    group_col : str, list of str or None
+        Grouping column(s); None estimates the whole dataset as one row
+    methods : iterable of str
+        Estimators to compute
+    **kwargs : dict
+        Passed to tau_squared_batch (max_iter, tol)
+
+    Returns:
+    --------
+    DataFrame : 'k' plus one column per method (and '<method>_converged'),
+                indexed by group
+    """
+    if group_col is None:
+        groups = None
+    elif isinstance(group_col, str):
+        groups = df[group_col].values
+    else:
+        groups = pd.MultiIndex.from_frame(df[list(group_col)]).to_flat_index()
+
+    results = tau_squared_batch(df[effect_col].values, df[var_col].values, groups=groups,
+                                methods=methods, **kwargs)
+    labels = results.pop('group')
+    table = pd.DataFrame(results)
+    if isinstance(group_col, str):
+        table.index = pd.Index(labels, name=group_col)
+    elif group_col is not None:
+        table.index = pd.MultiIndex.from_tuples(labels, names=list(group_col))
+    return table
+
+
+# --- 8. COMPARISON FUNCTION ---
+
+def compare_tau_estimators(df, effect_col, var_col):
+    """
+    Compare all tau-squared estimators on the same dataset
+
+    Useful for sensitivity analysis and understanding which method
+    is most appropriate for your data.
+
+    Parameters:
+    -----------
+    df : DataFrame
+        Data with effect sizes and variances
+    effect_col : str
+        Name of effect size column
+    var_col : str
+        Name of variance column
+
+    Returns:
+    --------
+    DataFrame : Comparison of all methods
+    """
+    try:
+        batch = tau_squared_batch(df[effect_col].values, df[var_col].values)
+    except Exception as e:
+        warnings.warn(f"Error in batched tau-squared estimation: {e}")
+        batch = {}
+
+    results = []
+    for method in TAU_METHODS:
+        tau_sq = float(batch[method][0]) if method in batch else np.nan
+        results.append({
+            'Method': method,
+            'τ²': tau_sq,
+            'τ': np.sqrt(tau_sq),
+            'Success': bool(np.isfinite(tau_sq) and batch.get(f'{method}_converged', [True])[0])
+        })
+
+    comparison_df = pd.DataFrame(results)
+
+    return comparison_df
+
+
+# --- 9. KNAPP-HARTUNG CORRECTION ---
+
+def calculate_knapp_hartung_ci(yi, vi, tau_sq, pooled_effect, alpha=0.05):
+    """
+    Calculate Knapp-Hartung adjusted confidence interval
+
+    The Knapp-Hartung (K-H) method provides more accurate confidence intervals
+    for random-effects meta-analysis, especially with small numbers of studies.
+
+    Key improvements over standard method:
+    1. Uses t-distribution instead of normal distribution
+    2. Adjusts standard error based on observed variability (Q statistic)
+    3. Reduces Type I error rate (false positives)
+    4. More conservative with small k (appropriate coverage)
+
+    Parameters:
+    -----------
+    yi : array-like
+        Effect sizes from individual studies
+    vi : array-like
+        Sampling variances
+    tau_sq : float
+        Between-study variance (tau-squared)
+    pooled_effect : float
+        Pooled effect estimate from random-effects model
+    alpha : float, default=0.05
+        Significance level (0.05 for 95% CI)
+
+    Returns:
+    --------
+    dict with keys:
+        'se_KH': Knapp-Hartung adjusted standard error
+        'var_KH': Knapp-Hartung adjusted variance
+        'ci_lower': Lower bound of 95% CI
+        'ci_upper': Upper bound of 95% CI
+        't_stat': t-statistic
+        't_crit': Critical t-value
+        'df': Degrees of freedom (k-1)
+        'p_value': Two-tailed p-value
+        'Q': Residual heterogeneity statistic
+
+    References:
+    -----------
+    Knapp, G., & Hartung, J. (2003). Improved tests for a random effects
+    meta-regression with a single covariate. Statistics in Medicine, 22(17),
+    2693-2710.
+
+    IntHout, J., Ioannidis, J. P., & Borm, G. F. (2014). The Hartung-Knapp-
+    Sidik-Jonkman method for random effects meta-analysis is straightforward
+    and considerably outperforms the standard DerSimonian-Laird method.
+    BMC Medical Research Methodology, 14(1), 25.
+
+    Recommended by Cochrane Handbook (2023), Section 10.4.4.3
+    """
+
+    # Convert to numpy arrays
+    yi = np.array(yi)
+    vi = np.array(vi)
+
+    # Random-effects weights
+    wi_star = 1 / (vi + tau_sq)
+    sum_wi_star = np.sum(wi_star)
+
+    # Degrees of freedom
+    k = len(yi)
+    df = k - 1
+
+    if df <= 0:
+        # Can't use K-H with k=1
+        return None
+
+    # Calculate Q statistic (residual heterogeneity)
+    Q = np.sum(wi_star * (yi - pooled_effect)**2)
+
+    # Standard random-effects variance
+    var_standard = 1 / sum_wi_star
+
+    # Knapp-Hartung adjusted variance
+    # SE_KH² = (Q / (k-1)) × (1 / Σw*)
+    var_KH = (Q / df) * var_standard
+    se_KH = np.sqrt(var_KH)
+
+    # t-distribution critical value
+    t_crit = t.ppf(1 - alpha/2, df)
+
+    # Confidence interval
+    ci_lower = pooled_effect - t_crit * se_KH
+    ci_upper = pooled_effect + t_crit * se_KH
+
+    # Test statistic and p-value
+    t_stat = pooled_effect / se_KH
+    p_value = 2 * (1 - t.cdf(abs(t_stat), df))
+
+    return {
+        'se_KH': se_KH,
+        'var_KH': var_KH,
+        'ci_lower': ci_lower,
+        'ci_upper': ci_upper,
+        't_stat': t_stat,
+        't_crit': t_crit,
+        'df': df,
+        'p_value': p_value,
+        'Q': Q
+    }
+
+
+# --- 10. FISHER SCORING AND Q-PROFILE ---
+
+def _validated_arrays(yi, vi):
+    yi = np.asarray(yi, dtype=np.float64)
+    vi = np.asarray(vi, dtype=np.float64)
+    valid_mask = np.isfinite(yi) & np.isfinite(vi) & (vi > 0)
+    if not valid_mask.all():
+        yi, vi = yi[valid_mask], vi[valid_mask]
+    return yi, vi
+
+
+def _dl_from_arrays(y, v):
+    w = 1.0 / v
+    sum_w = w.sum()
+    mu = (w @ y) / sum_w
+    Q = w @ (y - mu)**2
+    C = sum_w - (w @ w) / sum_w
+    return (Q - (len(y) - 1)) / C if C > 0 and Q > len(y) - 1 else 0.0
+
+
+@timed_likelihood
+def _segment_likelihood_state(y, v, tau_sq, counts, seg_starts, reml):
+    """
+    Log-likelihood, score and information at tau_sq for every group of
+    group-sorted arrays at once (tau_sq holds one value per group).
+
+    The information is the observed one when positive (Newton step) and
+    the expected one otherwise (Fisher scoring); expected information
+    alone can under-estimate the curvature enough to make the iterates
+    oscillate slowly around the optimum.
+    """
+    tau_rep = np.repeat(tau_sq, counts)
+    w = 1.0 / (v + tau_rep)
+    sum_w = _segment_sums(w, seg_starts)
+    mu = _segment_sums(w * y, seg_starts) / sum_w
+    r = y - np.repeat(mu, counts)
+    w2 = w * w
+    w2r = w2 * r
+    sum_w2 = _segment_sums(w2, seg_starts)
+    sum_w2r2 = _segment_sums(w2r * r, seg_starts)
+    uPu = _segment_sums(w2r * r * w, seg_starts) - _segment_sums(w2r, seg_starts)**2 / sum_w
+    log_lik = -0.5 * _segment_sums(np.log(v + tau_rep) + w * r * r, seg_starts)
+    if reml:
+        log_lik -= 0.5 * np.log(sum_w)
+        tr_P = sum_w - sum_w2 / sum_w
+        expected_info = 0.5 * (sum_w2 - 2.0 * _segment_sums(w2 * w, seg_starts) / sum_w
+                               + (sum_w2 / sum_w)**2)
+        score = 0.5 * (sum_w2r2 - tr_P)
+    else:
+        expected_info = 0.5 * sum_w2
+        score = 0.5 * (sum_w2r2 - sum_w)
+    observed_info = uPu - expected_info
+    info = np.where(observed_info > 0, observed_info, expected_info)
+    return log_lik, score, info
+
+
+def _segment_scoring(y, v, tau_start, counts, seg_starts, reml, max_iter=100, tol=1e-10,
+                     max_halvings=30, active=None):
+    """
+    Safeguarded REML / ML scoring iterations for every group at once;
+    the one implementation behind fit_tau_squared() and
+    tau_squared_batch().
+
+    Newton steps (Fisher scoring where the observed information is not
+    positive) truncated at 0, each group's step halved while it would
+    lower that group's log-likelihood. Groups stop independently once
+    their change is within tol; groups with active=False are left at
+    their start.
+
+    Returns:
+    --------
+    ndarray : tau² per group
+    dict : per-group arrays 'iterations', 'converged', 'step_halvings',
+           'last_step', 'score', 'log_lik'
+    """
+    tau_sq = np.maximum(np.asarray(tau_start, dtype=np.float64), 0.0)
+    n_groups = len(tau_sq)
+    active = np.ones(n_groups, dtype=bool) if active is None else np.array(active, dtype=bool)
+    converged = ~active
+    iterations = np.zeros(n_groups, dtype=np.intp)
+    step_halvings = np.zeros(n_groups, dtype=np.intp)
+    last_step = np.zeros(n_groups)
+
+    def state(tau):
+        return _segment_likelihood_state(y, v, tau, counts, seg_starts, reml)
+
+    log_lik, score, info = state(tau_sq)
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        # Fast path while every group is still iterating (always for one group)
+        everyone = active.all()
+        if everyone and (info > 0).all():
+            step = score / info
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                step = np.where(active & (info > 0), score / info, 0.0)
+        tau_new = np.maximum(tau_sq + step, 0.0)
+        new_log_lik, new_score, new_info = state(tau_new)
+        worse = active & (new_log_lik < log_lik - 1e-12 * np.abs(log_lik))
+        halvings = 0
+        while worse.any() and halvings < max_halvings:
+            step = np.where(worse, 0.5 * step, step)
+            tau_new = np.where(worse, np.maximum(tau_sq + step, 0.0), tau_new)
+            trial_log_lik, trial_score, trial_info = state(tau_new)
+            new_log_lik = np.where(worse, trial_log_lik, new_log_lik)
+            new_score = np.where(worse, trial_score, new_score)
+            new_info = np.where(worse, trial_info, new_info)
+            step_halvings += worse
+            halvings += 1
+            worse &= new_log_lik < log_lik - 1e-12 * np.abs(log_lik)
+
+        change = np.abs(tau_new - tau_sq)
+        if everyone:
+            tau_sq, log_lik, score, info, last_step = tau_new, new_log_lik, new_score, new_info, step
+        else:
+            tau_sq = np.where(active, tau_new, tau_sq)
+            log_lik = np.where(active, new_log_lik, log_lik)
+            score = np.where(active, new_score, score)
+            info = np.where(active, new_info, info)
+            last_step = np.where(active, step, last_step)
+        iterations += active
+        newly_converged = active & (change <= tol * np.maximum(1.0, tau_sq))
+        converged |= newly_converged
+        active &= ~newly_converged
+
+    return tau_sq, {'iterations': iterations, 'converged': converged,
+                    'step_halvings': step_halvings, 'last_step': last_step,
+                    'score': score, 'log_lik': log_lik}
+
+
+def _solve_q_equation(y, v, targets, tau_sq_start=0.0, max_iter=100, tol=1e-10):
+    """
+    Solve Q(tau²) = target for several targets at once.
+
+    The generalized Q statistic is decreasing in tau² and behaves roughly
+    like 1/tau² for large tau², so Newton's method is applied to
+    1/Q(tau²) - 1/target, which is close to linear. All targets iterate
+    together as rows of one matrix; each keeps a bracket [lo, hi] and
+    bisects if a step ever leaves it. Targets with Q(0) <= target have
+    root 0.
+
+    Returns:
+    --------
+    tuple : (tau_sq array, iterations, converged array)
+    """
+    targets = np.atleast_1d(np.asarray(targets, dtype=np.float64))
+    w0 = 1.0 / v
+    mu0 = (w0 @ y) / w0.sum()
+    at_zero = (w0 @ (y - mu0)**2) <= targets
+
+    tau_sq = np.where(at_zero, 0.0, max(0.0, tau_sq_start))
+    lo = np.zeros_like(tau_sq)
+    hi = np.full_like(tau_sq, np.inf)
+    converged = at_zero.copy()
+
+    iterations = 0
+    for iterations in range(1, max_iter + 1):
+        if converged.all():
+            break
+        W = 1.0 / (v + tau_sq[:, None])
+        mu = (W @ y) / W.sum(axis=1)
+        R = y - mu[:, None]
+        WR = W * R
+        Q = (WR * R).sum(axis=1)
+        slope = np.minimum(-(WR * WR).sum(axis=1), -1e-300)
+
+        above = Q > targets
+        lo = np.where(above, tau_sq, lo)
+        hi = np.where(above, hi, tau_sq)
+        step = Q * (1.0 - Q / targets) / slope
+        converged = at_zero | (np.abs(step) <= tol * np.maximum(1.0, tau_sq))
+        tau_new = tau_sq + step
+        outside = ~converged & ((tau_new <= lo) | (tau_new >= hi) | ~np.isfinite(tau_new))
+        tau_new = np.where(outside, np.where(np.isfinite(hi), 0.5 * (lo + hi), 2.0 * lo + 1.0), tau_new)
+        tau_sq = np.where(at_zero, 0.0, tau_new)
+
+    return tau_sq, iterations, converged
+
+
+def fit_tau_squared(yi, vi, method='REML', tau_sq_start=None, max_iter=100, tol=1e-10,
+                    max_halvings=30):
+    """
+    REML, ML or PM tau-squared with iteration diagnostics.
+
+    REML and ML use scoring iterations from the DL estimate (or
+    tau_sq_start), truncated at 0: Newton steps with the observed
+    information, falling back to Fisher scoring where that is not
+    positive, and halving the step whenever it would lower the
+    log-likelihood, so every accepted iterate improves the fit. These
+    are the iterations of tau_squared_batch() run on one group. PM solves
+    Q(tau²) = k - 1 with bracketed Newton steps (see _solve_q_equation).
+
+    Parameters:
+    -----------
+    yi, vi : array-like
+        Effect sizes and sampling variances (invalid variances are dropped)
+    method : str
+        'REML', 'ML' or 'PM'
+    tau_sq_start : float or None
+        Starting value (default: DL estimate)
+    max_iter : int
+        Maximum iterations
+    tol : float
+        Convergence tolerance on tau² (relative to max(1, tau²))
+    max_halvings : int
+        Maximum step halvings per iteration
+
+    Returns:
+    --------
+    float : tau-squared estimate
+    dict : diagnostics ('method', 'k', 'iterations', 'converged',
+           'step_halvings', 'last_step', 'score', and 'log_lik' or 'Q_gap')
+    """
+    method = method.upper()
+    if method not in ('REML', 'ML', 'PM'):
+        raise ValueError(f"fit_tau_squared supports REML, ML and PM, not '{method}'")
+
+    y, v = _validated_arrays(yi, vi)
+    k = len(y)
+    diagnostics = {'method': method, 'k': k, 'iterations': 0, 'converged': True,
+                   'step_halvings': 0, 'last_step': 0.0}
+    if k < 2:
+        return 0.0, diagnostics
+
+    tau_sq = _dl_from_arrays(y, v) if tau_sq_start is None else max(0.0, float(tau_sq_start))
+
+    if method == 'PM':
+        roots, iterations, converged = _solve_q_equation(y, v, [k - 1], tau_sq_start=tau_sq,
+                                                         max_iter=max_iter, tol=tol)
+        tau_sq = float(roots[0])
+        w = 1.0 / (v + tau_sq)
+        mu = (w @ y) / w.sum()
+        diagnostics.update(iterations=iterations, converged=bool(converged[0]),
+                           Q_gap=float(w @ (y - mu)**2 - (k - 1)))
+        return tau_sq, diagnostics
+
+    # One group of the batched iterations
+    tau, state = _segment_scoring(y, v, np.array([tau_sq]), np.array([k]), np.array([0]),
+                                  reml=method == 'REML', max_iter=max_iter, tol=tol,
+                                  max_halvings=max_halvings)
+    diagnostics.update(iterations=int(state['iterations'][0]),
+                       converged=bool(state['converged'][0]),
+                       step_halvings=int(state['step_halvings'][0]),
+                       last_step=float(state['last_step'][0]), score=float(state['score'][0]),
+                       log_lik=float(state['log_lik'][0]))
+    return float(tau[0]), diagnostics
+
+
+@lru_cache(maxsize=1024)
+def _chi2_bounds(df_Q, alpha):
+    return chi2.ppf(1 - alpha / 2, df_Q), chi2.ppf(alpha / 2, df_Q)
+
+
+def q_profile_ci(yi, vi, alpha=0.05, max_iter=100, tol=1e-10):
+    """
+    Q-profile confidence interval for tau² (and the matching tau and I²).
+
+    The bounds solve Q(tau²) = chi²(k-1) quantiles (Viechtbauer, 2007);
+    both are found together by bracketed Newton iterations. A bound is 0
+    when Q(0) is already below its quantile. I² bounds use the typical
+    within-study variance of Higgins & Thompson (2002).
+
+    Reference:
+    Viechtbauer, W. (2007). Confidence intervals for the amount of
+    heterogeneity in meta-analysis. Statistics in Medicine, 26(1), 37-52.
+
+    Parameters:
+    -----------
+    yi, vi : array-like
+        Effect sizes and sampling variances (invalid variances are dropped)
+    alpha : float
+        Significance level (0.05 for a 95% CI)
+    max_iter : int
+        Maximum iterations
+    tol : float
+        Convergence tolerance on the bounds
+
+    Returns:
+    --------
+    dict : 'tau_sq_lower', 'tau_sq_upper', 'tau_lower', 'tau_upper',
+           'I_squared_lower', 'I_squared_upper' (%), 'typical_within_variance',
+           'alpha', 'converged' (NaN bounds for k < 2)
+    """
+    y, v = _validated_arrays(yi, vi)
+    k = len(y)
+    if k < 2:
+        return {'tau_sq_lower': np.nan, 'tau_sq_upper': np.nan, 'tau_lower': np.nan,
+                'tau_upper': np.nan, 'I_squared_lower': np.nan, 'I_squared_upper': np.nan,
+                'typical_within_variance': np.nan, 'alpha': alpha, 'converged': False}
+
+    # Q is decreasing in tau², so the upper chi² quantile gives the lower bound
+    bounds, _, converged = _solve_q_equation(y, v, _chi2_bounds(k - 1, alpha),
+                                             max_iter=max_iter, tol=tol)
+    tau_sq_lower, tau_sq_upper = float(bounds[0]), float(bounds[1])
+
+    w = 1.0 / v
+    sum_w = w.sum()
+    s_squared = (k - 1) * sum_w / (sum_w**2 - (w @ w))
+
+    return {
+        'tau_sq_lower': tau_sq_lower,
+        'tau_sq_upper': tau_sq_upper,
+        'tau_lower': np.sqrt(tau_sq_lower),
+        'tau_upper': np.sqrt(tau_sq_upper),
+        'I_squared_lower': 100 * tau_sq_lower / (tau_sq_lower + s_squared),
+        'I_squared_upper': 100 * tau_sq_upper / (tau_sq_upper + s_squared),
+        'typical_within_variance': s_squared,
+        'alpha': alpha,
+        'converged': bool(converged.all()),
+    }
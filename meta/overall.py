@@ -0,0 +1,253 @@
+"""
+Overall (two-level) meta-analysis.
+
+Mirrors the notebook's "OVERALL POOLED EFFECT SIZE & HETEROGENEITY" step:
+fixed-effects pooling, Cochran's Q / I², τ² with the selected estimator,
+random-effects pooling with optional Knapp-Hartung adjustment and the 95%
+prediction interval.
+
+Usage:
+    overall_results = run_overall_analysis(analysis_data, 'lnRR', 'var_lnRR', 'SE_lnRR')
+"""
+
+import numpy as np
+from scipy.stats import norm, chi2, t
+
+from .fit_cache import cached_fit
+from .perf import instrumented_fit
+from .heterogeneity import calculate_tau_squared, calculate_knapp_hartung_ci, q_profile_ci
+
+__all__ = [
+    'interpret_I_squared',
+    'run_overall_analysis',
+]
+
+
+def interpret_I_squared(I_squared):
+    """Return the (interpretation, level) pair used in the results tables."""
+    if I_squared < 25:
+        return "Low heterogeneity (might not be important)", "🟢"
+    elif I_squared < 50:
+        return "Moderate heterogeneity", "🟡"
+    elif I_squared < 75:
+        return "Substantial heterogeneity", "🟠"
+    return "Considerable heterogeneity", "🔴"
+
+
+@instrumented_fit('overall')
+@cached_fit('overall', columns=('id', 'w_fixed'))
+def run_overall_analysis(analysis_data, effect_col, var_col, se_col, tau_method='REML',
+                         use_knapp_hartung=True, alpha=0.05):
+    """
+    Fixed- and random-effects pooled estimates with heterogeneity statistics.
+
+    Parameters:
+    -----------
+    analysis_data : DataFrame
+        Data with 'id', effect size, variance, SE and 'w_fixed' columns
+    effect_col, var_col, se_col : str
+        Column names for effect sizes, variances and standard errors
+    tau_method : str
+        τ² estimator ('DL', 'REML', 'ML', 'PM', 'SJ')
+    use_knapp_hartung : bool
+        Report the Knapp-Hartung adjusted random-effects CI
+    alpha : float
+        Significance level
+
+    Returns:
+    --------
+    dict : Same keys as ANALYSIS_CONFIG['overall_results']
+    """
+    analysis_data = analysis_data.dropna(subset=[effect_col, var_col]).copy()
+    analysis_data = analysis_data[analysis_data[var_col] > 0]
+    if 'w_fixed' not in analysis_data.columns:
+        analysis_data['w_fixed'] = 1 / analysis_data[var_col]
+
+    k = len(analysis_data)
+    k_papers = analysis_data['id'].nunique()
+    if k < 1:
+        raise ValueError("No valid studies available for meta-analysis after filtering.")
+
+    z_crit = norm.ppf(1 - alpha / 2)
+    yi = analysis_data[effect_col].values
+    vi = analysis_data[var_col].values
+    w_fixed = analysis_data['w_fixed'].values
+
+    # --- Single study: no pooling or heterogeneity ---
+    if k == 1:
+        effect, se = yi[0], analysis_data[se_col].values[0]
+        return {
+            'k': k,
+            'k_papers': k_papers,
+            'pooled_effect_fixed': effect,
+            'pooled_var_fixed': vi[0],
+            'pooled_SE_fixed': np.nan,
+            'ci_lower_fixed': np.nan,
+            'ci_upper_fixed': np.nan,
+            'z_stat_fixed': np.nan,
+            'p_value_fixed': np.nan,
+            'Qt': np.nan,
+            'df_Q': np.nan,
+            'p_heterogeneity': np.nan,
+            'I_squared': np.nan,
+            'I_squared_interpretation': 'N/A',
+            'tau_squared': np.nan,
+            'tau': np.nan,
+            'tau_squared_ci_lower': np.nan,
+            'tau_squared_ci_upper': np.nan,
+            'I_squared_ci_lower': np.nan,
+            'I_squared_ci_upper': np.nan,
+            'tau_method': tau_method,
+            'pooled_effect_random': effect,
+            'pooled_var_random': vi[0],
+            'pooled_SE_random_Z': np.nan,
+            'ci_lower_random_Z': np.nan,
+            'ci_upper_random_Z': np.nan,
+            'z_stat_random': np.nan,
+            'p_value_random_Z': np.nan,
+            'pooled_SE_random_reported': se,
+            'ci_lower_random_reported': effect - z_crit * se,
+            'ci_upper_random_reported': effect + z_crit * se,
+            'p_value_random_reported': np.nan,
+            'knapp_hartung': {'used': False, 'reason': 'k<=1'},
+            'pi_lower_random': np.nan,
+            'pi_upper_random': np.nan,
+            'pi_df': np.nan,
+            'effect_difference': np.nan,
+            'se_ratio': np.nan,
+            'recommended_model': 'either',
+            'heterogeneity_level': 'N/A'
+        }
+
+    # --- Fixed-effects model ---
+    sum_w_fixed = w_fixed.sum()
+    if sum_w_fixed <= 0:
+        raise ValueError("Sum of fixed-effects weights is non-positive. Check variance values.")
+
+    pooled_effect_fixed = (w_fixed * yi).sum() / sum_w_fixed
+    pooled_var_fixed = 1 / sum_w_fixed
+    pooled_SE_fixed = np.sqrt(pooled_var_fixed)
+    ci_lower_fixed = pooled_effect_fixed - z_crit * pooled_SE_fixed
+    ci_upper_fixed = pooled_effect_fixed + z_crit * pooled_SE_fixed
+    z_stat_fixed = pooled_effect_fixed / pooled_SE_fixed
+    p_value_fixed = 2 * (1 - norm.cdf(abs(z_stat_fixed)))
+
+    # --- Heterogeneity ---
+    Qt = (w_fixed * (yi - pooled_effect_fixed)**2).sum()
+    df_Q = k - 1
+    p_heterogeneity = 1 - chi2.cdf(Qt, df_Q) if df_Q > 0 else np.nan
+    I_squared = ((Qt - df_Q) / Qt) * 100 if Qt > df_Q else 0
+    i2_interp, i2_level = interpret_I_squared(I_squared)
+
+    if tau_method != 'DL':
+        tau_squared, _ = calculate_tau_squared(analysis_data, effect_col, var_col, method=tau_method)
+        tau_squared = float(tau_squared)
+    else:
+        C = sum_w_fixed - ((w_fixed**2).sum() / sum_w_fixed)
+        tau_squared = (Qt - df_Q) / C if C > 0 and Qt > df_Q else 0.0
+
+    # Q-profile confidence interval for tau² (and the matching I² bounds)
+    tau_ci = q_profile_ci(yi, vi, alpha=alpha)
+
+    # --- Random-effects model ---
+    w_random = 1 / (vi + tau_squared)
+    sum_w_random = w_random.sum()
+
+    pooled_effect_random = (w_random * yi).sum() / sum_w_random
+    pooled_var_random = 1 / sum_w_random
+    pooled_SE_random = np.sqrt(pooled_var_random)
+    ci_lower_random = pooled_effect_random - z_crit * pooled_SE_random
+    ci_upper_random = pooled_effect_random + z_crit * pooled_SE_random
+    z_stat_random = pooled_effect_random / pooled_SE_random
+    p_value_random = 2 * (1 - norm.cdf(abs(z_stat_random)))
+
+    final_re_se = pooled_SE_random
+    final_re_ci_lower, final_re_ci_upper = ci_lower_random, ci_upper_random
+    final_re_p_value = p_value_random
+    knapp_hartung = {'used': False, 'reason': 'user_disabled'}
+
+    if use_knapp_hartung:
+        kh_results = calculate_knapp_hartung_ci(yi, vi, tau_squared, pooled_effect_random, alpha=alpha)
+        if kh_results is not None:
+            ci_width_standard = ci_upper_random - ci_lower_random
+            ci_width_kh = kh_results['ci_upper'] - kh_results['ci_lower']
+            standard_sig = p_value_random < alpha
+            kh_sig = kh_results['p_value'] < alpha
+            knapp_hartung = {
+                'used': True,
+                'se': kh_results['se_KH'],
+                'ci_lower': kh_results['ci_lower'],
+                'ci_upper': kh_results['ci_upper'],
+                't_stat': kh_results['t_stat'],
+                't_crit': kh_results['t_crit'],
+                'df': kh_results['df'],
+                'p_value': kh_results['p_value'],
+                'Q': kh_results['Q'],
+                'comparison': {
+                    'standard_se': pooled_SE_random,
+                    'standard_ci': [ci_lower_random, ci_upper_random],
+                    'standard_p': p_value_random,
+                    'kh_ci': [kh_results['ci_lower'], kh_results['ci_upper']],
+                    'width_increase_percent': ((ci_width_kh - ci_width_standard) / ci_width_standard) * 100,
+                    'significance_changed': standard_sig != kh_sig
+                }
+            }
+            final_re_se = kh_results['se_KH']
+            final_re_ci_lower, final_re_ci_upper = kh_results['ci_lower'], kh_results['ci_upper']
+            final_re_p_value = kh_results['p_value']
+        else:
+            knapp_hartung = {'used': False, 'reason': 'k_or_calc_error'}
+
+    # --- 95% prediction interval ---
+    if k > 2:
+        df_pi = k - 2
+        t_crit = t.ppf(1 - alpha / 2, df=df_pi)
+        se_prediction = np.sqrt(tau_squared + pooled_var_random)
+        pi_lower_random = pooled_effect_random - t_crit * se_prediction
+        pi_upper_random = pooled_effect_random + t_crit * se_prediction
+    else:
+        df_pi = np.nan
+        pi_lower_random = pi_upper_random = np.nan
+
+    return {
+        'k': k,
+        'k_papers': k_papers,
+        'pooled_effect_fixed': pooled_effect_fixed,
+        'pooled_var_fixed': pooled_var_fixed,
+        'pooled_SE_fixed': pooled_SE_fixed,
+        'ci_lower_fixed': ci_lower_fixed,
+        'ci_upper_fixed': ci_upper_fixed,
+        'z_stat_fixed': z_stat_fixed,
+        'p_value_fixed': p_value_fixed,
+        'Qt': Qt,
+        'df_Q': df_Q,
+        'p_heterogeneity': p_heterogeneity,
+        'I_squared': I_squared,
+        'I_squared_interpretation': i2_interp,
+        'tau_squared': tau_squared,
+        'tau': np.sqrt(tau_squared),
+        'tau_squared_ci_lower': tau_ci['tau_sq_lower'],
+        'tau_squared_ci_upper': tau_ci['tau_sq_upper'],
+        'I_squared_ci_lower': tau_ci['I_squared_lower'],
+        'I_squared_ci_upper': tau_ci['I_squared_upper'],
+        'tau_method': tau_method,
+        'pooled_effect_random': pooled_effect_random,
+        'pooled_var_random': pooled_var_random,
+        'pooled_SE_random_Z': pooled_SE_random,
+        'ci_lower_random_Z': ci_lower_random,
+        'ci_upper_random_Z': ci_upper_random,
+        'z_stat_random': z_stat_random,
+        'p_value_random_Z': p_value_random,
+        'pooled_SE_random_reported': final_re_se,
+        'ci_lower_random_reported': final_re_ci_lower,
+        'ci_upper_random_reported': final_re_ci_upper,
+        'p_value_random_reported': final_re_p_value,
+        'knapp_hartung': knapp_hartung,
+        'pi_lower_random': pi_lower_random,
+        'pi_upper_random': pi_upper_random,
+        'pi_df': df_pi,
+        'effect_difference': pooled_effect_random - pooled_effect_fixed,
+        'se_ratio': pooled_SE_random / pooled_SE_fixed if pooled_SE_fixed > 0 else np.inf,
+        'recommended_model': 'random-effects' if (I_squared > 25 or p_heterogeneity < 0.10) else 'either',
+        'heterogeneity_level': i2_level
+    }
@@ -0,0 +1,354 @@
+"""
+Performance instrumentation.
+
+When enabled, every instrumented fit records how long it took, how much
+of that was spent evaluating the likelihood, and the optimizer's own
+diagnostics (function / gradient evaluations, iterations, convergence
+message). Records nest: pipeline stage -> fit -> phase (e.g. the
+three-level 'optimize' and 'variance_cis' phases), so a slow notebook
+cell can be narrowed down to the part that is slow.
+
+    enable_perf()                        # cheap, off by default
+    ... run analyses ...
+    perf_table()                         # one row per record
+    write_perf_json('perf.json')
+
+Peak memory is recorded when enable_perf(memory=True) (tracemalloc;
+slows Python-level code). For a one-off deep look, profile_run() wraps a
+block in cProfile + tracemalloc and prints a summary table:
+
+    with profile_run() as report:
+        run_three_level_reml(df, 'yi', 'vi')
+    report['profile']                    # top functions by cumulative time
+
+Likelihood evaluations done in worker processes (n_jobs > 1) are not
+seen by the parent and are not counted.
+"""
+
+import contextlib
+import cProfile
+import functools
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+__all__ = [
+    'enable_perf',
+    'perf_enabled',
+    'perf_section',
+    'instrumented_fit',
+    'timed_likelihood',
+    'perf_records',
+    'clear_perf',
+    'perf_summary',
+    'perf_table',
+    'write_perf_json',
+    'profile_table',
+    'profile_run',
+]
+
+_PERF = {
+    'enabled': False,
+    'memory': False,
+    'started_tracing': False,
+    'records': [],
+}
+# Open sections of the current thread (the pipeline runs stages on threads)
+_LOCAL = threading.local()
+
+
+# --- 1. SWITCHES ---
+
+def enable_perf(enabled=True, memory=False):
+    """
+    Turn instrumentation on or off. memory=True also traces allocations
+    (tracemalloc) so sections record their peak memory.
+
+    Returns the previous (enabled, memory) so a caller can restore it
+    with enable_perf(*previous).
+    """
+    previous = (_PERF['enabled'], _PERF['memory'])
+    _PERF['enabled'] = bool(enabled)
+    _PERF['memory'] = bool(enabled and memory)
+    if _PERF['memory'] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _PERF['started_tracing'] = True
+    elif not _PERF['memory'] and _PERF['started_tracing']:
+        tracemalloc.stop()
+        _PERF['started_tracing'] = False
+    return previous
+
+
+def perf_enabled():
+    return _PERF['enabled']
+
+
+def perf_records():
+    """Top-level records collected so far (sections nest under 'children')."""
+    return list(_PERF['records'])
+
+
+def clear_perf():
+    _PERF['records'].clear()
+
+
+# --- 2. SECTIONS ---
+
+def _stack():
+    stack = getattr(_LOCAL, 'stack', None)
+    if stack is None:
+        stack = _LOCAL.stack = []
+    return stack
+
+
+@contextlib.contextmanager
+def perf_section(name, kind='phase', keep=True):
+    """
+    Time a block. Yields the record (None when instrumentation is off);
+    the record is filled in when the block exits and is attached to the
+    enclosing section, or kept as a top-level record if keep=True.
+    """
+    if not _PERF['enabled']:
+        yield None
+        return
+    record = {
+        'name': name,
+        'kind': kind,
+        'seconds': 0.0,
+        'likelihood_evals': 0,
+        'likelihood_seconds': 0.0,
+        'children': [],
+    }
+    stack = _stack()
+    tracing = _PERF['memory'] and tracemalloc.is_tracing()
+    if tracing:
+        # The peak is process-wide (concurrent sections see each other's
+        # allocations); a section hands the peak so far to its parent
+        # before resetting it
+        start_memory, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]['_peak'] = max(stack[-1].get('_peak', 0), peak)
+        tracemalloc.reset_peak()
+    stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        record['overhead_seconds'] = record['seconds'] - record['likelihood_seconds']
+        if tracing:
+            peak = max(tracemalloc.get_traced_memory()[1], record.pop('_peak', 0))
+            record['peak_mb'] = max(0, peak - start_memory) / 2**20
+            if len(stack) > 1:
+                stack[-2]['_peak'] = max(stack[-2].get('_peak', 0), peak)
+        stack.pop()
+        if stack:
+            stack[-1]['children'].append(record)
+        elif keep:
+            _PERF['records'].append(record)
+
+
+def timed_likelihood(func):
+    """
+    Decorator for likelihood functions: each call is counted and timed in
+    every open section of the calling thread.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _PERF['enabled']:
+            return func(*args, **kwargs)
+        stack = _stack()
+        if not stack:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            for record in stack:
+                record['likelihood_evals'] += 1
+                record['likelihood_seconds'] += elapsed
+    return wrapper
+
+
+def _optimizer_diagnostics(result):
+    """nfev / njev / nit / success / message from a fit's return value."""
+    from scipy.optimize import OptimizeResult
+    candidates = result if isinstance(result, tuple) else (result,)
+    for candidate in candidates:
+        if isinstance(candidate, OptimizeResult):
+            return {
+                'nfev': candidate.get('nfev'),
+                'njev': candidate.get('njev'),
+                'nit': candidate.get('nit'),
+                'success': bool(candidate.get('success', False)),
+                'message': str(candidate.get('message', '')),
+            }
+    if isinstance(result, dict) and ('n_iter' in result or 'converged' in result):
+        return {'nit': result.get('n_iter'), 'success': result.get('converged')}
+    return {}
+
+
+def instrumented_fit(model):
+    """
+    Decorator for fitting entry points: records a 'fit' section with the
+    optimizer diagnostics of the result. Put it above @cached_fit so
+    cache hits show up as (near-)zero-time fits with no evaluations.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _PERF['enabled']:
+                return func(*args, **kwargs)
+            with perf_section(model, kind='fit') as record:
+                record['function'] = func.__qualname__
+                result = func(*args, **kwargs)
+                record.update(_optimizer_diagnostics(result))
+            return result
+        return wrapper
+    return decorator
+
+
+# --- 3. REPORTS ---
+
+def _flatten(records, path=()):
+    for record in records:
+        row_path = path + (record['name'],)
+        yield row_path, record
+        yield from _flatten(record.get('children', ()), row_path)
+
+
+def perf_summary(record):
+    """
+    Compact summary of one section: seconds, likelihood share, number of
+    fits (and of those that did not converge), evaluations and peak memory.
+    """
+    fits = [r for _, r in _flatten([record]) if r['kind'] == 'fit']
+    summary = {
+        'seconds': record['seconds'],
+        'likelihood_seconds': record['likelihood_seconds'],
+        'likelihood_pct': (100.0 * record['likelihood_seconds'] / record['seconds']
+                           if record['seconds'] > 0 else 0.0),
+        'likelihood_evals': record['likelihood_evals'],
+        'fits': len(fits),
+        'not_converged': sum(1 for r in fits if r.get('success') is False),
+    }
+    if 'peak_mb' in record:
+        summary['peak_mb'] = record['peak_mb']
+    return summary
+
+
+def perf_table(records=None):
+    """
+    One row per section (nested sections included), with the share of
+    time spent in the likelihood.
+
+    Returns:
+    --------
+    DataFrame : 'path' ('stage/fit/phase'), 'kind', 'seconds',
+                'likelihood_seconds', 'likelihood_pct', 'likelihood_evals',
+                'nfev', 'njev', 'nit', 'success', 'message', 'peak_mb'
+    """
+    records = _PERF['records'] if records is None else records
+    rows = []
+    for path, record in _flatten(records):
+        row = {key: value for key, value in record.items() if key != 'children'}
+        row['path'] = '/'.join(path)
+        row['likelihood_pct'] = (100.0 * record['likelihood_seconds'] / record['seconds']
+                                 if record['seconds'] > 0 else 0.0)
+        rows.append(row)
+    columns = ['path', 'kind', 'seconds', 'likelihood_seconds', 'likelihood_pct',
+               'likelihood_evals', 'nfev', 'njev', 'nit', 'success', 'message', 'peak_mb']
+    table = pd.DataFrame(rows)
+    return table.reindex(columns=columns + [c for c in table.columns if c not in columns])
+
+
+def write_perf_json(path, records=None, **extra):
+    """Write perf records (plus any extra JSON-friendly fields) to a JSON sidecar."""
+    records = _PERF['records'] if records is None else records
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(dict(extra, records=records), f, indent=2, default=str)
+
+
+def profile_table(stats, top=30, sort='cumtime'):
+    """
+    Top functions of a cProfile.Profile / pstats.Stats as a DataFrame
+    ('function', 'ncalls', 'tottime', 'cumtime', 'percall_cum').
+    """
+    if not isinstance(stats, pstats.Stats):
+        stats = pstats.Stats(stats)
+    rows = []
+    for (filename, line, function), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            'function': f"{function} ({filename.rsplit('/', 1)[-1]}:{line})",
+            'ncalls': ncalls,
+            'tottime': tottime,
+            'cumtime': cumtime,
+            'percall_cum': cumtime / ncalls if ncalls else 0.0,
+        })
+    table = pd.DataFrame(rows)
+    if table.empty:
+        return table
+    return table.sort_values(sort, ascending=False).head(top).reset_index(drop=True)
+
+
+@contextlib.contextmanager
+def profile_run(label='run', top=20, memory=True, verbose=True):
+    """
+    Profile a block with cProfile (this thread only) and tracemalloc,
+    with instrumentation enabled.
+
+    Yields a dict that is filled in when the block exits:
+        'records'      perf records of the block (see perf_table)
+        'table'        perf_table() of those records
+        'profile'      profile_table() of the top functions
+        'peak_mb'      peak traced memory of the block
+        'allocations'  top allocation sites (tracemalloc)
+
+    verbose=True prints the perf table and the top functions.
+    """
+    report = {'label': label}
+    previous = (_PERF['enabled'], _PERF['memory'])
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    if memory:
+        tracemalloc.reset_peak()
+    _PERF['enabled'] = True
+    _PERF['memory'] = memory
+    profiler = cProfile.Profile()
+    try:
+        with perf_section(label, kind='run', keep=False) as record:
+            profiler.enable()
+            try:
+                yield report
+            finally:
+                profiler.disable()
+    finally:
+        if memory:
+            report['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+            snapshot = tracemalloc.take_snapshot()
+            report['allocations'] = [str(stat) for stat in snapshot.statistics('lineno')[:10]]
+        if started_tracing:
+            tracemalloc.stop()
+        _PERF['enabled'], _PERF['memory'] = previous
+        report['records'] = [record]
+        report['table'] = perf_table([record])
+        report['profile'] = profile_table(profiler, top=top)
+        if verbose:
+            with pd.option_context('display.width', 160, 'display.max_columns', 20,
+                                   'display.max_colwidth', 70):
+                print(f"\nPERF: {label}")
+                print(report['table'][['path', 'seconds', 'likelihood_pct', 'likelihood_evals',
+                                       'nfev', 'njev', 'nit', 'message']].to_string(index=False))
+                print(f"\nTop {top} functions by cumulative time:")
+                print(report['profile'].to_string(index=False))
+                if memory:
+                    print(f"\nPeak traced memory: {report['peak_mb']:.1f} MB")
@@ -0,0 +1,1120 @@
+"""
+Headless batch pipeline.
+
+Runs the notebook's analysis chain without widgets or Colab authentication:
+
+    clean -> effect_sizes -> tau, overall, three_level, cumulative
+    overall -> subgroups, regression
+    three_level -> bias (Egger + trim-and-fill), loo
+
+Settings come from a JSON (or TOML) config file whose keys mirror
+ANALYSIS_CONFIG. Every stage writes its tables/figures to the output
+directory and a summary to results.json; a failed stage is recorded and
+the stages that depend on it are skipped.
+
+STAGE_SPECS declares each stage's inputs, outputs and config entries.
+Stages whose dependencies are done run concurrently ("stage_workers"
+threads), and a stage whose input fingerprint (upstream outputs + its
+config) has not changed since the last run into the same output
+directory is restored from OUTPUT_DIR/.stage_cache.pkl instead of rerun:
+changing the prefilter reruns everything, changing "bias" only reruns
+the bias stage.
+
+Each stage that runs is timed ("perf"): OUTPUT_DIR/perf.json holds, per
+stage, every model fit with its optimizer diagnostics (evaluations,
+iterations, convergence message) and the time spent in the likelihood.
+--profile (or "perf": {"profile": true}) also profiles the stages with
+cProfile and adds the top functions.
+
+Command line:
+    python -m meta CONFIG INPUT [INPUT ...] -o OUTPUT_DIR
+
+Minimal config:
+    {
+        "col_map": {"Study": "id", "Mean_T": "xe", "SD_T": "sde", "N_T": "ne",
+                    "Mean_C": "xc", "SD_C": "sdc", "N_C": "nc"},
+        "effect_size_type": "lnRR",
+        "subgroups": [{"moderator1": "Crop"}],
+        "regression": {"moderators": ["Temperature"]}
+    }
+
+Multi-moderator three-level meta-regressions go under
+"regression": {"three_level_models": [{"moderators": ["Temperature", "Crop"],
+"interactions": [["Temperature", "Crop"]]}]}. "regression": {"screen": true}
+fits every numeric input column as a moderator (or "screen": [columns])
+and writes a ranked moderator_screening.csv with FDR / Holm p-values.
+
+Exit status: 0 all stages succeeded, 1 at least one stage failed,
+2 invalid config or arguments, 3 an input could not be read.
+"""
+
+import argparse
+import copy
+import cProfile
+import datetime
+import hashlib
+import json
+import logging
+import os
+import pickle
+import pstats
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    'STAGES',
+    'STAGE_SPECS',
+    'DEFAULT_CONFIG',
+    'EXIT_OK',
+    'EXIT_STAGE_FAILED',
+    'EXIT_CONFIG_ERROR',
+    'EXIT_INPUT_ERROR',
+    'load_config',
+    'run_pipeline',
+    'main',
+]
+
+logger = logging.getLogger(__name__)
+
+EXIT_OK = 0
+EXIT_STAGE_FAILED = 1
+EXIT_CONFIG_ERROR = 2
+EXIT_INPUT_ERROR = 3
+
+STAGES = ('clean', 'effect_sizes', 'tau', 'overall', 'three_level', 'subgroups',
+          'regression', 'bias', 'loo', 'cumulative')
+
+# What every stage reads from / writes to `state`, and the config entries
+# its results depend on ('a.b' is config['a']['b']). 'optional' inputs are
+# waited for when their stage runs but do not block when it fails or is
+# disabled. n_jobs is left out on purpose: it never changes a result.
+STAGE_SPECS = {
+    'clean': {
+        'inputs': ('raw_data',),
+        'config': ('col_map', 'prefilter_col', 'prefilter_values_kept'),
+        'outputs': ('data_filtered',),
+    },
+    'effect_sizes': {
+        'inputs': ('data_filtered',),
+        'config': ('effect_size_type',),
+        'outputs': ('analysis_data', 'es_config', 'effect_col', 'var_col', 'se_col'),
+    },
+    'tau': {
+        'inputs': ('analysis_data', 'effect_col', 'var_col'),
+        'config': ('tau_method',),
+        'outputs': ('tau_estimators',),
+    },
+    'overall': {
+        'inputs': ('analysis_data', 'effect_col', 'var_col', 'se_col'),
+        'config': ('tau_method', 'use_knapp_hartung', 'figures.study_forest',
+                   'figures.forest_rows_per_page', 'figures.formats', 'figures.dpi'),
+        'outputs': ('overall_results',),
+    },
+    'three_level': {
+        'inputs': ('analysis_data', 'effect_col', 'var_col'),
+        'config': ('three_level', 'variance_ci', 'bootstrap'),
+        'outputs': ('three_level_results',),
+    },
+    'subgroups': {
+        'inputs': ('analysis_data', 'effect_col', 'var_col', 'es_config', 'overall_results'),
+        'optional': ('three_level_results',),
+        'config': ('subgroups', 'three_level'),
+        'outputs': (),
+    },
+    'regression': {
+        'inputs': ('data_filtered', 'analysis_data', 'effect_col', 'var_col', 'overall_results'),
+        'optional': ('three_level_results',),
+        'config': ('regression',),
+        'outputs': (),
+    },
+    'bias': {
+        'inputs': ('analysis_data', 'effect_col', 'var_col', 'se_col', 'es_config',
+                   'three_level_results'),
+        'config': ('tau_method', 'bias', 'figures.funnel_render'),
+        'outputs': (),
+    },
+    'loo': {
+        'inputs': ('analysis_data', 'effect_col', 'var_col', 'es_config', 'three_level_results'),
+        'config': (),
+        'outputs': (),
+    },
+    'cumulative': {
+        'inputs': ('analysis_data', 'effect_col', 'var_col', 'es_config'),
+        'config': ('tau_method', 'cumulative'),
+        'outputs': (),
+    },
+}
+
+_PRODUCERS = {key: stage for stage, spec in STAGE_SPECS.items() for key in spec['outputs']}
+
+# Stages each stage needs results from (derived from STAGE_SPECS)
+STAGE_DEPENDENCIES = {
+    stage: tuple(dict.fromkeys(_PRODUCERS[key] for key in spec['inputs'] if key in _PRODUCERS))
+    for stage, spec in STAGE_SPECS.items()
+}
+OPTIONAL_DEPENDENCIES = {
+    stage: tuple(dict.fromkeys(_PRODUCERS[key] for key in spec.get('optional', ())))
+    for stage, spec in STAGE_SPECS.items()
+}
+
+# Bump when a stage's outputs change so stale stage caches are not reused
+_STAGE_CACHE_VERSION = 1
+_STAGE_CACHE_FILE = '.stage_cache.pkl'
+
+DEFAULT_CONFIG = {
+    'col_map': None,
+    'prefilter_col': 'None',
+    'prefilter_values_kept': 'All',
+    'effect_size_type': 'lnRR',
+    'tau_method': 'REML',
+    'use_knapp_hartung': True,
+    'three_level': {'fit_method': 'fisher', 'info_type': 'expected', 'log_scale': False},
+    'variance_ci': 'profile',
+    'bootstrap': {'n_boot': 0, 'seed': None, 'bca': True},
+    'subgroups': [],
+    'regression': {'moderators': [], 'three_level_models': [], 'n_permutations': 0, 'seed': None,
+                   'vcov_type': 'CR2', 'screen': False},
+    'bias': {'estimator': 'L0', 'side': 'auto', 'max_iter': 100, 'model': 'fixed',
+             'grid': False, 'grid_group_col': None},
+    'loo': {'n_jobs': 1},
+    'stage_workers': 4,
+    'cumulative': {'year_col': 'year', 'unit': 'study', 'sort_order': 'ascending'},
+    'figures': {'formats': ['pdf', 'png'], 'dpi': 300, 'funnel_render': 'auto',
+                'study_forest': False, 'forest_rows_per_page': 50, 'bundle': False,
+                'cache_dir': None},
+    'fit_cache': {'enabled': True, 'max_entries': 256, 'disk_dir': None},
+    'perf': {'enabled': True, 'memory': False, 'profile': False, 'profile_top': 30},
+    'stages': list(STAGES),
+}
+
+
+# --- 1. CONFIGURATION ---
+
+def _merge_config(user_config):
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    for key, value in user_config.items():
+        if key not in config:
+            raise ValueError(f"Unknown config key '{key}'")
+        if isinstance(config[key], dict) and isinstance(value, dict):
+            config[key].update(value)
+        else:
+            config[key] = value
+    return config
+
+
+def load_config(path_or_dict):
+    """
+    Load and validate a pipeline config.
+
+    Parameters:
+    -----------
+    path_or_dict : str or dict
+        Path to a .json / .toml file, or an already-parsed dict
+
+    Returns:
+    --------
+    dict : Config with defaults filled in
+    """
+    if isinstance(path_or_dict, dict):
+        user_config = path_or_dict
+    elif str(path_or_dict).lower().endswith('.toml'):
+        import tomllib
+        with open(path_or_dict, 'rb') as f:
+            user_config = tomllib.load(f)
+    else:
+        with open(path_or_dict, encoding='utf-8') as f:
+            user_config = json.load(f)
+
+    config = _merge_config(user_config)
+
+    from .effect_sizes import ES_CONFIGS
+    if not config['col_map']:
+        raise ValueError("'col_map' is required (source column -> role)")
+    missing_roles = set(['id', 'xe', 'sde', 'ne', 'xc', 'sdc', 'nc']) - set(config['col_map'].values())
+    if missing_roles:
+        raise ValueError(f"'col_map' has no column for role(s): {sorted(missing_roles)}")
+    if config['effect_size_type'] not in ES_CONFIGS:
+        raise ValueError(f"Unknown effect_size_type '{config['effect_size_type']}' "
+                         f"(expected one of {list(ES_CONFIGS)})")
+    if config['variance_ci'] not in ('profile', 'wald'):
+        raise ValueError(f"Unknown variance_ci '{config['variance_ci']}' (expected 'profile' or 'wald')")
+    from .robust import VCOV_TYPES
+    if config['regression']['vcov_type'] not in VCOV_TYPES:
+        raise ValueError(f"Unknown regression vcov_type '{config['regression']['vcov_type']}' "
+                         f"(expected one of {list(VCOV_TYPES)})")
+    if not isinstance(config['stage_workers'], int) or config['stage_workers'] < 1:
+        raise ValueError(f"'stage_workers' must be a positive integer, got {config['stage_workers']!r}")
+    unknown_stages = set(config['stages']) - set(STAGES)
+    if unknown_stages:
+        raise ValueError(f"Unknown stage(s): {sorted(unknown_stages)}")
+    for subgroup in config['subgroups']:
+        if 'moderator1' not in subgroup:
+            raise ValueError("Every 'subgroups' entry needs 'moderator1'")
+    screen = config['regression']['screen']
+    if not (isinstance(screen, bool) or (isinstance(screen, list) and all(isinstance(m, str) for m in screen))):
+        raise ValueError("'regression.screen' must be true/false or a list of moderator columns")
+    for model in config['regression']['three_level_models']:
+        if not model.get('moderators'):
+            raise ValueError("Every 'three_level_models' entry needs 'moderators'")
+    return config
+
+
+# --- 2. STAGES ---
+# Each stage reads from and writes to `state` (the batch equivalent of the
+# notebook globals / ANALYSIS_CONFIG) and returns a JSON-friendly summary.
+
+def _stage_clean(state, config, output_dir):
+    from .data import clean_data
+
+    data_filtered, load_metadata = clean_data(
+        state['raw_data'], config['col_map'],
+        prefilter_col=config['prefilter_col'],
+        prefilter_values=config['prefilter_values_kept']
+    )
+    if data_filtered.empty:
+        raise ValueError("No rows left after cleaning and pre-filtering.")
+    state['data_filtered'] = data_filtered
+    return load_metadata
+
+
+def _stage_effect_sizes(state, config, output_dir):
+    from .effect_sizes import ES_CONFIGS, calculate_effect_sizes
+
+    effect_size_type = config['effect_size_type']
+    analysis_data, calculation_log = calculate_effect_sizes(state['data_filtered'], effect_size_type)
+    if analysis_data.empty:
+        raise ValueError("No valid effect sizes could be calculated.")
+
+    es_config = ES_CONFIGS[effect_size_type]
+    state['analysis_data'] = analysis_data
+    state['es_config'] = es_config
+    state['effect_col'] = es_config['effect_col']
+    state['var_col'] = es_config['var_col']
+    state['se_col'] = es_config['se_col']
+
+    analysis_data.to_csv(os.path.join(output_dir, 'effect_sizes.csv'), index=False)
+    return calculation_log
+
+
+def _stage_tau(state, config, output_dir):
+    from .heterogeneity import compare_tau_estimators
+
+    effect_col, var_col = state['effect_col'], state['var_col']
+    data = state['analysis_data'].dropna(subset=[effect_col, var_col])
+    data = data[data[var_col] > 0]
+    comparison = compare_tau_estimators(data, effect_col, var_col)
+    comparison.to_csv(os.path.join(output_dir, 'tau_estimators.csv'), index=False)
+    state['tau_estimators'] = comparison
+    return {
+        'method': config['tau_method'],
+        'estimates': dict(zip(comparison['Method'], comparison['τ²'])),
+    }
+
+
+def _stage_overall(state, config, output_dir):
+    from .overall import run_overall_analysis
+
+    overall_results = run_overall_analysis(
+        state['analysis_data'], state['effect_col'], state['var_col'], state['se_col'],
+        tau_method=config['tau_method'], use_knapp_hartung=config['use_knapp_hartung']
+    )
+    state['overall_results'] = overall_results
+
+    if config['figures']['study_forest'] and 'overall' in state['figure_stages']:
+        with state['plot_lock']:
+            from .plotting import study_forest_table, save_forest_pages
+            rows = study_forest_table(state['analysis_data'], state['effect_col'], state['var_col'],
+                                      tau_squared=overall_results['tau_squared'])
+            rows['summary'] = False
+            summary_row = pd.DataFrame([{
+                'label': 'RE Model',
+                'effect': overall_results['pooled_effect_random'],
+                'ci_lower': overall_results['ci_lower_random_reported'],
+                'ci_upper': overall_results['ci_upper_random_reported'],
+                'summary': True,
+            }])
+            figures_dir = os.path.join(output_dir, 'figures')
+            os.makedirs(figures_dir, exist_ok=True)
+            save_forest_pages(
+                pd.concat([rows, summary_row], ignore_index=True),
+                os.path.join(figures_dir, 'study_forest'),
+                rows_per_page=config['figures']['forest_rows_per_page'],
+                formats=config['figures']['formats'], dpi=config['figures']['dpi'],
+                summary_col='summary', weight_col='weight'
+            )
+    return overall_results
+
+
+def _stage_three_level(state, config, output_dir):
+    from .three_level import run_three_level_reml
+
+    estimates, data_lists, optimizer_result = run_three_level_reml(
+        state['analysis_data'], state['effect_col'], state['var_col'],
+        ci_method=config['variance_ci'], n_jobs=config['loo']['n_jobs'], **config['three_level']
+    )
+    if estimates is None:
+        raise RuntimeError("REML optimization failed to converge.")
+
+    N_total, M_studies = data_lists[3], data_lists[4]
+    mu, se_mu = estimates['mu'], estimates['se_mu']
+    tau_sq, sigma_sq = estimates['tau_sq'], estimates['sigma_sq']
+    total_var = tau_sq + sigma_sq
+    k_params = 3
+
+    three_level_results = {
+        'status': 'completed',
+        'k_obs': N_total,
+        'k_studies': M_studies,
+        'pooled_effect': mu,
+        'se': se_mu,
+        'var': estimates['var_mu'],
+        'ci_lower': mu - 1.96 * se_mu,
+        'ci_upper': mu + 1.96 * se_mu,
+        'p_value': 2 * (1 - _norm_cdf(abs(mu / se_mu))),
+        'tau_squared': tau_sq,
+        'se_tau_sq': estimates.get('se_tau_sq'),
+        'ci_lower_tau_sq': estimates.get('ci_lower_tau_sq'),
+        'ci_upper_tau_sq': estimates.get('ci_upper_tau_sq'),
+        'sigma_squared': sigma_sq,
+        'se_sigma_sq': estimates.get('se_sigma_sq'),
+        'ci_lower_sigma_sq': estimates.get('ci_lower_sigma_sq'),
+        'ci_upper_sigma_sq': estimates.get('ci_upper_sigma_sq'),
+        'variance_ci_method': estimates.get('ci_method'),
+        'ICC_level2_pct': (sigma_sq / total_var) * 100 if total_var > 0 else 0.0,
+        'ICC_level3_pct': (tau_sq / total_var) * 100 if total_var > 0 else 0.0,
+        'log_lik_reml': estimates['log_lik_reml'],
+        'log_lik_ml': estimates['log_lik_ml'],
+        'AIC': (2 * k_params) - (2 * estimates['log_lik_ml']),
+        'BIC': (k_params * np.log(N_total)) - (2 * estimates['log_lik_ml']),
+        'optimizer_iterations': int(getattr(optimizer_result, 'nit', 0)),
+    }
+    if 'profile' in estimates and 'three_level' in state['figure_stages']:
+        with state['plot_lock']:
+            from .plotting import plot_profile_likelihood
+            state['save_figure'](plot_profile_likelihood(estimates['profile']), 'profile_likelihood')
+
+    if config['bootstrap']['n_boot'] > 0:
+        from .bootstrap import run_three_level_bootstrap
+        boot = run_three_level_bootstrap(
+            state['analysis_data'], state['effect_col'], state['var_col'],
+            n_boot=config['bootstrap']['n_boot'], seed=config['bootstrap']['seed'],
+            n_jobs=config['loo']['n_jobs'], bca=config['bootstrap']['bca'], **config['three_level']
+        )
+        boot['intervals'].to_csv(os.path.join(output_dir, 'three_level_bootstrap.csv'))
+        three_level_results['bootstrap'] = {
+            'intervals': boot['intervals'].to_dict(orient='index'),
+            'n_failed': boot['n_failed'],
+            'seed': boot['seed'],
+        }
+
+    state['three_level_results'] = three_level_results
+    return three_level_results
+
+
+def _norm_cdf(x):
+    from scipy.stats import norm
+    return norm.cdf(x)
+
+
+def _stage_subgroups(state, config, output_dir):
+    from .subgroups import find_valid_groups, run_subgroup_analysis
+
+    summaries = []
+    for subgroup in config['subgroups']:
+        moderator1 = subgroup['moderator1']
+        moderator2 = subgroup.get('moderator2')
+        label = moderator1 if moderator2 is None else f"{moderator1}_x_{moderator2}"
+
+        valid_groups_list = find_valid_groups(
+            state['analysis_data'], moderator1, moderator2,
+            min_papers=subgroup.get('min_papers', 2), min_obs=subgroup.get('min_obs', 2)
+        )
+        if len(valid_groups_list) < 2:
+            raise ValueError(f"Only {len(valid_groups_list)} group(s) of '{label}' meet the criteria; need at least 2.")
+
+        subgroup_results = run_subgroup_analysis(
+            state['analysis_data'], state['effect_col'], state['var_col'],
+            moderator1, moderator2, valid_groups_list,
+            state['overall_results']['Qt'],
+            has_fold_change=state['es_config'].get('has_fold_change', False),
+            n_jobs=subgroup.get('n_jobs', config['loo']['n_jobs']),
+            **config['three_level']
+        )
+        results_df = subgroup_results.pop('results_df')
+        results_df.to_csv(os.path.join(output_dir, f'subgroups_{label}.csv'), index=False)
+
+        if 'subgroups' in state['figure_stages']:
+            with state['plot_lock']:
+                from .plotting import plot_subgroup_forest
+                fig = plot_subgroup_forest(
+                    results_df,
+                    overall_effect=state.get('three_level_results', {}).get('pooled_effect'),
+                    null_value=state['es_config']['null_value'],
+                    x_label=state['es_config']['effect_label']
+                )
+                state['save_figure'](fig, f'forest_{label}')
+
+        subgroup_results['n_groups'] = len(results_df)
+        summaries.append(subgroup_results)
+    return summaries
+
+
+def _stage_regression(state, config, output_dir):
+    from .regression import (run_cluster_robust_regression, run_three_level_reml_regression,
+                             candidate_moderators, screen_moderators)
+
+    effect_col, var_col = state['effect_col'], state['var_col']
+    rows = []
+    for moderator in config['regression']['moderators']:
+        reg_df = state['analysis_data'].copy()
+        reg_df[moderator] = pd.to_numeric(reg_df[moderator], errors='coerce')
+        reg_df = reg_df.dropna(subset=[effect_col, var_col, 'id', moderator])
+        reg_df = reg_df[reg_df[var_col] > 0]
+        if len(reg_df) < 3:
+            raise ValueError(f"Not enough data (k={len(reg_df)}) for meta-regression on '{moderator}'.")
+
+        results = run_cluster_robust_regression(
+            reg_df, moderator, effect_col, var_col, 'id',
+            state['overall_results']['tau_squared'], QT=state['overall_results']['Qt'],
+            n_permutations=config['regression']['n_permutations'],
+            seed=config['regression']['seed'], n_jobs=config['loo']['n_jobs'],
+            vcov_type=config['regression']['vcov_type']
+        )
+        rows.append({
+            'moderator': moderator,
+            'k_obs': results['k_obs'],
+            'M_studies': results['M_studies'],
+            'df': results['df'],
+            'vcov_type': results['vcov_type'],
+            'df_slope': np.asarray(results['df_coefficients'])[1],
+            'intercept': np.asarray(results['coefficients'])[0],
+            'slope': np.asarray(results['coefficients'])[1],
+            'se_intercept': np.asarray(results['std_errors_robust'])[0],
+            'se_slope': np.asarray(results['std_errors_robust'])[1],
+            'p_intercept': np.asarray(results['p_values_robust'])[0],
+            'p_slope': np.asarray(results['p_values_robust'])[1],
+            'p_slope_perm': np.asarray(results['p_values_perm'])[1] if 'p_values_perm' in results else np.nan,
+            'ci_lower_slope': np.asarray(results['ci_lower_robust'])[1],
+            'ci_upper_slope': np.asarray(results['ci_upper_robust'])[1],
+            'R_squared_adj': results['R_squared_adj'],
+        })
+
+    regression_df = pd.DataFrame(rows)
+    if not regression_df.empty:
+        regression_df.to_csv(os.path.join(output_dir, 'regression.csv'), index=False)
+
+    # --- Moderator screening (every numeric input column, or a given list) ---
+    screening = []
+    screen = config['regression']['screen']
+    if screen:
+        if screen is True:
+            roles = ['id', 'xe', 'sde', 'ne', 'xc', 'sdc', 'nc']
+            screen = candidate_moderators(state['data_filtered'], exclude=roles)
+        screening_df = screen_moderators(
+            state['analysis_data'], screen, effect_col, var_col, 'id',
+            state['overall_results']['tau_squared'], QT=state['overall_results']['Qt'],
+            vcov_type=config['regression']['vcov_type'],
+            df_method='satterthwaite' if config['regression']['vcov_type'] == 'CR2' else 'residual',
+            n_jobs=config['loo']['n_jobs']
+        )
+        screening_df.to_csv(os.path.join(output_dir, 'moderator_screening.csv'), index=False)
+        screening = screening_df.to_dict(orient='records')
+
+    # --- Multi-moderator three-level models ---
+    three_level = state.get('three_level_results', {})
+    start_params = (three_level['tau_squared'], three_level['sigma_squared']) if three_level else None
+    models = []
+    for model in config['regression']['three_level_models']:
+        moderators = model['moderators']
+        label = model.get('label', '_'.join(moderators))
+        estimates, dims, _ = run_three_level_reml_regression(
+            state['analysis_data'], moderators, effect_col, var_col,
+            start_params=start_params, categorical=model.get('categorical'),
+            interactions=model.get('interactions'), reference=model.get('reference')
+        )
+        if estimates is None:
+            raise RuntimeError(f"Three-level meta-regression '{label}' failed to converge.")
+        pd.DataFrame({
+            'term': estimates['coef_names'],
+            'estimate': estimates['betas'],
+            'se': estimates['se_betas'],
+            'z': estimates['z_stats'],
+            'p_value': estimates['p_values'],
+            'ci_lower': estimates['betas'] - 1.96 * estimates['se_betas'],
+            'ci_upper': estimates['betas'] + 1.96 * estimates['se_betas'],
+        }).to_csv(os.path.join(output_dir, f'regression_three_level_{label}.csv'), index=False)
+        models.append({
+            'label': label,
+            'k_obs': dims[0],
+            'M_studies': dims[1],
+            'p_params': dims[2],
+            'tau_squared': estimates['tau_sq'],
+            'sigma_squared': estimates['sigma_sq'],
+            'QM': estimates['QM'],
+            'df_QM': estimates['df_QM'],
+            'p_QM': estimates['p_QM'],
+            'log_lik_reml': estimates['log_lik_reml'],
+        })
+    return {'moderators': rows, 'screening': screening, 'three_level_models': models}
+
+
+def _stage_bias(state, config, output_dir):
+    from .bias import egger_test_three_level, trimfill_analysis, trimfill_batch
+
+    effect_col, var_col, se_col = state['effect_col'], state['var_col'], state['se_col']
+    plot_data = state['analysis_data'].dropna(subset=[effect_col, se_col, 'id'])
+    plot_data = plot_data[plot_data[se_col] > 0]
+    three_level_results = state['three_level_results']
+
+    egger = egger_test_three_level(
+        plot_data, effect_col, var_col, se_col,
+        start_params=(three_level_results['tau_squared'], three_level_results['sigma_squared'])
+    )
+    tau_method = config['tau_method'] if config['tau_method'] in ('DL', 'REML', 'ML', 'PM') else 'REML'
+    trimfill = trimfill_analysis(
+        plot_data, effect_col, var_col,
+        estimator=config['bias']['estimator'], side=config['bias']['side'],
+        max_iter=config['bias']['max_iter'], model=config['bias']['model'],
+        tau_method=tau_method
+    )
+    if config['bias']['grid']:
+        trimfill_grid = trimfill_batch(
+            plot_data, effect_col, var_col, group_col=config['bias']['grid_group_col'],
+            tau_method=tau_method, max_iter=config['bias']['max_iter']
+        )
+        trimfill_grid.to_csv(os.path.join(output_dir, 'trimfill_grid.csv'), index=False)
+
+    if 'bias' in state['figure_stages']:
+        with state['plot_lock']:
+            from .plotting import plot_funnel
+            fig = plot_funnel(
+                plot_data, effect_col, se_col, three_level_results['pooled_effect'],
+                null_value=state['es_config']['null_value'], trimfill_results=trimfill,
+                x_label=f"Effect Size ({state['es_config']['effect_label']})",
+                render=config['figures']['funnel_render']
+            )
+            state['save_figure'](fig, 'funnel')
+
+    trimfill_summary = {key: value for key, value in trimfill.items()
+                        if key not in ('yi_filled', 'vi_filled', 'yi_combined', 'vi_combined',
+                                       'trimmed_index')}
+    return {'egger_test_robust': egger, 'trimfill': trimfill_summary}
+
+
+def _stage_loo(state, config, output_dir):
+    from .three_level import build_study_segments
+    from .sensitivity import run_three_level_loo, loo_results_table
+
+    three_level_results = state['three_level_results']
+    y_sorted, v_sorted, seg_starts, removal_ids = build_study_segments(
+        state['analysis_data'], state['effect_col'], state['var_col']
+    )
+    if len(removal_ids) - 1 < 2:
+        raise ValueError("Not enough studies remain after removing one study.")
+
+    all_estimates = run_three_level_loo(
+        y_sorted, v_sorted, seg_starts,
+        (three_level_results['tau_squared'], three_level_results['sigma_squared']),
+        n_jobs=config['loo']['n_jobs']
+    )
+    results_df = loo_results_table(
+        removal_ids, all_estimates, three_level_results['pooled_effect'],
+        three_level_results['ci_lower'], three_level_results['ci_upper'],
+        null_value=state['es_config']['null_value']
+    )
+    if results_df.empty:
+        raise ValueError("No LOO iterations were successful.")
+    results_df.to_csv(os.path.join(output_dir, 'loo.csv'), index=False)
+
+    if 'loo' in state['figure_stages']:
+        with state['plot_lock']:
+            from .plotting import plot_loo
+            fig = plot_loo(
+                results_df, three_level_results['pooled_effect'],
+                three_level_results['ci_lower'], three_level_results['ci_upper'],
+                null_value=state['es_config']['null_value'],
+                x_label=f"Pooled Effect ({state['es_config']['effect_label']})"
+            )
+            state['save_figure'](fig, 'loo')
+
+    return {
+        'n_refits': len(removal_ids),
+        'n_failed': len(removal_ids) - len(results_df),
+        'effect_min': results_df['pooled_effect'].min(),
+        'effect_max': results_df['pooled_effect'].max(),
+        'n_sig_changers': int(results_df['changes_sig'].sum()),
+    }
+
+
+def _stage_cumulative(state, config, output_dir):
+    from .sensitivity import aggregate_by_study, run_cumulative_engine
+
+    settings = config['cumulative']
+    effect_col, var_col = state['effect_col'], state['var_col']
+    year_col = settings['year_col']
+
+    data = state['analysis_data']
+    if year_col not in data.columns:
+        raise ValueError(f"'{year_col}' column not found. Ensure data has publication years.")
+    data = data.copy()
+    data['year'] = pd.to_numeric(data[year_col], errors='coerce')
+    data = data.dropna(subset=['year'])
+    if len(data) < 2:
+        raise ValueError("Insufficient data with valid years. Need at least 2.")
+
+    if settings['unit'] == 'study':
+        data_sorted = aggregate_by_study(data, effect_col, var_col)
+    else:
+        data_sorted = data[[effect_col, var_col, 'year', 'id']].copy()
+    data_sorted = data_sorted.sort_values('year', ascending=(settings['sort_order'] == 'ascending'))
+
+    results_df = run_cumulative_engine(
+        data_sorted[effect_col].values.astype(float),
+        data_sorted[var_col].values.astype(float),
+        data_sorted['year'].values,
+        data_sorted['id'].values,
+        tau_method='DL' if config['tau_method'] == 'DL' else 'REML'
+    )
+    results_df.to_csv(os.path.join(output_dir, 'cumulative.csv'), index=False)
+
+    if 'cumulative' in state['figure_stages']:
+        with state['plot_lock']:
+            from .plotting import plot_cumulative
+            fig = plot_cumulative(results_df, null_value=state['es_config']['null_value'],
+                                  y_label=f"Pooled Effect ({state['es_config']['effect_label']})")
+            state['save_figure'](fig, 'cumulative')
+
+    final = results_df.iloc[-1]
+    return {
+        'n_steps': len(results_df),
+        'final_effect': final['pooled_effect'],
+        'final_ci_lower': final['ci_lower'],
+        'final_ci_upper': final['ci_upper'],
+    }
+
+
+_STAGE_FUNCTIONS = {
+    'clean': _stage_clean,
+    'effect_sizes': _stage_effect_sizes,
+    'tau': _stage_tau,
+    'overall': _stage_overall,
+    'three_level': _stage_three_level,
+    'subgroups': _stage_subgroups,
+    'regression': _stage_regression,
+    'bias': _stage_bias,
+    'loo': _stage_loo,
+    'cumulative': _stage_cumulative,
+}
+
+
+# --- 3. RUNNER ---
+
+def _to_jsonable(obj):
+    """Recursively convert results to JSON-serializable values (NaN -> None)."""
+    if isinstance(obj, dict):
+        return {str(key): _to_jsonable(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_to_jsonable(value) for value in obj]
+    if isinstance(obj, pd.Series):
+        return _to_jsonable(obj.to_dict())
+    if isinstance(obj, pd.DataFrame):
+        return _to_jsonable(obj.to_dict(orient='records'))
+    if isinstance(obj, np.ndarray):
+        return _to_jsonable(obj.tolist())
+    if isinstance(obj, (np.bool_, bool)):
+        return bool(obj)
+    if isinstance(obj, (np.integer, int)):
+        return int(obj)
+    if isinstance(obj, (np.floating, float)):
+        return None if not np.isfinite(obj) else float(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if obj is None or isinstance(obj, str):
+        return obj
+    return str(obj)
+
+
+def _config_value(config, key):
+    value = config
+    for part in key.split('.'):
+        value = value[part]
+    return value
+
+
+def _stage_fingerprint(stage, state, config, output_dir, tokens):
+    """Hash of everything a stage's results depend on."""
+    from . import __version__
+    spec = STAGE_SPECS[stage]
+    parts = {
+        'version': [_STAGE_CACHE_VERSION, __version__],
+        'stage': stage,
+        'inputs': {key: tokens.get(key) for key in spec['inputs'] + spec.get('optional', ())},
+        'config': {key: _config_value(config, key) for key in spec['config']},
+        'output_dir': os.path.abspath(output_dir),
+        'figures': stage in state['figure_stages'],
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _load_stage_cache(output_dir):
+    try:
+        with open(os.path.join(output_dir, _STAGE_CACHE_FILE), 'rb') as f:
+            cache = pickle.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return {}
+
+
+def _save_stage_cache(output_dir, cache):
+    try:
+        payload = pickle.dumps(cache, protocol=pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        logger.warning("  stage cache not saved: %s", e)
+        return
+    # Write to a temporary file and rename so a killed run never leaves a partial cache
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=output_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, os.path.join(output_dir, _STAGE_CACHE_FILE))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    except OSError as e:
+        logger.warning("  stage cache not saved: %s", e)
+
+
+def _execute_stage(stage, state, config, output_dir):
+    """
+    Run one stage on a view of `state` holding only its declared inputs;
+    returns its status and, on success, its result, outputs and figures.
+    """
+    spec = STAGE_SPECS[stage]
+    view = {key: state[key] for key in spec['inputs']}
+    view.update({key: state[key] for key in spec.get('optional', ()) if key in state})
+    figures = {}
+
+    def save_figure(fig, name):
+        figures[name] = fig
+        state['save_figure'](fig, name)
+
+    view.update(figure_stages=state['figure_stages'], plot_lock=state['plot_lock'],
+                save_figure=save_figure)
+
+    from .perf import perf_section, perf_summary
+
+    start = time.perf_counter()
+    record = None
+    profiler = cProfile.Profile() if config['perf']['profile'] else None
+    with perf_section(stage, kind='stage', keep=False) as perf_record:
+        try:
+            if profiler is not None:
+                profiler.enable()
+            try:
+                result = _STAGE_FUNCTIONS[stage](view, config, output_dir)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+            record = {'result': result, 'outputs': {key: view[key] for key in spec['outputs']},
+                      'figures': figures}
+            status = {'status': 'ok'}
+        except Exception as e:
+            status = {'status': 'failed', 'error': f"{type(e).__name__}: {e}",
+                      'traceback': traceback.format_exc()}
+    status['seconds'] = time.perf_counter() - start
+    if perf_record is not None:
+        status['perf'] = perf_summary(perf_record)
+        state['perf_records'].append(perf_record)
+    if profiler is not None:
+        state['profilers'].append(profiler)
+    return status, record
+
+
+def _run_stage_graph(state, config, output_dir, run_record, cache, use_cache=True):
+    """
+    Run the enabled stages in dependency order.
+
+    A stage starts as soon as the stages it depends on have finished, so
+    independent stages (subgroups, regression, bias, LOO, cumulative) run
+    concurrently on config['stage_workers'] threads. A stage whose input
+    fingerprint matches its entry in `cache` is not rerun: its outputs,
+    result and figures are restored from the cache.
+    """
+    from .fit_cache import data_fingerprint
+
+    statuses = run_record['stages']
+    tokens = {'raw_data': data_fingerprint(state['raw_data'])}
+
+    def finish(stage, fingerprint, status, record):
+        status['fingerprint'] = fingerprint
+        statuses[stage] = status
+        if record is None:
+            cache.pop(stage, None)
+            logger.error("  %-13s FAILED (%.2fs): %s", stage, status['seconds'], status['error'])
+            return
+        state.update(record['outputs'])
+        tokens.update({key: f'{fingerprint}:{key}' for key in record['outputs']})
+        run_record['results'][stage] = record['result']
+        cache[stage] = dict(record, fingerprint=fingerprint)
+        if status.get('up_to_date'):
+            logger.info("  %-13s up to date", stage)
+        else:
+            logger.info("  %-13s ok (%.2fs)", stage, status['seconds'])
+
+    pending = list(STAGES)
+    running = {}
+    # Profiles of concurrent stages would mix (and newer Pythons allow only
+    # one active profiler), so profiled runs go one stage at a time
+    workers = 1 if config['perf']['profile'] else config['stage_workers']
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            # STAGES is in dependency order, so one pass starts everything that is ready
+            for stage in list(pending):
+                if stage not in config['stages']:
+                    statuses[stage] = {'status': 'disabled'}
+                    pending.remove(stage)
+                    continue
+                if any(dep not in statuses
+                       for dep in STAGE_DEPENDENCIES[stage] + OPTIONAL_DEPENDENCIES[stage]):
+                    continue
+                pending.remove(stage)
+                blocked_by = [dep for dep in STAGE_DEPENDENCIES[stage]
+                              if statuses[dep]['status'] != 'ok']
+                if blocked_by:
+                    statuses[stage] = {'status': 'skipped', 'blocked_by': blocked_by}
+                    logger.warning("  %-13s skipped (needs %s)", stage, ', '.join(blocked_by))
+                    continue
+
+                fingerprint = _stage_fingerprint(stage, state, config, output_dir, tokens)
+                cached = cache.get(stage) if use_cache else None
+                if cached is not None and cached['fingerprint'] == fingerprint:
+                    with state['plot_lock']:
+                        for name, fig in cached['figures'].items():
+                            state['save_figure'](fig, name)
+                    finish(stage, fingerprint, {'status': 'ok', 'up_to_date': True, 'seconds': 0.0},
+                           cached)
+                    continue
+                running[pool.submit(_execute_stage, stage, state, config, output_dir)] = (stage, fingerprint)
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, fingerprint = running.pop(future)
+                finish(stage, fingerprint, *future.result())
+
+    # Report in pipeline order rather than completion order
+    state['perf_records'].sort(key=lambda record: STAGES.index(record['name']))
+    run_record['stages'] = {stage: statuses[stage] for stage in STAGES}
+    run_record['results'] = {stage: run_record['results'][stage] for stage in STAGES
+                             if stage in run_record['results']}
+
+
+def run_pipeline(config, raw_data, output_dir, figures=True, source_info=None, stage_cache=None):
+    """
+    Run the configured stages on one dataset.
+
+    Parameters:
+    -----------
+    config : dict
+        Output of load_config()
+    raw_data : DataFrame
+        Raw input table (before column mapping)
+    output_dir : str
+        Directory for tables, figures and results.json (created if missing)
+    figures : bool
+        Write figures for the stages that have them
+    source_info : dict or None
+        Input provenance from load_table(), recorded in results.json
+    stage_cache : dict, None or False
+        Results of earlier runs by stage; stages whose input fingerprint is
+        unchanged are restored instead of rerun. None keeps the cache in
+        OUTPUT_DIR/.stage_cache.pkl, a dict (e.g. held by a notebook) is
+        used and updated in place, False reruns every stage.
+
+    Returns:
+    --------
+    dict : {'stages': {stage: {'status', 'seconds', 'fingerprint', 'error'}}, 'results': {...}}
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    figure_settings = config['figures']
+
+    # Several inputs in one run often share fits (same data, other outputs)
+    from .fit_cache import configure_fit_cache, fit_cache_info
+    configure_fit_cache(**config['fit_cache'])
+    fit_counts = fit_cache_info()
+    from .perf import enable_perf
+    perf_settings = config['perf']
+    previous_perf = enable_perf(perf_settings['enabled'] or perf_settings['profile'],
+                                memory=perf_settings['memory'])
+    figures_dir = os.path.join(output_dir, 'figures')
+
+    figure_exports = {}
+
+    def save_figure(fig, name):
+        # Rendered in the background while later stages run; unchanged
+        # figures are copied from the figure cache
+        import matplotlib.pyplot as plt
+        from .export import submit_figure
+        figure_exports[name] = (fig, submit_figure(
+            fig, os.path.join(figures_dir, name), formats=figure_settings['formats'],
+            dpi=figure_settings['dpi'], cache_dir=figure_settings['cache_dir'],
+            n_jobs=max(1, config['loo']['n_jobs'])
+        ))
+        plt.close(fig)
+
+    state = {
+        'raw_data': raw_data,
+        'figure_stages': set(STAGES) if figures else set(),
+        'save_figure': save_figure,
+        'plot_lock': threading.Lock(),
+        'perf_records': [],
+        'profilers': [],
+    }
+    run_record = {
+        'started': datetime.datetime.now(),
+        'input': source_info,
+        'config': config,
+        'stages': {},
+        'results': {},
+    }
+
+    if stage_cache is None:
+        cache = _load_stage_cache(output_dir)
+    else:
+        cache = stage_cache if stage_cache is not False else {}
+    try:
+        _run_stage_graph(state, config, output_dir, run_record, cache,
+                         use_cache=stage_cache is not False)
+    finally:
+        enable_perf(*previous_perf)
+    if stage_cache is None:
+        _save_stage_cache(output_dir, cache)
+
+    for name, (fig, export) in figure_exports.items():
+        try:
+            export.result()
+        except Exception as e:
+            logger.error("  figure %s not exported: %s: %s", name, type(e).__name__, e)
+    if figure_exports and figure_settings['bundle']:
+        from .export import export_bundle
+        run_record['figure_bundle'] = export_bundle(
+            {name: fig for name, (fig, _) in figure_exports.items()},
+            os.path.join(figures_dir, 'all_figures'), formats=figure_settings['formats'],
+            dpi=figure_settings['dpi'], cache_dir=figure_settings['cache_dir'],
+            n_jobs=max(1, config['loo']['n_jobs'])
+        )['files']
+
+    cache_counts = fit_cache_info()
+    run_record['fit_cache'] = {key: cache_counts[key] - fit_counts[key]
+                               for key in ('hits', 'disk_hits', 'misses')}
+    run_record['finished'] = datetime.datetime.now()
+    if perf_settings['enabled'] or perf_settings['profile']:
+        _write_perf(state, config, output_dir, run_record)
+    with open(os.path.join(output_dir, 'results.json'), 'w', encoding='utf-8') as f:
+        json.dump(_to_jsonable(run_record), f, indent=2, ensure_ascii=False)
+    return run_record
+
+
+def _write_perf(state, config, output_dir, run_record):
+    """
+    Write OUTPUT_DIR/perf.json: one record per stage that ran, with its
+    fits and their optimizer diagnostics nested under it, plus the top
+    functions of the combined profile when profiling.
+    """
+    from .perf import perf_table, profile_table, write_perf_json
+    extra = {'started': run_record['started'], 'stage_workers': config['stage_workers']}
+    if state['profilers']:
+        stats = pstats.Stats(state['profilers'][0])
+        for profiler in state['profilers'][1:]:
+            stats.add(profiler)
+        top = profile_table(stats, top=config['perf']['profile_top'])
+        extra['profile'] = top.to_dict('records')
+        logger.info("  profile (top %d by cumulative time):\n%s",
+                    config['perf']['profile_top'], top.head(10).to_string(index=False))
+    try:
+        write_perf_json(os.path.join(output_dir, 'perf.json'), _to_jsonable(state['perf_records']),
+                        **_to_jsonable(extra))
+    except OSError as e:
+        logger.warning("  perf.json not written: %s", e)
+        return
+    table = perf_table(state['perf_records'])
+    slowest = table[table['kind'] == 'fit'].nlargest(3, 'seconds')
+    for _, row in slowest.iterrows():
+        logger.info("  slowest fit %-40s %.2fs (%.0f%% likelihood, %d evals)", row['path'],
+                    row['seconds'], row['likelihood_pct'], row['likelihood_evals'])
+
+
+def main(argv=None):
+    """Command-line entry point; returns the process exit status."""
+    parser = argparse.ArgumentParser(
+        prog='python -m meta',
+        description="Run the meta-analysis pipeline headlessly on one or more datasets."
+    )
+    parser.add_argument('config', help="Pipeline config (.json or .toml)")
+    parser.add_argument('inputs', nargs='+', help="Input tables (.csv, .tsv, .parquet, .xlsx)")
+    parser.add_argument('-o', '--output-dir', default='meta_results',
+                        help="Output directory; one sub-directory per input when several are given")
+    parser.add_argument('--sheet', default=0, help="Worksheet name for Excel inputs")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, help="Run only these stages")
+    parser.add_argument('--n-jobs', type=int, help="Worker processes for leave-one-out, subgroup fits, bootstrap and permutations")
+    parser.add_argument('--no-figures', action='store_true', help="Skip figure export")
+    parser.add_argument('--cache-dir', help="Typed-input cache directory (default ~/.cache/meta/data)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Always re-read inputs and rerun every stage")
+    parser.add_argument('--profile', action='store_true',
+                        help="Profile every stage (cProfile); top functions go to perf.json")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Only log warnings and errors")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    try:
+        config = load_config(args.config)
+    except (OSError, ValueError, KeyError) as e:
+        logger.error("Invalid config %s: %s", args.config, e)
+        return EXIT_CONFIG_ERROR
+    if args.stages:
+        config['stages'] = args.stages
+    if args.n_jobs:
+        config['loo']['n_jobs'] = args.n_jobs
+    if args.profile:
+        config['perf']['profile'] = True
+
+    if not args.no_figures:
+        import matplotlib
+        matplotlib.use('Agg')
+
+    from .data import load_table
+
+    exit_status = EXIT_OK
+    for input_path in args.inputs:
+        name = os.path.splitext(os.path.basename(input_path))[0]
+        output_dir = args.output_dir if len(args.inputs) == 1 else os.path.join(args.output_dir, name)
+        logger.info("%s -> %s", input_path, output_dir)
+
+        try:
+            raw_data, source_info = load_table(input_path, sheet_name=args.sheet,
+                                               cache_dir=args.cache_dir, use_cache=not args.no_cache)
+        except Exception as e:
+            logger.error("  could not read %s: %s", input_path, e)
+            exit_status = max(exit_status, EXIT_INPUT_ERROR)
+            continue
+        logger.info("  loaded %d rows (%s)", len(raw_data),
+                    'cache hit' if source_info['cache_hit'] else 'parsed')
+
+        run_record = run_pipeline(config, raw_data, output_dir, figures=not args.no_figures,
+                                  source_info=source_info,
+                                  stage_cache=False if args.no_cache else None)
+        if any(stage['status'] in ('failed', 'skipped') for stage in run_record['stages'].values()):
+            exit_status = max(exit_status, EXIT_STAGE_FAILED)
+
+    return exit_status
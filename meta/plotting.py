@@ -0,0 +1,544 @@
+"""
+Figures for the analysis stages.
+
+Each function draws one figure and returns it without showing or saving,
+so the notebook cells and the batch runner can decide what to do with it.
+Defaults match the notebook widgets.
+
+Usage:
+    fig = plot_funnel(data, 'lnRR', 'SE_lnRR', pooled_effect)
+    save_figure(fig, 'out/funnel', formats=('pdf', 'png'), dpi=300)
+
+Study-level forests with thousands of rows go through save_forest_pages,
+which writes one multi-page PDF.
+"""
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.lines import Line2D
+from matplotlib.patches import Patch
+from scipy.stats import norm
+
+__all__ = [
+    'FUNNEL_CONTOUR_LEVELS',
+    'funnel_contour_regions',
+    'plot_funnel',
+    'plot_subgroup_forest',
+    'study_forest_table',
+    'forest_x_limits',
+    'plot_forest',
+    'save_forest_pages',
+    'plot_loo',
+    'plot_cumulative',
+    'plot_profile_likelihood',
+    'save_figure',
+]
+
+
+FUNNEL_CONTOUR_LEVELS = ((0.10, '#F2F2F2'), (0.05, '#DADADA'), (0.01, '#C4C4C4'))
+
+def funnel_contour_regions(null_value, se_max, x_limits, levels=FUNNEL_CONTOUR_LEVELS):
+    """
+    Contour-enhanced funnel regions as polygons.
+
+    The two-sided p-value of an effect y with standard error s is below
+    p when |y - null_value| > z_{1-p/2} * s, so every region between two
+    significance levels is bounded by straight lines through
+    (null_value, 0): each side is one quadrilateral (the outermost one is
+    closed by the x-axis limits). The polygons depend only on se_max and
+    the axis limits, not on the number of studies.
+
+    Returns:
+    --------
+    list : (label, color, [left polygon, right polygon]) per level, each
+           polygon an (n, 2) array of (effect, SE) vertices
+    """
+    x_min, x_max = x_limits
+    regions = []
+    for i, (p, color) in enumerate(levels):
+        z_inner = norm.ppf(1 - p / 2)
+        z_outer = norm.ppf(1 - levels[i + 1][0] / 2) if i + 1 < len(levels) else None
+        polygons = []
+        for sign, x_edge in ((-1, x_min), (1, x_max)):
+            inner = (null_value + sign * z_inner * se_max, se_max)
+            if z_outer is None:
+                outer = [(x_edge, se_max), (x_edge, 0.0)]
+            else:
+                outer = [(null_value + sign * z_outer * se_max, se_max)]
+            polygons.append(np.array([(null_value, 0.0), inner] + outer))
+        label = f'p < {p:g}' if z_outer is None else f'{levels[i + 1][0]:g} < p < {p:g}'
+        regions.append((label, color, polygons))
+    return regions
+
+def plot_funnel(plot_data, effect_col, se_col, pooled_effect, null_value=0,
+                trimfill_results=None, show_ci_funnel=True, show_contours=True,
+                title="Funnel Plot for Publication Bias", x_label="Effect Size",
+                y_label="Standard Error (Inverted)", point_color='#4A90E2', point_alpha=0.7,
+                width=8.0, height=7.0, show_grid=True, render='auto', raster_threshold=2000,
+                gridsize=60):
+    """
+    Funnel plot of effect vs. standard error around the pooled effect.
+
+    trimfill_results (output of trimfill_analysis) adds the imputed studies.
+    show_contours shades the contour-enhanced significance regions
+    (funnel_contour_regions), drawn as one polygon collection.
+
+    render controls how the studies are drawn:
+      'points'  one vector marker per study
+      'raster'  the marker layer is rasterized (also inside PDFs), so
+                file size and render time stay flat as k grows
+      'hexbin'  2-D density of studies (log counts) instead of markers
+      'auto'    'points' up to raster_threshold studies, else 'raster'
+    """
+    fig, ax = plt.subplots(figsize=(width, height))
+
+    effects = np.asarray(plot_data[effect_col], dtype=float)
+    ses = np.asarray(plot_data[se_col], dtype=float)
+    k = len(effects)
+    if render == 'auto':
+        render = 'points' if k <= raster_threshold else 'raster'
+
+    se_max = ses.max() * 1.1
+    se_ends = np.array([0.0, se_max])
+
+    # x-range: data, imputed studies and the funnel at se_max
+    x_values = [effects.min(), effects.max(), pooled_effect - 1.96 * se_max,
+                pooled_effect + 1.96 * se_max]
+    if trimfill_results is not None and trimfill_results.get('k0', 0) > 0:
+        x_values += [np.min(trimfill_results['yi_filled']), np.max(trimfill_results['yi_filled'])]
+    x_pad = 0.05 * (max(x_values) - min(x_values))
+    x_limits = (min(x_values) - x_pad, max(x_values) + x_pad)
+
+    # --- Contour-enhanced significance regions ---
+    if show_contours:
+        regions = funnel_contour_regions(null_value, se_max, x_limits)
+        polygons = [polygon for _, _, pair in regions for polygon in pair]
+        colors = [color for _, color, pair in regions for _ in pair]
+        ax.add_collection(PolyCollection(polygons, facecolors=colors, edgecolors='none',
+                                         zorder=0))
+        contour_handles = [Patch(facecolor=color, edgecolor='gray', linewidth=0.5, label=label)
+                           for label, color, _ in regions]
+    else:
+        contour_handles = []
+
+    # --- 95% CI funnel (straight lines: two vertices each) ---
+    if show_ci_funnel:
+        upper_ci = pooled_effect + 1.96 * se_ends
+        lower_ci = pooled_effect - 1.96 * se_ends
+        ax.plot(upper_ci, se_ends, color='gray', linestyle='--', linewidth=1.5, label='95% CI', alpha=0.7)
+        ax.plot(lower_ci, se_ends, color='gray', linestyle='--', linewidth=1.5, alpha=0.7)
+        if not show_contours:
+            ax.fill_betweenx(se_ends, lower_ci, upper_ci, color='lightgray', alpha=0.2)
+
+    if render == 'hexbin':
+        hexes = ax.hexbin(effects, ses, gridsize=gridsize, bins='log', cmap='Blues', mincnt=1,
+                          extent=(*x_limits, 0.0, se_max), linewidths=0.2, zorder=3)
+        fig.colorbar(hexes, ax=ax, label='Studies per cell (log scale)', pad=0.02)
+    elif render == 'raster':
+        # Line2D markers go through the renderer's fast draw_markers path
+        marker_size = max(2.0, np.sqrt(40 * raster_threshold / k))
+        ax.plot(effects, ses, linestyle='none', marker='o', markersize=marker_size,
+                color=point_color, alpha=point_alpha, markeredgewidth=0, label='Studies',
+                rasterized=True, zorder=3)
+    else:
+        ax.scatter(effects, ses, s=40, c=point_color, alpha=point_alpha, edgecolors='black',
+                   linewidths=0.5, label='Studies', zorder=3)
+
+    if trimfill_results is not None and trimfill_results.get('k0', 0) > 0:
+        ax.scatter(trimfill_results['yi_filled'], np.sqrt(trimfill_results['vi_filled']),
+                   s=40, marker='s', facecolors='none', edgecolors='red', linewidths=1,
+                   label=f"Imputed (trim-and-fill, k0={trimfill_results['k0']})",
+                   rasterized=trimfill_results['k0'] > raster_threshold, zorder=3)
+
+    ax.axvline(x=pooled_effect, color='red', linestyle='-', linewidth=2,
+               label=f'3-Level Pooled Effect ({pooled_effect:.3f})', zorder=2)
+
+    ax.set_xlim(*x_limits)
+    ax.set_ylim(0.0, se_max)
+    ax.set_xlabel(x_label, fontsize=12, fontweight='bold')
+    ax.set_ylabel(y_label, fontsize=12, fontweight='bold')
+    if title:
+        ax.set_title(title, fontsize=14, fontweight='bold', pad=15)
+    ax.invert_yaxis()
+    if show_grid:
+        ax.grid(True, linestyle=':', alpha=0.4, zorder=0)
+    handles, _ = ax.get_legend_handles_labels()
+    ax.legend(handles=handles + contour_handles, loc='best', fontsize=10, framealpha=0.9)
+    fig.tight_layout()
+    return fig
+
+
+def plot_subgroup_forest(results_df, overall_effect=None, null_value=0,
+                         title="Subgroup Analysis (Three-Level Model)", x_label="Effect Size",
+                         width=10.0):
+    """
+    Forest plot of the subgroup pooled effects (output of run_subgroup_analysis).
+    """
+    plot_df = results_df.sort_values('pooled_effect_re').reset_index(drop=True)
+    n = len(plot_df)
+    y_positions = np.arange(n)
+
+    fig, ax = plt.subplots(figsize=(width, max(4, n * 0.4 + 2)))
+
+    effects = plot_df['pooled_effect_re'].values
+    xerr = np.vstack([effects - plot_df['ci_lower_re'].values,
+                      plot_df['ci_upper_re'].values - effects])
+    ax.errorbar(effects, y_positions, xerr=xerr, fmt='s', capsize=3, color='#2E86AB',
+                ecolor='#2E86AB', mec='black', markersize=7, linewidth=1.5, zorder=3)
+
+    if overall_effect is not None:
+        ax.axvline(x=overall_effect, color='darkred', linestyle='--', linewidth=1.5,
+                   label=f'Overall Effect ({overall_effect:.3f})', zorder=1)
+    ax.axvline(x=null_value, color='gray', linestyle='-', linewidth=1, alpha=0.5, zorder=0)
+
+    ax.set_yticks(y_positions)
+    ax.set_yticklabels([f"{g} (k={k})" for g, k in zip(plot_df['group'], plot_df['k'])], fontsize=9)
+    ax.set_xlabel(x_label, fontsize=12, fontweight='bold')
+    if title:
+        ax.set_title(title, fontsize=14, fontweight='bold', pad=15)
+    if overall_effect is not None:
+        ax.legend(loc='best', fontsize=10, framealpha=0.9)
+    ax.grid(axis='x', linestyle=':', alpha=0.4)
+    fig.tight_layout()
+    return fig
+
+
+# --- Forest plot engine ---
+# Every page is drawn with three artists whatever its number of rows: one
+# LineCollection for the CIs (and caps), one scatter for the row markers
+# and one PolyCollection for the summary diamonds. Labels and annotations
+# are tick labels on the left and right axes. A paginated export builds
+# the figure once and only swaps the artists' data between pages.
+
+def study_forest_table(data, effect_col, var_col, label_col='id', level=0.95, tau_squared=0.0):
+    """
+    Study-level forest rows: effect, CI and percentage weight per row of data.
+
+    Returns:
+    --------
+    DataFrame : 'label', 'effect', 'ci_lower', 'ci_upper', 'weight'
+                (inverse-variance weight in %, using 1 / (v + tau_squared))
+    """
+    effects = np.asarray(data[effect_col], dtype=float)
+    variances = np.asarray(data[var_col], dtype=float)
+    half_width = norm.ppf(0.5 + level / 2) * np.sqrt(variances)
+    weights = 1.0 / (variances + tau_squared)
+    return pd.DataFrame({
+        'label': np.asarray(data[label_col]).astype(str),
+        'effect': effects,
+        'ci_lower': effects - half_width,
+        'ci_upper': effects + half_width,
+        'weight': 100.0 * weights / np.nansum(weights),
+    })
+
+def forest_x_limits(rows, ci_lower_col='ci_lower', ci_upper_col='ci_upper', null_value=0,
+                    padding=0.05):
+    """x-axis limits covering every CI and the null value (shared by all pages)."""
+    low = min(np.nanmin(rows[ci_lower_col].values), null_value)
+    high = max(np.nanmax(rows[ci_upper_col].values), null_value)
+    span = (high - low) or 1.0
+    return low - padding * span, high + padding * span
+
+def _forest_figure(n_rows, x_limits, null_value, x_label, title, width, row_height,
+                   color, summary_color, annotations, label_fontsize):
+    fig, ax = plt.subplots(figsize=(width, max(2.5, n_rows * row_height + 1.5)))
+    y_transform = ax.get_yaxis_transform()
+    artists = {
+        'ax': ax,
+        'ci_lines': ax.add_collection(LineCollection([], colors=color, linewidths=1.2, zorder=2)),
+        'points': ax.scatter([], [], marker='s', c=color, edgecolors='black', linewidths=0.5,
+                             zorder=3),
+        'diamonds': ax.add_collection(PolyCollection([], facecolors=summary_color,
+                                                     edgecolors='black', linewidths=0.8,
+                                                     zorder=4)),
+        # One Text per row slot, reused by every page
+        'labels': [ax.text(-0.01, i, '', transform=y_transform, ha='right', va='center',
+                           fontsize=label_fontsize) for i in range(n_rows)],
+        'annotations': [ax.text(1.01, i, '', transform=y_transform, ha='left', va='center',
+                                fontsize=label_fontsize) for i in range(n_rows)]
+                       if annotations else [],
+    }
+    ax.axvline(x=null_value, color='gray', linestyle='-', linewidth=1, alpha=0.7, zorder=1)
+    ax.set_xlim(*x_limits)
+    ax.set_ylim(n_rows - 0.5, -0.5)
+    ax.set_yticks([])
+    ax.set_xlabel(x_label, fontsize=12, fontweight='bold')
+    if title:
+        ax.set_title(title, fontsize=14, fontweight='bold', pad=15)
+    ax.grid(axis='x', linestyle=':', alpha=0.4)
+    return fig, artists
+
+def _draw_forest_page(artists, effects, lower, upper, labels, annotations, summary, sizes,
+                      caps):
+    y = np.arange(len(effects), dtype=float)
+    study = ~summary
+
+    # CI lines (plus caps) as one array of segments
+    segments = [np.stack([np.column_stack([lower[study], y[study]]),
+                          np.column_stack([upper[study], y[study]])], axis=1)]
+    if caps:
+        for x in (lower[study], upper[study]):
+            segments.append(np.stack([np.column_stack([x, y[study] - 0.15]),
+                                      np.column_stack([x, y[study] + 0.15])], axis=1))
+    artists['ci_lines'].set_segments(np.concatenate(segments))
+
+    artists['points'].set_offsets(np.column_stack([effects[study], y[study]]))
+    artists['points'].set_sizes(sizes[study])
+
+    # Summary rows: diamonds spanning the CI
+    y_sum = y[summary]
+    artists['diamonds'].set_verts(np.stack([
+        np.column_stack([lower[summary], y_sum]),
+        np.column_stack([effects[summary], y_sum - 0.35]),
+        np.column_stack([upper[summary], y_sum]),
+        np.column_stack([effects[summary], y_sum + 0.35]),
+    ], axis=1))
+
+    for i, text in enumerate(artists['labels']):
+        in_page = i < len(labels)
+        text.set_text(labels[i] if in_page else '')
+        text.set_fontweight('bold' if in_page and summary[i] else 'normal')
+    for i, text in enumerate(artists['annotations']):
+        text.set_text(annotations[i] if i < len(annotations) else '')
+
+def _forest_page_data(rows, effect_col, ci_lower_col, ci_upper_col, label_col, annotation_col,
+                      summary_col, weight_col, marker_size):
+    effects = rows[effect_col].to_numpy(dtype=float)
+    summary = (rows[summary_col].to_numpy(dtype=bool) if summary_col is not None
+               else np.zeros(len(rows), dtype=bool))
+    if weight_col is not None:
+        weights = rows[weight_col].to_numpy(dtype=float)
+        scale = np.nanmax(np.where(summary, np.nan, weights)) if (~summary).any() else 1.0
+        sizes = marker_size * 3 * np.sqrt(np.nan_to_num(weights / scale, nan=0.0)) + 4
+    else:
+        sizes = np.full(len(rows), float(marker_size))
+    annotations = (rows[annotation_col].astype(str).to_numpy() if annotation_col is not None
+                   else None)
+    return (effects, rows[ci_lower_col].to_numpy(dtype=float),
+            rows[ci_upper_col].to_numpy(dtype=float), rows[label_col].astype(str).to_numpy(),
+            annotations, summary, sizes)
+
+def plot_forest(rows, effect_col='effect', ci_lower_col='ci_lower', ci_upper_col='ci_upper',
+                label_col='label', annotation_col=None, summary_col=None, weight_col=None,
+                null_value=0, x_limits=None, x_label="Effect Size", title=None, width=10.0,
+                row_height=0.3, color='#2E86AB', summary_color='darkred', caps=False,
+                marker_size=30, label_fontsize=9, n_rows=None):
+    """
+    Forest plot of one page of rows (e.g. from study_forest_table).
+
+    All rows are drawn with collection artists, so the cost per row is a
+    few array entries, not a matplotlib call. Rows where summary_col is
+    True are drawn as diamonds (pooled estimates); weight_col scales the
+    study markers. n_rows fixes the page height (default: len(rows)).
+    """
+    if x_limits is None:
+        x_limits = forest_x_limits(rows, ci_lower_col, ci_upper_col, null_value)
+    fig, artists = _forest_figure(n_rows or len(rows), x_limits, null_value, x_label, title,
+                                  width, row_height, color, summary_color,
+                                  annotation_col is not None, label_fontsize)
+    page = _forest_page_data(rows, effect_col, ci_lower_col, ci_upper_col, label_col,
+                             annotation_col, summary_col, weight_col, marker_size)
+    _draw_forest_page(artists, *page, caps)
+    fig.tight_layout()
+    return fig
+
+def save_forest_pages(rows, base_filename, rows_per_page=50, formats=('pdf',), dpi=300,
+                      effect_col='effect', ci_lower_col='ci_lower', ci_upper_col='ci_upper',
+                      label_col='label', annotation_col=None, summary_col=None,
+                      weight_col=None, null_value=0, x_limits=None, x_label="Effect Size",
+                      title=None, width=10.0, row_height=0.3, color='#2E86AB',
+                      summary_color='darkred', caps=False, marker_size=30, label_fontsize=9):
+    """
+    Paginated forest plot for thousands of rows.
+
+    PDF output is a single multi-page file (base_filename.pdf); raster
+    formats get one file per page (base_filename_p001.png, ...). All pages
+    share the x-axis limits and row height. The figure is built once and
+    each page only replaces the data of its collections and tick labels.
+
+    Returns:
+    --------
+    list : Paths written
+    """
+    if x_limits is None:
+        x_limits = forest_x_limits(rows, ci_lower_col, ci_upper_col, null_value)
+    n_pages = max(1, -(-len(rows) // rows_per_page))
+    fig, artists = _forest_figure(rows_per_page, x_limits, null_value, x_label, title, width,
+                                  row_height, color, summary_color, annotation_col is not None,
+                                  label_fontsize)
+    page_data = _forest_page_data(rows, effect_col, ci_lower_col, ci_upper_col, label_col,
+                                  annotation_col, summary_col, weight_col, marker_size)
+
+    # Fit the margins once, to the longest label and annotation of any page
+    labels, annotations = page_data[3], page_data[4]
+    artists['labels'][0].set_text(max(labels, key=len, default=''))
+    artists['labels'][0].set_fontweight('bold')
+    if annotations is not None:
+        artists['annotations'][0].set_text(max(annotations, key=len, default=''))
+    fig.tight_layout()
+
+    saved_files = []
+    pdf = PdfPages(f"{base_filename}.pdf") if 'pdf' in formats else None
+    try:
+        for page in range(n_pages):
+            start, stop = page * rows_per_page, min((page + 1) * rows_per_page, len(rows))
+            _draw_forest_page(artists, *[None if values is None else values[start:stop]
+                                         for values in page_data], caps)
+            if title and n_pages > 1:
+                artists['ax'].set_title(f"{title} ({page + 1}/{n_pages})", fontsize=14,
+                                        fontweight='bold', pad=15)
+            if pdf is not None:
+                pdf.savefig(fig, dpi=dpi)
+            for ext in formats:
+                if ext != 'pdf':
+                    filename = f"{base_filename}_p{page + 1:03d}.{ext}"
+                    fig.savefig(filename, dpi=dpi)
+                    saved_files.append(filename)
+    finally:
+        if pdf is not None:
+            pdf.close()
+            saved_files.insert(0, f"{base_filename}.pdf")
+        plt.close(fig)
+    return saved_files
+
+
+def plot_loo(results_df, original_effect, original_ci_lower, original_ci_upper, null_value=0,
+             sort_by='effect', x_label="Pooled Effect", width=10.0):
+    """
+    Leave-one-out plot: pooled effect and CI with each study removed.
+    """
+    if sort_by == 'effect':
+        plot_df = results_df.sort_values('pooled_effect')
+    elif sort_by == 'influence':
+        plot_df = results_df.sort_values('abs_diff', ascending=False)
+    else:
+        plot_df = results_df.sort_values('unit_removed')
+    plot_df = plot_df.reset_index(drop=True)
+
+    fig, ax = plt.subplots(figsize=(width, max(6, len(plot_df) * 0.3 + 2)))
+    y_positions = np.arange(len(plot_df))
+
+    # One errorbar call per colour instead of one per study
+    changes_sig = plot_df['changes_sig'].values.astype(bool)
+    for mask, color in ((~changes_sig, 'blue'), (changes_sig, 'red')):
+        if not mask.any():
+            continue
+        effects = plot_df['pooled_effect'].values[mask]
+        xerr = np.vstack([effects - plot_df['ci_lower'].values[mask],
+                          plot_df['ci_upper'].values[mask] - effects])
+        ax.errorbar(effects, y_positions[mask], xerr=xerr, fmt='o', capsize=3, color=color,
+                    ecolor=color, mfc=color, mec='black', markersize=5, linewidth=1.5, zorder=3)
+
+    legend_elements = [
+        Line2D([0], [0], marker='o', color='w', markerfacecolor='blue', markeredgecolor='black', markersize=8, label='No significance change'),
+        Line2D([0], [0], marker='o', color='w', markerfacecolor='red', markeredgecolor='black', markersize=8, label='Changes significance'),
+        Line2D([0], [0], color='darkred', linestyle='--', linewidth=2, label=f'Original Effect ({original_effect:.3f})'),
+        plt.Rectangle((0, 0), 1, 1, fc='red', alpha=0.1, label='Original 95% CI')
+    ]
+
+    ax.axvline(x=original_effect, color='darkred', linestyle='--', linewidth=2, zorder=1)
+    ax.axvspan(original_ci_lower, original_ci_upper, color='red', alpha=0.1, zorder=0)
+    ax.axvline(x=null_value, color='gray', linestyle='-', linewidth=1, alpha=0.5, zorder=0)
+
+    ax.set_yticks(y_positions)
+    ax.set_yticklabels(plot_df['unit_removed'], fontsize=8)
+    ax.set_xlabel(x_label, fontsize=12, fontweight='bold')
+    ax.set_ylabel("Study Removed", fontsize=12, fontweight='bold')
+    ax.set_title("Three-Level Leave-One-Out Sensitivity Analysis", fontsize=14, fontweight='bold', pad=15)
+    ax.legend(handles=legend_elements, loc='best', fontsize=10, framealpha=0.9)
+    ax.grid(axis='x', linestyle=':', alpha=0.4)
+    fig.tight_layout()
+    return fig
+
+
+def plot_cumulative(results_df, null_value=0, show_ci=True, show_i2=True,
+                    title="Cumulative Meta-Analysis", x_label="Publication Year",
+                    y_label="Pooled Effect Size", line_color='#2E86AB',
+                    width=12.0, height=6.0):
+    """
+    Cumulative pooled effect (and I²) by year (output of run_cumulative_engine).
+    """
+    fig, ax1 = plt.subplots(figsize=(width, height))
+    ax1.plot(results_df['year'], results_df['pooled_effect'], color=line_color, linewidth=2,
+             marker='o', markersize=5, label='Cumulative Effect', zorder=3)
+
+    if show_ci:
+        ax1.fill_between(results_df['year'], results_df['ci_lower'], results_df['ci_upper'],
+                         color=line_color, alpha=0.2, label='95% CI', zorder=2)
+
+    ax1.axhline(y=null_value, color='gray', linestyle='--', linewidth=1.5, label='Null Effect', zorder=1)
+    ax1.axhline(y=results_df.iloc[-1]['pooled_effect'], color=line_color, linestyle=':',
+                linewidth=2, alpha=0.7, label='Final Effect', zorder=1)
+
+    ax1.set_xlabel(x_label, fontsize=12, fontweight='bold')
+    ax1.set_ylabel(y_label, fontsize=12, fontweight='bold')
+    ax1.grid(True, alpha=0.3)
+    ax1.legend(loc='upper left', frameon=True)
+
+    if show_i2:
+        ax2 = ax1.twinx()
+        ax2.plot(results_df['year'], results_df['I_squared'], color='orange', linestyle='--', alpha=0.7, label='I² (%)')
+        ax2.set_ylabel('Heterogeneity (I²%)', color='orange', fontweight='bold')
+        ax2.set_ylim(0, 100)
+        ax2.legend(loc='upper right')
+
+    if title:
+        ax1.set_title(title, fontsize=14, fontweight='bold', pad=20)
+    fig.tight_layout()
+    return fig
+
+
+def plot_profile_likelihood(profile, line_color='#2E86AB', width=12.0, height=5.0):
+    """
+    Profile REML log-likelihood of τ² and σ² (output of profile_likelihood_ci)
+    with the estimate, the χ² cutoff and the interval bounds. Points more
+    than twice the cutoff drop below the maximum are left out.
+    """
+    fig, axes = plt.subplots(1, 2, figsize=(width, height))
+    threshold = profile['log_lik_reml'] - 0.5 * profile['cutoff']
+    level_pct = profile['level'] * 100
+
+    for ax, name, label in zip(axes, ('tau_sq', 'sigma_sq'),
+                               ('τ² (between-study)', 'σ² (within-study)')):
+        component = profile[name]
+        shown = component['log_lik'] >= profile['log_lik_reml'] - profile['cutoff']
+        ax.plot(component['values'][shown], component['log_lik'][shown], color=line_color,
+                linewidth=2, marker='o', markersize=3, zorder=3)
+        ax.axhline(y=threshold, color='gray', linestyle='--', linewidth=1.5,
+                   label=f'{level_pct:g}% cutoff', zorder=1)
+        ax.axvline(x=component['estimate'], color='darkred', linestyle='--', linewidth=1.5,
+                   label=f"Estimate ({component['estimate']:.4f})", zorder=2)
+        for bound in (component['ci_lower'], component['ci_upper']):
+            if np.isfinite(bound):
+                ax.axvline(x=bound, color='gray', linestyle=':', linewidth=1.5, zorder=2)
+
+        ax.set_xlabel(label, fontsize=12, fontweight='bold')
+        ax.set_ylabel("Profile REML Log-Likelihood", fontsize=12, fontweight='bold')
+        ax.set_title(f"[{component['ci_lower']:.4f}, {component['ci_upper']:.4f}]", fontsize=11)
+        ax.legend(loc='lower right', fontsize=9, framealpha=0.9)
+        ax.grid(True, alpha=0.3)
+
+    fig.suptitle("Profile Likelihood of the Variance Components", fontsize=14, fontweight='bold')
+    fig.tight_layout()
+    return fig
+
+
+def save_figure(fig, base_filename, formats=('pdf', 'png'), dpi=300, transparent=False):
+    """
+    Save a figure as base_filename.<ext> for every format and close it.
+    dpi also sets the resolution of rasterized layers in vector formats.
+
+    Returns:
+    --------
+    list : Paths written
+    """
+    saved_files = []
+    for ext in formats:
+        filename = f"{base_filename}.{ext}"
+        fig.savefig(filename, dpi=dpi, bbox_inches='tight', transparent=transparent)
+        saved_files.append(filename)
+    plt.close(fig)
+    return saved_files
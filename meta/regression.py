@@ -0,0 +1,875 @@
+"""
+Meta-regression engines.
+
+- run_cluster_robust_regression: WLS meta-regression with cluster-robust
+  (study-level) standard errors and optional permutation p-values
+  (cluster_permutation_test).
+- screen_moderators: the same regression for every candidate moderator
+  (candidate_moderators) in one batch, ranked, with FDR / Holm adjusted
+  p-values.
+- run_cluster_robust_spline: natural cubic spline meta-regression with
+  cluster-robust standard errors (requires patsy).
+
+Both use the native sandwich estimators of meta.robust (CR2 with
+Satterthwaite degrees of freedom by default).
+- run_three_level_reml_regression: three-level mixed-effects
+  meta-regression by REML with any number of continuous/categorical
+  moderators and interactions (also used for the robust Egger test).
+"""
+
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+from scipy.linalg import cho_solve, solve_triangular
+from scipy.optimize import minimize
+from scipy.stats import t, norm, chi2
+
+from .fit_cache import cached_fit
+from .perf import instrumented_fit, timed_likelihood
+from .robust import VCOV_TYPES, robust_design, fit_robust_wls, robust_wald_test
+
+# patsy is only needed for the spline basis
+try:
+    import patsy
+    PATSY_AVAILABLE = True
+except ImportError:
+    PATSY_AVAILABLE = False
+
+__all__ = [
+    'run_cluster_robust_regression',
+    'cluster_permutation_test',
+    'candidate_moderators',
+    'screen_moderators',
+    'run_cluster_robust_spline',
+    'build_moderator_matrix',
+    'run_three_level_reml_regression',
+]
+
+
+# --- 1. CLUSTER-ROBUST WLS META-REGRESSION ---
+
+@instrumented_fit('cluster_robust')
+@cached_fit('cluster_robust', whole_frame=True)
+def run_cluster_robust_regression(reg_df, moderator_col, effect_col, var_col, cluster_col, tau_squared,
+                                  QT=None, n_permutations=0, seed=None, n_jobs=1,
+                                  vcov_type='CR2', df_method='satterthwaite'):
+    """
+    Runs a mixed-effects meta-regression using weighted least squares (WLS)
+    and computes cluster-robust standard errors.
+
+    QT is the total heterogeneity Q of the unconditional model
+    (overall_results['Qt']); R² is reported as NaN without it.
+
+    vcov_type is 'CR2' (bias-reduced linearization, the default), 'CR1'
+    or 'CR0'; df_method 'satterthwaite' gives every coefficient its own
+    small-sample degrees of freedom, 'residual' uses M - p for all
+    (vcov_type='CR1', df_method='residual' is the statsmodels estimator).
+
+    With n_permutations > 0 the moderator p-values are also computed by
+    cluster-level permutation (see cluster_permutation_test), which does
+    not rely on a t reference distribution.
+    """
+
+    # --- 1. Prepare data ---
+    moderators = [moderator_col] if isinstance(moderator_col, str) else list(moderator_col)
+    names = ['const'] + moderators
+    y = reg_df[effect_col].to_numpy(dtype=float)
+    X = np.column_stack([np.ones(len(reg_df))] +
+                        [reg_df[m].to_numpy(dtype=float) for m in moderators])
+    weights = 1.0 / (reg_df[var_col].to_numpy(dtype=float) + tau_squared)
+
+    # --- 2. WLS fit with cluster-robust variance ---
+    design = robust_design(X, weights, reg_df[cluster_col])
+    fit = fit_robust_wls(design, y, vcov_type=vcov_type, df_method=df_method)
+
+    # --- 3. Extract all results ---
+    M_studies = design['n_clusters']
+    k_obs = len(reg_df)
+
+    df = M_studies - X.shape[1] # Degrees of freedom
+    if df < 1:
+        warnings.warn(f"Insufficient clusters ({M_studies}) for {X.shape[1]} predictors. Results are unreliable.")
+        df = 1
+
+    betas = pd.Series(fit['coefficients'], index=names)
+
+    # --- 4. Calculate R-squared ---
+    R_squared = _wls_r_squared(y, weights, fit['residuals'], X.shape[1], QT)
+
+    results = {
+        'coefficients': betas,
+        'std_errors_robust': pd.Series(fit['std_errors'], index=names),
+        'var_betas_robust': pd.DataFrame(fit['vcov'], index=names, columns=names),
+        't_stats': pd.Series(fit['t_stats'], index=names),
+        'p_values_robust': pd.Series(fit['p_values'], index=names),
+        'ci_lower_robust': pd.Series(fit['ci_lower'], index=names),
+        'ci_upper_robust': pd.Series(fit['ci_upper'], index=names),
+        'df_coefficients': pd.Series(fit['df'], index=names),
+        'vcov_type': vcov_type,
+        'df_method': df_method,
+        'R_squared_adj': R_squared,
+        'k_obs': k_obs,
+        'M_studies': M_studies,
+        'df': df,
+        'reg_df': reg_df
+    }
+
+    if len(moderators) > 1:
+        results['wald_test'] = robust_wald_test(fit, np.arange(1, len(names)))
+
+    if n_permutations > 0:
+        permutation = cluster_permutation_test(
+            reg_df, moderator_col, effect_col, var_col, cluster_col, tau_squared,
+            n_permutations=n_permutations, seed=seed, n_jobs=n_jobs
+        )
+        results['p_values_perm'] = pd.Series(permutation['p_values'], index=betas.index)
+        results['permutation'] = permutation
+
+    return results
+
+
+def _wls_r_squared(y, weights, residuals, n_params, QT):
+    """
+    Approximate R² (%): QM, the model / residual mean square ratio of the
+    WLS fit, relative to QT. NaN without QT.
+    """
+    if QT is None:
+        return np.nan
+    ssr = np.sum(weights * residuals ** 2)
+    y_bar = np.sum(weights * y) / np.sum(weights)
+    ess = np.sum(weights * (y - y_bar) ** 2) - ssr
+    QM = (ess / (n_params - 1)) / (ssr / (len(y) - n_params))
+    return max(0, (QM / QT) * 100) if QT > 0 else 0.0
+
+
+def _cluster_robust_t(X_batch, y, w, cluster_starts, correction):
+    """
+    WLS coefficients and cluster-robust t statistics for a stack of designs.
+
+    X_batch is (B, N, p) with rows sorted by cluster; every design shares
+    y and the weights w. One batched inverse of X'WX per design serves as
+    the bread of the sandwich; the meat is built from per-cluster score
+    sums (segment reductions over the cluster blocks).
+
+    Returns:
+    --------
+    ndarray : (B, p) t statistics
+    ndarray : (B, p) coefficients
+    """
+    Xw = X_batch * w[None, :, None]
+    bread = np.linalg.inv(np.einsum('bnp,bnq->bpq', Xw, X_batch))
+    betas = np.einsum('bpq,bq->bp', bread, np.einsum('bnp,n->bp', Xw, y))
+    resid = y[None, :] - np.einsum('bnp,bp->bn', X_batch, betas)
+    scores = np.add.reduceat(Xw * resid[:, :, None], cluster_starts, axis=1)
+    meat = np.einsum('bgp,bgq->bpq', scores, scores)
+    cov = correction * (bread @ meat @ bread)
+    se = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+    return betas / se, betas
+
+
+def _permuted_designs(X_sorted, moderator_idx, seg_starts, counts, strata, n, rng):
+    """
+    n designs with the moderator columns permuted at the cluster level.
+
+    strata is None when every moderator is constant within clusters: the
+    cluster values are then permuted over all clusters. Otherwise each
+    cluster's block of moderator rows is handed to another cluster of the
+    same size (strata lists the clusters of each size).
+    """
+    n_clusters = len(seg_starts)
+    X_batch = np.broadcast_to(X_sorted, (n,) + X_sorted.shape).copy()
+    if strata is None:
+        cluster_values = X_sorted[seg_starts][:, moderator_idx]
+        order = rng.permuted(np.broadcast_to(np.arange(n_clusters), (n, n_clusters)), axis=1)
+        X_batch[:, :, moderator_idx] = np.repeat(cluster_values[order], counts, axis=1)
+    else:
+        source = np.broadcast_to(np.arange(n_clusters), (n, n_clusters)).copy()
+        for members in strata:
+            shuffled = rng.permuted(np.broadcast_to(np.arange(len(members)), (n, len(members))), axis=1)
+            source[:, members] = members[shuffled]
+        rows = np.repeat(seg_starts[source] - seg_starts, counts, axis=1) + np.arange(len(X_sorted))
+        X_batch[:, :, moderator_idx] = X_sorted[rows][:, :, moderator_idx]
+    return X_batch
+
+# --- Parallel permutation workers ---
+# Each worker receives the sorted arrays once (initializer); each task is a
+# chunk number, from which the worker derives that chunk's seed.
+
+_PERM_SHARED = {}
+
+def _init_permutation_worker(*shared):
+    _PERM_SHARED['args'] = shared
+
+def _permutation_chunk(X_sorted, y, w, moderator_idx, seg_starts, counts, strata, correction,
+                       t_observed, entropy, chunk_size, n_permutations, chunk):
+    """Number of permutations in chunk `chunk` with |t| >= |t_observed|, per coefficient."""
+    n = min(chunk_size, n_permutations - chunk * chunk_size)
+    rng = np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(chunk,)))
+    X_batch = _permuted_designs(X_sorted, moderator_idx, seg_starts, counts, strata, n, rng)
+    t_perm, _ = _cluster_robust_t(X_batch, y, w, seg_starts, correction)
+    tolerance = 1e-10 * np.abs(t_observed)
+    return np.sum(np.abs(t_perm) >= np.abs(t_observed) - tolerance, axis=0)
+
+def _permutation_worker(chunk):
+    return _permutation_chunk(*_PERM_SHARED['args'], chunk)
+
+def cluster_permutation_test(reg_df, moderator_col, effect_col, var_col, cluster_col, tau_squared,
+                             n_permutations=5000, seed=None, chunk_size=None, n_jobs=1):
+    """
+    Permutation p-values for the cluster-robust WLS meta-regression.
+
+    The moderator values are permuted at the cluster level (whole studies
+    swap moderator values, so the within-study dependence is kept), the
+    WLS fit and cluster-robust t statistics are recomputed for every
+    permutation, and p = (1 + #{|t*| >= |t|}) / (1 + n_permutations).
+
+    Permutations are evaluated in chunks of stacked (chunk, N, p) design
+    matrices with einsum and batched inverses; chunk_size bounds the memory
+    (default about 2 million design entries per chunk). Chunk c always uses
+    child c of one SeedSequence, so the result does not depend on n_jobs.
+
+    Parameters:
+    -----------
+    reg_df : DataFrame
+        Regression data (no missing values in the columns used)
+    moderator_col : str or list of str
+        Moderator column(s); permuted jointly
+    effect_col, var_col, cluster_col : str
+        Effect size, sampling variance and cluster (study) columns
+    tau_squared : float
+        Between-study variance used in the weights 1 / (v + τ²)
+    n_permutations : int
+        Number of permutations
+    seed : int or None
+        Seed (None: fresh entropy, reported back)
+    chunk_size : int or None
+        Permutations per chunk
+    n_jobs : int
+        Worker processes (1 = run in this process)
+
+    Returns:
+    --------
+    dict : 'terms', 't_observed', 'p_values' (NaN for the intercept),
+           'n_permutations', 'scheme' ('cluster' or 'cluster_size_strata'),
+           'seed'
+    """
+    moderators = [moderator_col] if isinstance(moderator_col, str) else list(moderator_col)
+    codes, _ = pd.factorize(reg_df[cluster_col], sort=True)
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes)
+    seg_starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.intp)
+
+    y = reg_df[effect_col].to_numpy(dtype=float)[order]
+    w = 1.0 / (reg_df[var_col].to_numpy(dtype=float)[order] + tau_squared)
+    X_sorted = np.column_stack([np.ones(len(y))] +
+                               [reg_df[m].to_numpy(dtype=float)[order] for m in moderators])
+    moderator_idx = np.arange(1, X_sorted.shape[1])
+    n_obs, p_params = X_sorted.shape
+    n_clusters = len(seg_starts)
+    correction = n_clusters / (n_clusters - 1) * (n_obs - 1) / (n_obs - p_params)
+
+    # Cluster-level moderators permute freely; otherwise swap only equal-sized blocks
+    within_varies = np.add.reduceat(
+        np.abs(X_sorted - np.repeat(X_sorted[seg_starts], counts, axis=0)), seg_starts
+    )[:, moderator_idx].any()
+    if within_varies:
+        strata = [np.flatnonzero(counts == size) for size in np.unique(counts)]
+        strata = [members for members in strata if len(members) > 1]
+        scheme = 'cluster_size_strata'
+        if not strata:
+            warnings.warn("Moderator varies within clusters and no two clusters have the same "
+                          "size; the permutation distribution is degenerate.")
+    else:
+        strata = None
+        scheme = 'cluster'
+
+    t_observed, _ = _cluster_robust_t(X_sorted[None], y, w, seg_starts, correction)
+    t_observed = t_observed[0]
+
+    if chunk_size is None:
+        chunk_size = max(1, int(2e6 // (n_obs * p_params)))
+    n_chunks = -(-n_permutations // chunk_size)
+    entropy = np.random.SeedSequence(seed).entropy
+    shared = (X_sorted, y, w, moderator_idx, seg_starts, counts, strata, correction,
+              t_observed, entropy, chunk_size, n_permutations)
+
+    exceed = None
+    if n_jobs > 1 and n_chunks > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=_init_permutation_worker,
+                                     initargs=shared) as pool:
+                exceed = sum(pool.map(_permutation_worker, range(n_chunks)))
+        except (OSError, RuntimeError) as e:
+            warnings.warn(f"Process pool unavailable ({e}), running sequentially")
+    if exceed is None:
+        exceed = sum(_permutation_chunk(*shared, chunk) for chunk in range(n_chunks))
+
+    p_values = (1.0 + exceed) / (1.0 + n_permutations)
+    p_values[0] = np.nan  # the intercept is not permuted
+    return {
+        'terms': ['const'] + moderators,
+        't_observed': t_observed,
+        'p_values': p_values,
+        'n_permutations': n_permutations,
+        'scheme': scheme,
+        'seed': entropy,
+    }
+
+
+# --- Moderator screening ---
+# Each worker receives the shared arrays once (initializer); each task is
+# a list of moderator columns.
+
+_SCREEN_SHARED = {}
+
+_SCREEN_COLUMNS = ['moderator', 'k_obs', 'M_studies', 'intercept', 'slope', 'se_slope', 't_slope',
+                   'df_slope', 'p_slope', 'ci_lower_slope', 'ci_upper_slope', 'R_squared_adj',
+                   'error']
+
+def _init_screening_worker(*shared):
+    _SCREEN_SHARED['args'] = shared
+
+def _screen_chunk(y, weights, clusters, moderator_values, QT, vcov_type, df_method, min_obs,
+                  columns):
+    """One robust WLS fit per moderator column, on the rows where it is observed."""
+    rows = []
+    for column in columns:
+        x = moderator_values[:, column]
+        keep = np.isfinite(x)
+        row = {'k_obs': int(keep.sum()), 'error': None}
+        try:
+            if row['k_obs'] == 0:
+                raise ValueError("no numeric values")
+            if row['k_obs'] < min_obs:
+                raise ValueError(f"only {row['k_obs']} observations")
+            if np.ptp(x[keep]) == 0:
+                raise ValueError("moderator is constant")
+            X = np.column_stack([np.ones(row['k_obs']), x[keep]])
+            design = robust_design(X, weights[keep], clusters[keep])
+            fit = fit_robust_wls(design, y[keep], vcov_type=vcov_type, df_method=df_method)
+        except (ValueError, np.linalg.LinAlgError) as e:
+            row['error'] = str(e)
+            rows.append(row)
+            continue
+        row.update({
+            'M_studies': design['n_clusters'],
+            'intercept': fit['coefficients'][0],
+            'slope': fit['coefficients'][1],
+            'se_slope': fit['std_errors'][1],
+            't_slope': fit['t_stats'][1],
+            'df_slope': fit['df'][1],
+            'p_slope': fit['p_values'][1],
+            'ci_lower_slope': fit['ci_lower'][1],
+            'ci_upper_slope': fit['ci_upper'][1],
+            'R_squared_adj': _wls_r_squared(y[keep], weights[keep], fit['residuals'], 2, QT),
+        })
+        if design['n_clusters'] < 3:
+            row['error'] = f"only {design['n_clusters']} clusters; unreliable"
+        rows.append(row)
+    return rows
+
+def _screening_worker(columns):
+    return _screen_chunk(*_SCREEN_SHARED['args'], columns)
+
+def _adjust_p_values(p_values, method):
+    """
+    Multiplicity-adjusted p-values: 'fdr' (Benjamini-Hochberg step-up)
+    or 'holm' (Holm step-down).
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    m = len(p_values)
+    order = np.argsort(p_values, kind='stable')
+    ranked = p_values[order]
+    if method == 'fdr':
+        adjusted = np.minimum.accumulate((m / np.arange(1, m + 1) * ranked)[::-1])[::-1]
+    elif method == 'holm':
+        adjusted = np.maximum.accumulate((m - np.arange(m)) * ranked)
+    else:
+        raise ValueError(f"Unknown adjustment '{method}' (expected 'fdr' or 'holm')")
+    result = np.empty(m)
+    result[order] = np.minimum(adjusted, 1.0)
+    return result
+
+def candidate_moderators(data, exclude=()):
+    """
+    Columns usable as a continuous moderator: numeric (after coercion)
+    with at least 2 valid and 2 distinct values, in column order.
+    """
+    candidates = []
+    for col in data.columns:
+        if col in exclude:
+            continue
+        try:
+            values = pd.to_numeric(data[col], errors='coerce')
+        except (TypeError, ValueError):
+            continue
+        if values.notna().sum() >= 2 and values.nunique() >= 2:
+            candidates.append(col)
+    return candidates
+
+@instrumented_fit('moderator_screening')
+@cached_fit('moderator_screening')
+def screen_moderators(data, moderators, effect_col, var_col, cluster_col, tau_squared, QT=None,
+                      vcov_type='CR2', df_method='satterthwaite', min_obs=3, n_jobs=1):
+    """
+    Cluster-robust WLS meta-regression on every moderator, one at a time.
+
+    The effect, cluster and weight (1 / (v + τ²)) arrays are built once
+    and shared by all fits; each fit only drops the rows where its
+    moderator is missing. Moderators are fitted in chunks, in n_jobs
+    worker processes. p-values are adjusted over the moderators that
+    could be fitted, by Benjamini-Hochberg (FDR) and Holm (FWER).
+
+    Parameters:
+    -----------
+    data : DataFrame
+        Analysis data
+    moderators : list of str
+        Candidate moderators (see candidate_moderators); non-numeric
+        values are treated as missing
+    effect_col, var_col, cluster_col : str
+        Effect size, sampling variance and cluster (study) columns
+    tau_squared : float
+        Between-study variance of the unconditional model
+    QT : float or None
+        Total heterogeneity Q of the unconditional model (for R²)
+    vcov_type, df_method : str
+        Robust variance and degrees of freedom (see run_cluster_robust_regression)
+    min_obs : int
+        Fewest observations a moderator needs to be fitted
+    n_jobs : int
+        Worker processes (1 = run in this process)
+
+    Returns:
+    --------
+    DataFrame : one row per moderator ranked by slope p-value: 'rank',
+                'moderator', 'k_obs', 'M_studies', 'intercept', 'slope',
+                'se_slope', 't_slope', 'df_slope', 'p_slope',
+                'ci_lower_slope', 'ci_upper_slope', 'R_squared_adj',
+                'p_fdr', 'p_holm', 'error' (why a moderator was not
+                fitted, or a warning)
+    """
+    if vcov_type not in VCOV_TYPES:
+        raise ValueError(f"Unknown vcov_type '{vcov_type}' (expected one of {list(VCOV_TYPES)})")
+    if df_method not in ('satterthwaite', 'residual'):
+        raise ValueError(f"Unknown df_method '{df_method}' (expected 'satterthwaite' or 'residual')")
+    moderators = list(moderators)
+
+    base = data.dropna(subset=[effect_col, var_col, cluster_col])
+    base = base[base[var_col] > 0]
+    y = base[effect_col].to_numpy(dtype=float)
+    weights = 1.0 / (base[var_col].to_numpy(dtype=float) + tau_squared)
+    clusters, _ = pd.factorize(base[cluster_col], sort=True)
+    moderator_values = np.empty((len(base), len(moderators)))
+    for column, moderator in enumerate(moderators):
+        moderator_values[:, column] = pd.to_numeric(base[moderator], errors='coerce').to_numpy(dtype=float)
+
+    shared = (y, weights, clusters, moderator_values, QT, vcov_type, df_method, min_obs)
+    n_chunks = max(1, min(len(moderators), 4 * n_jobs))
+    chunks = [chunk for chunk in np.array_split(np.arange(len(moderators)), n_chunks) if len(chunk)]
+
+    rows = None
+    if n_jobs > 1 and len(chunks) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=_init_screening_worker,
+                                     initargs=shared) as pool:
+                rows = [row for chunk_rows in pool.map(_screening_worker, chunks) for row in chunk_rows]
+        except (OSError, RuntimeError) as e:
+            warnings.warn(f"Process pool unavailable ({e}), running sequentially")
+    if rows is None:
+        rows = [row for chunk in chunks for row in _screen_chunk(*shared, chunk)]
+
+    table = pd.DataFrame(rows).reindex(columns=_SCREEN_COLUMNS)
+    table['moderator'] = moderators
+    fitted = table['p_slope'].notna()
+    for method in ('fdr', 'holm'):
+        table[f'p_{method}'] = np.nan
+        if fitted.any():
+            table.loc[fitted, f'p_{method}'] = _adjust_p_values(table.loc[fitted, 'p_slope'], method)
+
+    table = table.sort_values('p_slope', kind='stable', na_position='last').reset_index(drop=True)
+    table.insert(0, 'rank', np.arange(1, len(table) + 1))
+    return table[['rank'] + _SCREEN_COLUMNS[:-1] + ['p_fdr', 'p_holm', 'error']]
+
+
+# --- 2. CLUSTER-ROBUST SPLINE META-REGRESSION ---
+
+@instrumented_fit('cluster_robust_spline')
+@cached_fit('cluster_robust_spline', whole_frame=True)
+def run_cluster_robust_spline(reg_df, moderator_col, effect_col, var_col,
+                               cluster_col, tau_squared, df_spline,
+                               vcov_type='CR2', df_method='satterthwaite'):
+    """
+    Runs spline meta-regression with cluster-robust standard errors.
+    Requires patsy for the natural cubic spline basis.
+
+    vcov_type / df_method as in run_cluster_robust_regression; the overall
+    test of the spline terms is a robust Wald test (HTZ small-sample F
+    unless df_method='residual').
+    """
+    if not PATSY_AVAILABLE:
+        raise ImportError("patsy is required for spline meta-regression (pip install patsy)")
+
+    # Standardize moderator for numerical stability
+    mod_mean = reg_df[moderator_col].mean()
+    mod_std = reg_df[moderator_col].std()
+
+    if mod_std == 0 or np.isnan(mod_std):
+        raise ValueError(f"Moderator '{moderator_col}' has zero variance")
+
+    moderator_col_std = f"{moderator_col}_std"
+    reg_df = reg_df.copy()
+    reg_df[moderator_col_std] = (reg_df[moderator_col] - mod_mean) / mod_std
+
+    # Generate natural cubic spline basis
+    spline_formula = f"cr({moderator_col_std}, df={df_spline}) - 1"
+
+    try:
+        X_spline = patsy.dmatrix(spline_formula, data=reg_df, return_type='dataframe')
+    except Exception as e:
+        raise ValueError(f"Failed to create spline basis: {e}")
+
+    # Add intercept manually
+    X_full = sm.add_constant(X_spline, prepend=True, has_constant='add')
+
+    # Response and weights
+    y = reg_df[effect_col].to_numpy(dtype=float)
+    weights = 1.0 / (reg_df[var_col].to_numpy(dtype=float) + tau_squared)
+
+    M_studies = reg_df[cluster_col].nunique()
+    k_obs = len(reg_df)
+    p_params = X_full.shape[1]
+    df_resid = M_studies - p_params
+
+    if df_resid < 1:
+        warnings.warn(f"Only {M_studies} clusters for {p_params} parameters")
+        df_resid = 1
+
+    # Fit WLS model with cluster-robust covariance
+    design = robust_design(X_full.to_numpy(), weights, reg_df[cluster_col])
+    fit = fit_robust_wls(design, y, vcov_type=vcov_type, df_method=df_method)
+
+    # Extract results
+    names = list(X_full.columns)
+    betas = pd.Series(fit['coefficients'], index=names)
+    se_robust = pd.Series(fit['std_errors'], index=names)
+    t_stats = pd.Series(fit['t_stats'], index=names)
+    p_values = pd.Series(fit['p_values'], index=names)
+    ci_lower = pd.Series(fit['ci_lower'], index=names)
+    ci_upper = pd.Series(fit['ci_upper'], index=names)
+
+    # Robust F-test for overall spline effect (test all except intercept)
+    wald = robust_wald_test(fit, np.arange(1, p_params),
+                            test='naive' if df_method == 'residual' else 'HTZ')
+    f_stat = wald['F']
+    f_pvalue = wald['p_value']
+
+    # Generate predictions for plotting
+    x_min = reg_df[moderator_col].min()
+    x_max = reg_df[moderator_col].max()
+    x_pred_orig = np.linspace(x_min, x_max, 100)
+    x_pred_std = (x_pred_orig - mod_mean) / mod_std
+
+    pred_data = pd.DataFrame({moderator_col_std: x_pred_std})
+    X_pred_spline = patsy.dmatrix(spline_formula, data=pred_data, return_type='dataframe')
+    X_pred_full = sm.add_constant(X_pred_spline, prepend=True, has_constant='add')
+
+    # Convert to arrays
+    X_pred_arr = np.array(X_pred_full)
+    betas_arr = np.array(betas)
+    var_betas_arr = fit['vcov']
+
+    # Predictions and CI
+    y_pred = X_pred_arr @ betas_arr
+    var_pred = np.sum((X_pred_arr @ var_betas_arr) * X_pred_arr, axis=1)
+    se_pred = np.sqrt(var_pred)
+    t_crit = t.ppf(0.975, df_resid)
+    ci_lower_pred = y_pred - t_crit * se_pred
+    ci_upper_pred = y_pred + t_crit * se_pred
+
+    results = {
+        'betas': betas,
+        'se_robust': se_robust,
+        'var_betas_robust': pd.DataFrame(fit['vcov'], index=names, columns=names),
+        't_stats': t_stats,
+        'p_values': p_values,
+        'ci_lower': ci_lower,
+        'ci_upper': ci_upper,
+        'df_coefficients': pd.Series(fit['df'], index=names),
+        'vcov_type': vcov_type,
+        'df_method': df_method,
+        'k_obs': k_obs,
+        'M_studies': M_studies,
+        'df_resid': df_resid,
+        'p_params': p_params,
+        'f_stat': f_stat,
+        'f_pvalue': f_pvalue,
+        'f_df': (wald['df_num'], wald['df_denom']),
+        'X_full': X_full,
+        'spline_formula': spline_formula,
+        'mod_mean': mod_mean,
+        'mod_std': mod_std,
+        'moderator_col_std': moderator_col_std,
+        'reg_df': reg_df,
+        'predictions': {
+            'x_orig': x_pred_orig,
+            'y_pred': y_pred,
+            'ci_lower': ci_lower_pred,
+            'ci_upper': ci_upper_pred
+        }
+    }
+
+    return results
+
+
+# --- 3. THREE-LEVEL META-REGRESSION (REML) ---
+
+def build_moderator_matrix(data, moderators, categorical=None, interactions=None, reference=None):
+    """
+    Design matrix (intercept first) for one or more moderators.
+
+    Numeric columns enter as they are; text/categorical columns (or any
+    listed in `categorical`) are expanded into treatment dummies against a
+    reference level. Each interaction multiplies the column blocks of its
+    moderators, so a continuous × categorical term gives one slope per
+    non-reference level.
+
+    Parameters:
+    -----------
+    data : DataFrame
+        Data containing the moderator columns
+    moderators : str or list of str
+        Moderator columns (main effects)
+    categorical : iterable of str, optional
+        Columns to treat as categorical even if numeric
+    interactions : list of tuples, optional
+        Moderator combinations to multiply, e.g. [('temp', 'crop')]
+    reference : dict, optional
+        Reference level per categorical moderator (default: first sorted level)
+
+    Returns:
+    --------
+    ndarray : (n_rows, p) design matrix
+    list : Column names ('intercept', 'temp', 'crop[rice]', 'temp:crop[rice]', ...)
+    """
+    if isinstance(moderators, str):
+        moderators = [moderators]
+    categorical = set(categorical or ())
+    reference = reference or {}
+    interactions = [tuple(term) for term in (interactions or ())]
+
+    blocks = {}
+    for name in dict.fromkeys(list(moderators) + [m for term in interactions for m in term]):
+        column = data[name]
+        if name in categorical or not pd.api.types.is_numeric_dtype(column):
+            levels = sorted(column.dropna().unique(), key=str)
+            ref = reference.get(name, levels[0] if levels else None)
+            levels = [level for level in levels if level != ref]
+            block = np.column_stack([column.eq(level).fillna(False).to_numpy(dtype=float)
+                                     for level in levels]) if levels else np.empty((len(data), 0))
+            block[column.isna().values] = np.nan
+            blocks[name] = (block, [f"{name}[{level}]" for level in levels])
+        else:
+            blocks[name] = (column.to_numpy(dtype=float)[:, None], [name])
+
+    columns = [np.ones((len(data), 1))]
+    names = ['intercept']
+    for name in moderators:
+        columns.append(blocks[name][0])
+        names += blocks[name][1]
+    for term in interactions:
+        block, block_names = blocks[term[0]]
+        for name in term[1:]:
+            other, other_names = blocks[name]
+            block = (block[:, :, None] * other[:, None, :]).reshape(len(data), -1)
+            block_names = [f"{a}:{b}" for a in block_names for b in other_names]
+        columns.append(block)
+        names += block_names
+
+    return np.hstack(columns), names
+
+
+@timed_likelihood
+def _three_level_regression_terms(params, y_sorted, v_sorted, X_sorted, seg_starts, counts,
+                                  with_gradient=False):
+    """
+    GLS estimates and REML log-likelihood of the three-level regression.
+
+    V_i = diag(v_ij + σ²) + τ²J, so V_i⁻¹ = W_i - c_i w_i w_i' with
+    w = 1/(v + σ²) and c_i = τ²/(1 + τ² 1'w_i). Stacking the id-sorted X
+    blocks, every per-study quantity is a segment sum:
+        X'V⁻¹X = X'WX - Σ c_i U_i U_i',   U_i = X_i'w_i
+    X'V⁻¹X is equilibrated and factored ONCE (Cholesky); the factor gives
+    log|X'V⁻¹X|, the coefficients and, with with_gradient, the closed-form
+    REML score used by the optimizer.
+
+    Returns:
+    --------
+    dict : Estimates ('log_lik_reml' is inf if the model cannot be evaluated)
+    ndarray or None : Gradient of the negative log-likelihood (with_gradient)
+    """
+    failed = {'log_lik_reml': np.inf}
+    tau_sq, sigma_sq = params
+    if tau_sq < 0 or sigma_sq < 0:
+        return failed, None
+    A_diag = v_sorted + sigma_sq
+    if np.any(A_diag <= 0):
+        return failed, None
+    w = 1.0 / A_diag
+    s = np.add.reduceat(w, seg_starts)
+    term_S = 1.0 + tau_sq * s
+    if np.any(term_S <= 1e-10):
+        return failed, None
+    c = tau_sq / term_S
+
+    wX = w[:, None] * X_sorted
+    U = np.add.reduceat(wX, seg_starts, axis=0)
+    sy = np.add.reduceat(w * y_sorted, seg_starts)
+    XtVX = X_sorted.T @ wX - (U.T * c) @ U
+    XtVy = wX.T @ y_sorted - U.T @ (c * sy)
+    yVy = w @ (y_sorted * y_sorted) - c @ (sy * sy)
+
+    # --- One Cholesky factorization of the (equilibrated) X'V⁻¹X ---
+    diag = np.diag(XtVX)
+    if np.any(diag <= 0) or not np.all(np.isfinite(XtVX)):
+        return failed, None
+    d = 1.0 / np.sqrt(diag)
+    try:
+        L = np.linalg.cholesky(XtVX * d[:, None] * d[None, :])
+    except np.linalg.LinAlgError:
+        return failed, None
+    L_diag = np.diag(L)
+    if L_diag.min() < 1e-7 * L_diag.max():
+        return failed, None  # design (nearly) rank deficient
+
+    log_det_XVX = 2.0 * np.sum(np.log(L_diag)) - 2.0 * np.sum(np.log(d))
+    betas = d * cho_solve((L, True), d * XtVy)
+    residual_ss = yVy - betas @ XtVy
+    sum_log_det_Vi = np.sum(np.log(A_diag)) + np.sum(np.log(term_S))
+    log_lik_reml = -0.5 * (sum_log_det_Vi + log_det_XVX + residual_ss)
+    if not np.isfinite(log_lik_reml):
+        return failed, None
+
+    estimates = {'betas': betas, 'log_lik_reml': log_lik_reml, 'tau_sq': tau_sq,
+                 'sigma_sq': sigma_sq, 'chol': (L, d)}
+    if not with_gradient:
+        return estimates, None
+
+    # --- Closed-form REML score ---
+    g = 1.0 / term_S
+    r = y_sorted - X_sorted @ betas
+    ur = np.add.reduceat(w * r, seg_starts)
+    e = w * (r - np.repeat(c * ur, counts))                   # V⁻¹r
+    B = wX - w[:, None] * np.repeat(c[:, None] * U, counts, axis=0)  # V⁻¹X
+    # u'(X'V⁻¹X)⁻¹u = |L⁻¹ D u|²
+    Z_U = solve_triangular(L, (U * d).T, lower=True)
+    Z_B = solve_triangular(L, (B * d).T, lower=True)
+    tr_PJ = np.sum(s * g) - np.sum(g**2 * np.sum(Z_U**2, axis=0))
+    tr_P = np.sum(w) - np.sum(c * np.add.reduceat(w * w, seg_starts)) - np.sum(Z_B**2)
+    score = 0.5 * np.array([np.sum((g * ur)**2) - tr_PJ, e @ e - tr_P])
+    return estimates, -score
+
+
+def _negative_log_likelihood_reml_reg(params, *args):
+    """Wrapper for jac=True optimizers. Returns (-REML log-lik, gradient)."""
+    estimates, gradient = _three_level_regression_terms(params, *args, with_gradient=True)
+    if gradient is None:
+        return np.inf, np.zeros(2)
+    return -estimates['log_lik_reml'], gradient
+
+
+@instrumented_fit('three_level_regression')
+@cached_fit('three_level_regression')
+def run_three_level_reml_regression(analysis_data, moderator_col, effect_col, var_col,
+                                    start_params=None, categorical=None, interactions=None,
+                                    reference=None):
+    """
+    Three-level mixed-effects meta-regression by REML.
+
+    Any number of continuous or categorical moderators and their
+    interactions (see build_moderator_matrix). Rows with a missing effect,
+    variance, id or moderator are dropped. The data are sorted once by
+    study id and each likelihood evaluation is a few segment sums over the
+    stacked X blocks plus one p × p Cholesky factorization, so the cost
+    grows linearly in the number of effects.
+
+    start_params is the starting (τ², σ²), typically the unconditional
+    three-level estimates; both are capped at 5.0.
+
+    Returns:
+    --------
+    tuple : (estimates dict, (N_total, M_studies, p_params), optimizer result);
+            estimates is None if the fit fails. Estimates hold 'betas',
+            'se_betas', 'var_betas', 'coef_names', 'z_stats', 'p_values',
+            'QM', 'df_QM', 'p_QM' (Wald test of all moderators), 'tau_sq',
+            'sigma_sq' and 'log_lik_reml'.
+    """
+    moderators = [moderator_col] if isinstance(moderator_col, str) else list(moderator_col)
+    X, coef_names = build_moderator_matrix(analysis_data, moderators, categorical=categorical,
+                                           interactions=interactions, reference=reference)
+    y = analysis_data[effect_col].to_numpy(dtype=float)
+    v = analysis_data[var_col].to_numpy(dtype=float)
+    keep = np.isfinite(y) & np.isfinite(v) & np.all(np.isfinite(X), axis=1) & analysis_data['id'].notna().values
+
+    codes, _ = pd.factorize(analysis_data['id'][keep], sort=True)
+    order = np.argsort(codes, kind='stable')
+    y_sorted, v_sorted, X_sorted = y[keep][order], v[keep][order], X[keep][order]
+    counts = np.bincount(codes)
+    seg_starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.intp)
+
+    N_total = len(y_sorted)
+    M_studies = len(seg_starts)
+    p_params = X.shape[1]
+    if start_params is not None:
+        tau_sq_start = min(start_params[0], 5.0)
+        sigma_sq_start = min(start_params[1], 5.0)
+    else:
+        tau_sq_start, sigma_sq_start = 0.01, 0.01
+    initial_params = [max(1e-6, tau_sq_start), max(1e-6, sigma_sq_start)]
+    bounds = [(1e-6, 100.0), (1e-6, 100.0)]
+    data_args = (y_sorted, v_sorted, X_sorted, seg_starts, counts)
+    optimizer_result = minimize(
+        _negative_log_likelihood_reml_reg,
+        x0=initial_params,
+        args=data_args,
+        jac=True,
+        method='L-BFGS-B',
+        bounds=bounds,
+        options={'ftol': 1e-10, 'gtol': 1e-6, 'maxiter': 500}
+    )
+    if not optimizer_result.success:
+        return None, None, optimizer_result
+    final_estimates, _ = _three_level_regression_terms(optimizer_result.x, *data_args)
+    if not np.isfinite(final_estimates['log_lik_reml']):
+        return None, None, optimizer_result
+
+    # Covariance of the coefficients from the same factor: D (LL')⁻¹ D
+    L, d = final_estimates.pop('chol')
+    var_betas = cho_solve((L, True), np.eye(p_params)) * d[:, None] * d[None, :]
+    betas = final_estimates['betas']
+    se_betas = np.sqrt(np.diag(var_betas))
+    z_stats = betas / se_betas
+
+    if p_params > 1:
+        b_mod = betas[1:]
+        QM = float(b_mod @ np.linalg.solve(var_betas[1:, 1:], b_mod))
+        p_QM = 1 - chi2.cdf(QM, p_params - 1)
+    else:
+        QM, p_QM = np.nan, np.nan
+
+    final_estimates.update({
+        'var_betas': var_betas,
+        'se_betas': se_betas,
+        'coef_names': coef_names,
+        'z_stats': z_stats,
+        'p_values': 2 * (1 - norm.cdf(np.abs(z_stats))),
+        'QM': QM,
+        'df_QM': p_params - 1,
+        'p_QM': p_QM,
+    })
+    return final_estimates, (N_total, M_studies, p_params), optimizer_result
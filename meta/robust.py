@@ -0,0 +1,354 @@
+"""
+Cluster-robust (sandwich) variance for weighted least squares.
+
+A design (moderators, weights 1 / (v + τ²), clusters) is prepared once
+with robust_design(); every fit on it (fit_robust_wls) then only costs a
+few matrix-vector products, so the same design can be refitted thousands
+of times (permutation, bootstrap or moderator-screening loops).
+
+Variance estimators (Pustejovsky & Tipton 2018):
+    CR0  the plain sandwich
+    CR1  CR0 × M/(M−1) × (N−1)/(N−p) (the statsmodels / Stata factor)
+    CR2  bias-reduced linearization: each cluster's residuals are
+         adjusted by (I − H_jj)^(-1/2), so the estimator is unbiased
+         when the weights are the inverse variances
+
+Degrees of freedom are the Satterthwaite approximation for each
+coefficient (under the working model given by the weights), and
+robust_wald_test() tests several coefficients jointly with the HTZ
+approximate Hotelling T² (Tipton & Pustejovsky 2015). With few clusters
+both are far better calibrated than CR1 with M − p degrees of freedom.
+
+Everything here depends on the design only through the per-cluster
+blocks, which are computed once per design and estimator and cached in
+the design dict.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.stats import t, f
+
+__all__ = [
+    'VCOV_TYPES',
+    'robust_design',
+    'fit_robust_wls',
+    'robust_wald_test',
+    'cluster_robust_wls',
+]
+
+VCOV_TYPES = ('CR0', 'CR1', 'CR2')
+
+# Largest (clusters × rows × parameters) block of CR2 adjustments built at once
+_CR2_CHUNK_ENTRIES = 2_000_000
+
+
+# --- 1. DESIGN ---
+
+def robust_design(X, weights, clusters):
+    """
+    Prepare a WLS design for cluster-robust fits.
+
+    Parameters:
+    -----------
+    X : array-like (N, p)
+        Design matrix, intercept included
+    weights : array-like (N,)
+        Inverse-variance weights, e.g. 1 / (v + τ²)
+    clusters : array-like (N,)
+        Cluster (study) labels
+
+    Returns:
+    --------
+    dict : sorted, square-root-weighted design, cluster segments and the
+           bread (X'WX)^+; passed to fit_robust_wls()
+    """
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1:
+        X = X[:, None]
+    weights = np.asarray(weights, dtype=float)
+    codes, _ = pd.factorize(np.asarray(clusters), sort=True)
+    if (codes < 0).any():
+        raise ValueError("Cluster labels must not be missing")
+    if np.any(~np.isfinite(weights)) or np.any(weights <= 0):
+        raise ValueError("Weights must be positive and finite")
+
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes)
+    seg_starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.intp)
+    sqrt_w = np.sqrt(weights[order])
+    Xt = X[order] * sqrt_w[:, None]
+    # Pseudo-inverse, as statsmodels: a rank-deficient design (e.g. a spline
+    # basis that sums to one next to the intercept) gets the minimum-norm fit
+    bread = np.linalg.pinv(Xt.T @ Xt, hermitian=True)
+
+    n_obs, n_params = X.shape
+    return {
+        'order': order,
+        'seg_starts': seg_starts,
+        'counts': counts,
+        'sqrt_w': sqrt_w,
+        'Xt': Xt,
+        'bread': bread,
+        'n_obs': n_obs,
+        'n_params': n_params,
+        'n_clusters': len(counts),
+        'terms': {},
+    }
+
+
+def _cr2_blocks(design):
+    """
+    (cluster indices, row indices, A_j X̃_j) for chunks of equal-sized
+    clusters, with A_j = (I − H_jj)^(-1/2) (Moore-Penrose for leverage 1).
+
+    H_jj = X̃_j M X̃_j' has rank <= p, so with the thin SVD X̃_j = U S V'
+    and K = S V' M V S, A_j X̃_j = U (I − K)^(-1/2) S V': no n_j × n_j
+    matrix is formed, whatever the cluster size.
+    """
+    Xt, bread, counts, seg_starts = (design['Xt'], design['bread'],
+                                     design['counts'], design['seg_starts'])
+    n_params = design['n_params']
+    blocks = []
+    for size in np.unique(counts):
+        members = np.flatnonzero(counts == size)
+        step = max(1, _CR2_CHUNK_ENTRIES // (size * n_params))
+        for start in range(0, len(members), step):
+            idx = members[start:start + step]
+            rows = seg_starts[idx][:, None] + np.arange(size)
+            U, S, Vt = np.linalg.svd(Xt[rows], full_matrices=False)
+            SVt = S[:, :, None] * Vt
+            K = SVt @ bread @ SVt.transpose(0, 2, 1)
+            values, vectors = np.linalg.eigh(np.eye(K.shape[1]) - K)
+            inv_sqrt = np.where(values > 1e-10, 1.0 / np.sqrt(np.clip(values, 1e-10, None)), 0.0)
+            adjust = np.einsum('grk,gk,gsk->grs', vectors, inv_sqrt, vectors)
+            blocks.append((idx, rows, U @ adjust @ SVt))
+    return blocks
+
+
+def _cluster_terms(design, vcov_type):
+    """
+    Per-cluster blocks of one estimator, cached in the design:
+        Q_j = X̃_j' A_j X̃_j,  R_j = X̃_j' A_j² X̃_j
+    (A_j = I for CR0 / CR1), the scale factor and the CR2 blocks.
+    """
+    if vcov_type not in VCOV_TYPES:
+        raise ValueError(f"Unknown vcov_type '{vcov_type}' (expected one of {list(VCOV_TYPES)})")
+    terms = design['terms'].get(vcov_type)
+    if terms is not None:
+        return terms
+
+    n_obs, n_params, n_clusters = design['n_obs'], design['n_params'], design['n_clusters']
+    if vcov_type == 'CR2':
+        blocks = _cr2_blocks(design)
+        Q = np.empty((n_clusters, n_params, n_params))
+        R = np.empty_like(Q)
+        for idx, rows, AX in blocks:
+            X_block = design['Xt'][rows]
+            Q[idx] = np.einsum('gnp,gnq->gpq', X_block, AX)
+            R[idx] = np.einsum('gnp,gnq->gpq', AX, AX)
+        factor = 1.0
+    else:
+        blocks = None
+        Xt = design['Xt']
+        Q = np.add.reduceat(Xt[:, :, None] * Xt[:, None, :], design['seg_starts'], axis=0)
+        R = Q
+        if vcov_type == 'CR1' and n_clusters > 1 and n_obs > n_params:
+            factor = n_clusters / (n_clusters - 1) * (n_obs - 1) / (n_obs - n_params)
+        else:
+            factor = 1.0
+
+    terms = {'blocks': blocks, 'Q': Q, 'R': R, 'factor': factor}
+    terms['df'] = _satterthwaite_df(design['bread'], Q, R)
+    design['terms'][vcov_type] = terms
+    return terms
+
+
+# --- 2. DEGREES OF FREEDOM ---
+
+def _satterthwaite_df(bread, Q, R):
+    """
+    Satterthwaite degrees of freedom of every coefficient.
+
+    The variance estimate of coefficient k is a quadratic form
+    Σ_j (ω_jk' ỹ)² in the transformed response; under the working model
+    ω_ik'ω_jk = δ_ij d_jk − u_ik' M u_jk with d_jk = (M R_j M)_kk and
+    u_jk = (Q_j M)[:, k], so df_k = (Σ_j Ω_jj)² / Σ_ij Ω_ij² is computed
+    from p × p blocks without forming any N × N matrix.
+    """
+    M = bread
+    U = Q @ M                                           # u_jk = U[j, :, k]
+    d = np.einsum('kp,jpk->jk', M, R @ M)
+    a = np.einsum('jxk,jxk->jk', U, M @ U)              # u_jk' M u_jk
+    expected = (d - a).sum(axis=0)
+    T = np.einsum('jxk,jyk->kxy', U, U)
+    MT = np.einsum('xz,kzy->kxy', M, T)
+    cross = np.einsum('kxy,kyx->k', MT, MT)             # Σ_ij (u_ik' M u_jk)²
+    sum_sq = (d ** 2).sum(axis=0) - 2 * (d * a).sum(axis=0) + cross
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(sum_sq > 0, expected ** 2 / sum_sq, np.nan)
+
+
+def _htz_df(bread, Q, R, C):
+    """
+    HTZ degrees of freedom ν for the constraints C (q × p): the
+    standardized variance estimate Ω^(-1/2) C V C' Ω^(-1/2) is matched to
+    a Wishart(ν, I_q) / ν on its total variance (Tipton & Pustejovsky 2015).
+    """
+    M = bread
+    q = C.shape[0]
+    MC = M @ C.T
+    U = Q @ MC
+    D = np.einsum('ps,jpw->jsw', MC, R @ MC)
+    A = np.einsum('jps,jpt->jst', U, M @ U)
+    omega = (D - A).sum(axis=0)
+
+    # Standardize so the working-model expectation is the identity
+    values, vectors = np.linalg.eigh(omega)
+    if np.any(values <= 0):
+        return np.nan
+    W = (vectors / np.sqrt(values)) @ vectors.T
+    U = U @ W.T
+    D = W @ D @ W.T
+    A = W @ A @ W.T
+
+    T = np.einsum('jxa,jyb->abxy', U, U)
+    MT = np.einsum('xz,abzy->abxy', M, T)
+    S = (np.einsum('jab,jcd->abcd', D, D)
+         - np.einsum('jab,jcd->abcd', D, A)
+         - np.einsum('jab,jcd->abcd', A, D)
+         + np.einsum('bdxy,cayx->abcd', MT, MT))
+    s_idx, t_idx = np.meshgrid(np.arange(q), np.arange(q), indexing='ij')
+    total_var = (S[s_idx, s_idx, t_idx, t_idx] + S[s_idx, t_idx, t_idx, s_idx]).sum()
+    return q * (q + 1) / total_var if total_var > 0 else np.nan
+
+
+# --- 3. FITS AND TESTS ---
+
+def fit_robust_wls(design, y, vcov_type='CR2', df_method='satterthwaite', alpha=0.05):
+    """
+    WLS coefficients with cluster-robust standard errors.
+
+    Parameters:
+    -----------
+    design : dict
+        Output of robust_design()
+    y : array-like (N,)
+        Response, in the row order given to robust_design()
+    vcov_type : str
+        'CR0', 'CR1' or 'CR2'
+    df_method : str
+        'satterthwaite' (per coefficient) or 'residual' (M − p)
+    alpha : float
+        1 − confidence level of the intervals
+
+    Returns:
+    --------
+    dict : 'coefficients', 'vcov', 'std_errors', 'df', 't_stats',
+           'p_values', 'ci_lower', 'ci_upper' (arrays), 'residuals',
+           'vcov_type', 'df_method', 'design'
+    """
+    if df_method not in ('satterthwaite', 'residual'):
+        raise ValueError(f"Unknown df_method '{df_method}' (expected 'satterthwaite' or 'residual')")
+    terms = _cluster_terms(design, vcov_type)
+    Xt, bread = design['Xt'], design['bread']
+    yt = np.asarray(y, dtype=float)[design['order']] * design['sqrt_w']
+    betas = bread @ (Xt.T @ yt)
+    resid_t = yt - Xt @ betas
+
+    if terms['blocks'] is None:
+        scores = np.add.reduceat(Xt * resid_t[:, None], design['seg_starts'], axis=0)
+    else:
+        scores = np.empty((design['n_clusters'], design['n_params']))
+        for idx, rows, AX in terms['blocks']:
+            scores[idx] = np.einsum('gnp,gn->gp', AX, resid_t[rows])
+    vcov = terms['factor'] * (bread @ (scores.T @ scores) @ bread)
+    se = np.sqrt(np.diag(vcov))
+
+    if df_method == 'satterthwaite':
+        df = terms['df']
+    else:
+        df = np.full(design['n_params'], float(max(1, design['n_clusters'] - design['n_params'])))
+    t_stats = betas / se
+    t_crit = t.ppf(1 - alpha / 2, df)
+    residuals = np.empty_like(resid_t)
+    residuals[design['order']] = resid_t / design['sqrt_w']
+    return {
+        'coefficients': betas,
+        'vcov': vcov,
+        'std_errors': se,
+        'df': df,
+        't_stats': t_stats,
+        'p_values': 2 * t.sf(np.abs(t_stats), df),
+        'ci_lower': betas - t_crit * se,
+        'ci_upper': betas + t_crit * se,
+        'residuals': residuals,
+        'vcov_type': vcov_type,
+        'df_method': df_method,
+        'design': design,
+    }
+
+
+def robust_wald_test(fit, constraints, rhs=None, test='HTZ'):
+    """
+    Cluster-robust Wald test of C β = d.
+
+    Parameters:
+    -----------
+    fit : dict
+        Output of fit_robust_wls()
+    constraints : array-like (q, p) or list of int
+        Constraint matrix C, or the indices of coefficients tested = 0
+    rhs : array-like (q,) or None
+        d (zeros if None)
+    test : str
+        'HTZ' (approximate Hotelling T², small-sample) or 'naive'
+        (Q / q against F(q, M − p))
+
+    Returns:
+    --------
+    dict : 'Q' (Wald statistic), 'F', 'df_num', 'df_denom', 'p_value', 'test'
+    """
+    design = fit['design']
+    n_params = design['n_params']
+    C = np.asarray(constraints)
+    if C.ndim == 1 and np.issubdtype(C.dtype, np.integer):
+        C = np.eye(n_params)[C]
+    C = np.atleast_2d(C).astype(float)
+    if C.shape[1] != n_params:
+        raise ValueError(f"Constraint matrix has {C.shape[1]} columns, the model {n_params} coefficients")
+    q = C.shape[0]
+    d = np.zeros(q) if rhs is None else np.asarray(rhs, dtype=float)
+
+    diff = C @ fit['coefficients'] - d
+    try:
+        Q_stat = float(diff @ np.linalg.solve(C @ fit['vcov'] @ C.T, diff))
+    except np.linalg.LinAlgError:
+        Q_stat = np.nan
+
+    if test == 'HTZ':
+        terms = _cluster_terms(design, fit['vcov_type'])
+        nu = _htz_df(design['bread'], terms['Q'], terms['R'], C)
+        df_denom = nu - q + 1
+        F_stat = (nu - q + 1) / (nu * q) * Q_stat if df_denom > 0 else np.nan
+    elif test == 'naive':
+        df_denom = float(max(1, design['n_clusters'] - n_params))
+        F_stat = Q_stat / q
+    else:
+        raise ValueError(f"Unknown test '{test}' (expected 'HTZ' or 'naive')")
+
+    p_value = f.sf(F_stat, q, df_denom) if np.isfinite(F_stat) and df_denom > 0 else np.nan
+    return {
+        'Q': Q_stat,
+        'F': F_stat,
+        'df_num': q,
+        'df_denom': df_denom,
+        'p_value': p_value,
+        'test': test,
+    }
+
+
+def cluster_robust_wls(X, y, weights, clusters, vcov_type='CR2', df_method='satterthwaite',
+                       alpha=0.05):
+    """One-off robust_design() + fit_robust_wls()."""
+    return fit_robust_wls(robust_design(X, weights, clusters), y, vcov_type=vcov_type,
+                          df_method=df_method, alpha=alpha)
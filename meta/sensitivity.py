@@ -0,0 +1,258 @@
+"""
+Sensitivity analyses: three-level leave-one-study-out and cumulative
+meta-analysis.
+
+Leave-one-out sorts the data once by study id; each refit slices one
+study out of the sorted arrays and runs the three-level REML fit
+(three_level.fit_three_level_segments), warm-started from the
+full-model (τ², σ²). Cumulative meta-analysis keeps running sums of the
+fixed-effect quantities and warm-starts each REML step from the previous
+one.
+"""
+
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from .fit_cache import cached_fit
+from .heterogeneity import fit_tau_squared
+from .perf import instrumented_fit
+from .three_level import fit_three_level_segments
+
+__all__ = [
+    'run_three_level_loo',
+    'loo_results_table',
+    'aggregate_by_study',
+    'run_cumulative_engine',
+]
+
+
+# --- 1. THREE-LEVEL LEAVE-ONE-OUT ---
+
+def _fit_three_level_loo(y_sorted, v_sorted, seg_starts, drop_index, start_params):
+    """
+    Fit the 3-level model on the pre-sorted data with one study dropped.
+    The study's block is sliced out of the sorted arrays (no DataFrame
+    copy or regrouping) and the REML fit is the one of the full model
+    (fit_three_level_segments), warm-started from start_params.
+    """
+    seg_ends = np.append(seg_starts[1:], len(y_sorted))
+    start, end = seg_starts[drop_index], seg_ends[drop_index]
+    y_loo = np.concatenate((y_sorted[:start], y_sorted[end:]))
+    v_loo = np.concatenate((v_sorted[:start], v_sorted[end:]))
+    seg_loo = np.concatenate((seg_starts[:drop_index], seg_starts[drop_index + 1:] - (end - start)))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        final_estimates, _, _ = fit_three_level_segments(y_loo, v_loo, seg_loo,
+                                                         start_params=start_params, ci_method=None)
+    if final_estimates is None:
+        return None # Not enough studies, or the fit failed
+    final_estimates['k_obs'] = len(y_loo)
+    final_estimates['k_studies'] = len(seg_loo)
+    return final_estimates
+
+# --- Parallel LOO workers ---
+# Each worker receives the sorted arrays once (initializer) instead of a
+# DataFrame per task; each task is just a study index.
+
+_LOO_SHARED = {}
+
+def _init_loo_worker(y_sorted, v_sorted, seg_starts, start_params):
+    _LOO_SHARED.update(y_sorted=y_sorted, v_sorted=v_sorted,
+                       seg_starts=seg_starts, start_params=start_params)
+
+def _loo_worker(drop_index):
+    return _fit_three_level_loo(_LOO_SHARED['y_sorted'], _LOO_SHARED['v_sorted'],
+                                _LOO_SHARED['seg_starts'], drop_index,
+                                _LOO_SHARED['start_params'])
+
+@instrumented_fit('three_level_loo')
+@cached_fit('three_level_loo')
+def run_three_level_loo(y_sorted, v_sorted, seg_starts, start_params, n_jobs=1):
+    """
+    Fit the 3-level model once per dropped study.
+
+    Args:
+        y_sorted, v_sorted, seg_starts: Output of build_study_segments()
+        start_params (tuple): Full-model (τ², σ²) used as warm start
+        n_jobs (int): Worker processes (1 = run in this process)
+
+    Returns:
+        list: One estimates dict (or None on failure) per study, in
+              segment order
+    """
+    drop_indices = range(len(seg_starts))
+    if n_jobs > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=_init_loo_worker,
+                                     initargs=(y_sorted, v_sorted, seg_starts, start_params)) as pool:
+                chunksize = max(1, len(seg_starts) // (4 * n_jobs))
+                return list(pool.map(_loo_worker, drop_indices, chunksize=chunksize))
+        except (OSError, RuntimeError) as e:
+            warnings.warn(f"Process pool unavailable ({e}), running sequentially")
+    return [_fit_three_level_loo(y_sorted, v_sorted, seg_starts, j, start_params)
+            for j in drop_indices]
+
+
+def loo_results_table(removal_ids, all_estimates, original_effect, original_ci_lower,
+                      original_ci_upper, null_value=0):
+    """
+    Tabulate leave-one-out refits against the full-model estimate.
+
+    Args:
+        removal_ids: Study ids in segment order (from build_study_segments())
+        all_estimates (list): Output of run_three_level_loo(); failed refits
+                              (None) are left out
+        original_effect, original_ci_lower, original_ci_upper (float):
+            Full three-level model estimate and 95% CI
+        null_value (float): Null effect used for the significance check
+
+    Returns:
+        DataFrame: One row per successful refit
+    """
+    original_is_sig = not (original_ci_lower <= null_value <= original_ci_upper)
+    loo_results = []
+    for remove_id, estimates in zip(removal_ids, all_estimates):
+        if estimates is None:
+            continue
+
+        mu_loo = estimates['mu']
+        se_loo = estimates['se_mu']
+        ci_lower_loo = mu_loo - 1.96 * se_loo
+        ci_upper_loo = mu_loo + 1.96 * se_loo
+        effect_diff = mu_loo - original_effect
+        loo_is_sig = not (ci_lower_loo <= null_value <= ci_upper_loo)
+
+        loo_results.append({
+            'unit_removed': str(remove_id),
+            'k_studies': estimates['k_studies'],
+            'k_obs': estimates['k_obs'],
+            'pooled_effect': mu_loo,
+            'se': se_loo,
+            'ci_lower': ci_lower_loo,
+            'ci_upper': ci_upper_loo,
+            'tau_squared': estimates['tau_sq'],
+            'sigma_squared': estimates['sigma_sq'],
+            'effect_diff': effect_diff,
+            'abs_diff': abs(effect_diff),
+            'changes_sig': original_is_sig != loo_is_sig
+        })
+    return pd.DataFrame(loo_results)
+
+
+# --- 2. CUMULATIVE META-ANALYSIS ---
+
+def aggregate_by_study(data, effect_col, var_col):
+    """
+    Pool observations within each study (fixed-effects) in ONE grouped pass.
+
+    Each study gets its earliest year, the inverse-variance weighted mean
+    effect and variance 1/Σw. Studies keep their order of first appearance.
+    """
+    w = 1.0 / data[var_col].values
+    work = pd.DataFrame({
+        'id': data['id'].values,
+        'year': data['year'].values,
+        'w': w,
+        'wy': w * data[effect_col].values,
+    })
+    grouped = work.groupby('id', sort=False).agg(
+        year=('year', 'min'), sum_w=('w', 'sum'), sum_wy=('wy', 'sum'), n_obs=('w', 'size')
+    )
+    return pd.DataFrame({
+        'id': grouped.index.values,
+        'year': grouped['year'].values,
+        effect_col: grouped['sum_wy'].values / grouped['sum_w'].values,
+        var_col: 1.0 / grouped['sum_w'].values,
+        'n_obs': grouped['n_obs'].values,
+    })
+
+@instrumented_fit('cumulative')
+@cached_fit('cumulative')
+def run_cumulative_engine(y, v, years, ids, tau_method='REML', alpha=0.05):
+    """
+    Incremental cumulative random-effects meta-analysis.
+
+    Running sums of w, wy, wy² and w² give the fixed-effect Q, I² and the DL
+    tau-squared for every step at once (O(n)). REML steps use
+    heterogeneity.fit_tau_squared() warm-started from the previous step's
+    tau-squared, falling back to DL if they fail; steps whose REML fit did
+    not converge are flagged and warned about.
+
+    Args:
+        y, v (ndarray): Effects and variances, already in cumulative order
+        years, ids (ndarray): Year and id of each unit (same order)
+        tau_method (str): 'REML' or 'DL'
+        alpha (float): Significance level for the CIs
+
+    Returns:
+        DataFrame: One row per cumulative step ('tau_converged' is False
+                   where the REML fit did not converge)
+    """
+    n_units = len(y)
+    steps = np.arange(1, n_units + 1)
+
+    # --- Running fixed-effect sums ---
+    w = 1.0 / v
+    sum_w = np.cumsum(w)
+    sum_wy = np.cumsum(w * y)
+    sum_wy2 = np.cumsum(w * y * y)
+    sum_w_sq = np.cumsum(w * w)
+
+    Q = np.maximum(sum_wy2 - sum_wy**2 / sum_w, 0.0)
+    Q[0] = 0.0  # a single unit has no heterogeneity (avoid rounding noise)
+    df_Q = steps - 1
+    C = sum_w - sum_w_sq / sum_w
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau2_dl = np.where((C > 0) & (Q > df_Q), (Q - df_Q) / C, 0.0)
+        I_sq = np.where(Q > 0, np.maximum(0.0, (Q - df_Q) / Q * 100), 0.0)
+
+    # --- Running count of distinct ids ---
+    n_studies = np.cumsum(~pd.Series(ids).duplicated().values)
+
+    z_crit = norm.ppf(1 - alpha / 2)
+    pooled = np.empty(n_units)
+    se = np.empty(n_units)
+    tau2 = tau2_dl.copy()
+    tau_converged = np.ones(n_units, dtype=bool)
+    tau_sq_prev = 0.0
+
+    for i in range(n_units):
+        y_i, v_i = y[:i + 1], v[:i + 1]  # views, no copies
+        if tau_method == 'REML' and i >= 1:
+            try:
+                tau_sq_reml, diagnostics = fit_tau_squared(y_i, v_i, method='REML',
+                                                           tau_sq_start=tau_sq_prev)
+                if np.isfinite(tau_sq_reml):
+                    tau2[i] = tau_sq_reml
+                    tau_converged[i] = diagnostics['converged']
+            except (FloatingPointError, ValueError, ZeroDivisionError):
+                pass # keep DL (common in small cumulative steps)
+        tau_sq_prev = tau2[i]
+
+        w_re = 1.0 / (v_i + tau2[i])
+        sum_w_re = w_re.sum()
+        pooled[i] = (w_re * y_i).sum() / sum_w_re
+        se[i] = np.sqrt(1.0 / sum_w_re)
+
+    if not tau_converged.all():
+        warnings.warn(f"REML did not converge at {int((~tau_converged).sum())} cumulative "
+                      f"step(s): {steps[~tau_converged].tolist()}")
+
+    return pd.DataFrame({
+        'step': steps,
+        'year': years,
+        'id_added': ids,
+        'n_studies': n_studies,
+        'pooled_effect': pooled,
+        'ci_lower': pooled - z_crit * se,
+        'ci_upper': pooled + z_crit * se,
+        'I_squared': I_sq,
+        'tau_squared': tau2,
+        'tau_converged': tau_converged
+    })
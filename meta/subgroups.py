@@ -0,0 +1,364 @@
+"""
+Three-level subgroup analysis.
+
+Mirrors the notebook's subgroup configuration and "PERFORM THREE-LEVEL
+SUBGROUP ANALYSIS" steps: pick the groups (one moderator, or every
+combination of two) that meet the minimum papers/observations, fit the
+three-level model in each and partition heterogeneity with the standard
+fixed-effect Q statistics.
+
+The data are partitioned once (build_group_segments): a single sort by
+(moderator(s), id) puts every group in a contiguous block and every study
+in a contiguous sub-block, so group sizes, paper counts, Q-within and the
+per-group three-level fits are all read off the sorted arrays without a
+boolean scan or DataFrame copy per group.
+
+Usage:
+    valid_groups = find_valid_groups(data, 'crop', min_papers=2, min_obs=2)
+    subgroup_results = run_subgroup_analysis(data, 'lnRR', 'var_lnRR', 'crop', None,
+                                             valid_groups, Qt_overall)
+"""
+
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm, chi2
+
+from .fit_cache import cached_fit
+from .perf import instrumented_fit
+from .three_level import fit_three_level_segments
+
+__all__ = [
+    'build_group_segments',
+    'group_summary',
+    'find_valid_groups',
+    'in_valid_groups',
+    'run_subgroup_analysis',
+]
+
+
+# --- 1. PARTITIONING ---
+
+def build_group_segments(analysis_data, moderator1, moderator2=None, effect_col=None, var_col=None):
+    """
+    Sort the data ONCE by (moderator1[, moderator2], id) and return offsets.
+
+    Groups are numbered in order of first appearance of each moderator
+    level (moderator1 major, moderator2 minor), which is the order
+    find_valid_groups() has always listed them in. Rows with a missing
+    moderator are dropped; rows with a missing id stay in their group
+    (they count towards k and Q) but sort first and belong to no study.
+
+    Parameters:
+    -----------
+    analysis_data : DataFrame
+        Data with 'id' and moderator columns
+    moderator1, moderator2 : str or None
+        Moderator column(s)
+    effect_col, var_col : str or None
+        Also return the sorted effect sizes / variances
+
+    Returns:
+    --------
+    dict : 'order' (row positions in sorted order), 'group_keys' (level or
+           (level1, level2) per group), 'group_starts', 'k', 'id_codes'
+           (sorted, -1 for missing), 'study_starts' (offsets of every study
+           block), 'study_group' (group of each study block), 'n_papers',
+           and 'y' / 'v' when requested
+    """
+    codes1, levels1 = pd.factorize(analysis_data[moderator1])
+    if moderator2 is None:
+        keep = codes1 >= 0
+        group_codes = codes1
+    else:
+        codes2, levels2 = pd.factorize(analysis_data[moderator2])
+        keep = (codes1 >= 0) & (codes2 >= 0)
+        group_codes = codes1 * len(levels2) + codes2
+    id_codes, _ = pd.factorize(analysis_data['id'], sort=True)
+
+    rows = np.flatnonzero(keep)
+    order = rows[np.lexsort((id_codes[rows], group_codes[rows]))]
+    sorted_groups = group_codes[order]
+    sorted_ids = id_codes[order]
+
+    n = len(order)
+    group_change = np.ones(n, dtype=bool)
+    group_change[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    group_starts = np.flatnonzero(group_change)
+    k = np.diff(np.append(group_starts, n))
+
+    # A study block starts wherever the group or the id changes (missing ids excluded)
+    study_change = group_change.copy()
+    study_change[1:] |= sorted_ids[1:] != sorted_ids[:-1]
+    study_change &= sorted_ids >= 0
+    study_starts = np.flatnonzero(study_change)
+    study_group = np.searchsorted(group_starts, study_starts, side='right') - 1
+    n_papers = np.bincount(study_group, minlength=len(group_starts))
+
+    first_codes = sorted_groups[group_starts]
+    if moderator2 is None:
+        group_keys = list(levels1[first_codes])
+    else:
+        group_keys = list(zip(levels1[first_codes // len(levels2)],
+                              levels2[first_codes % len(levels2)]))
+
+    segments = {
+        'order': order,
+        'group_keys': group_keys,
+        'group_starts': group_starts,
+        'k': k,
+        'id_codes': sorted_ids,
+        'study_starts': study_starts,
+        'study_group': study_group,
+        'n_papers': n_papers,
+    }
+    if effect_col is not None:
+        segments['y'] = np.asarray(analysis_data[effect_col].values, dtype=float)[order]
+    if var_col is not None:
+        segments['v'] = np.asarray(analysis_data[var_col].values, dtype=float)[order]
+    return segments
+
+
+def group_summary(analysis_data, moderator1, moderator2=None):
+    """
+    Observations and papers per group (or moderator1 × moderator2 cell).
+
+    Returns:
+    --------
+    DataFrame : One row per non-empty group, in find_valid_groups() order,
+                with the moderator level(s), 'k' and 'n_papers'
+    """
+    segments = build_group_segments(analysis_data, moderator1, moderator2)
+    if moderator2 is None:
+        summary = pd.DataFrame({moderator1: segments['group_keys']})
+    else:
+        summary = pd.DataFrame(segments['group_keys'], columns=[moderator1, moderator2])
+    summary['k'] = segments['k']
+    summary['n_papers'] = segments['n_papers']
+    return summary
+
+
+def find_valid_groups(analysis_data, moderator1, moderator2=None, min_papers=2, min_obs=2):
+    """
+    Groups (or moderator1 × moderator2 combinations) meeting the thresholds.
+
+    Returns:
+    --------
+    list : Category values (single) or (cat1, cat2) tuples (two-way)
+    """
+    segments = build_group_segments(analysis_data, moderator1, moderator2)
+    valid = (segments['n_papers'] >= min_papers) & (segments['k'] >= min_obs)
+    return [key for key, ok in zip(segments['group_keys'], valid) if ok]
+
+
+def in_valid_groups(analysis_data, moderator1, moderator2, valid_groups_list):
+    """
+    Boolean mask of the rows that fall in one of valid_groups_list.
+
+    Vectorized replacement for a row-wise apply over (moderator1,
+    moderator2) tuples.
+    """
+    if moderator2 is None:
+        return analysis_data[moderator1].isin(valid_groups_list).values
+    cells = pd.MultiIndex.from_arrays([analysis_data[moderator1], analysis_data[moderator2]])
+    return cells.isin(list(valid_groups_list))
+
+
+# --- 2. GROUP FITS ---
+
+def _fit_group(y, v, study_starts, fit_kwargs):
+    """
+    Three-level fit of one group block. study_starts are offsets into the
+    block; rows before the first study (missing id) are left out, exactly
+    as build_study_segments() drops them.
+    """
+    if len(study_starts) == 0:
+        return None
+    first = study_starts[0]
+    estimates, _, _ = fit_three_level_segments(y[first:], v[first:], study_starts - first,
+                                               **fit_kwargs)
+    return estimates
+
+# --- Parallel group workers ---
+# Each worker receives the sorted arrays once (initializer); each task is a
+# (start, end) block of the sorted arrays plus that group's study offsets.
+
+_GROUP_SHARED = {}
+
+def _init_group_worker(y, v, fit_kwargs):
+    _GROUP_SHARED.update(y=y, v=v, fit_kwargs=fit_kwargs)
+
+def _group_worker(task):
+    start, end, study_starts = task
+    return _fit_group(_GROUP_SHARED['y'][start:end], _GROUP_SHARED['v'][start:end],
+                      study_starts, _GROUP_SHARED['fit_kwargs'])
+
+def _fit_groups(y, v, tasks, fit_kwargs, n_jobs=1):
+    """Run _fit_group over (start, end, study_starts) tasks, optionally in worker processes."""
+    if n_jobs > 1 and len(tasks) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=_init_group_worker,
+                                     initargs=(y, v, fit_kwargs)) as pool:
+                chunksize = max(1, len(tasks) // (4 * n_jobs))
+                return list(pool.map(_group_worker, tasks, chunksize=chunksize))
+        except (OSError, RuntimeError) as e:
+            warnings.warn(f"Process pool unavailable ({e}), running sequentially")
+    return [_fit_group(y[start:end], v[start:end], study_starts, fit_kwargs)
+            for start, end, study_starts in tasks]
+
+
+# --- 3. SUBGROUP ANALYSIS ---
+
+@instrumented_fit('subgroups')
+@cached_fit('subgroups')
+def run_subgroup_analysis(analysis_data, effect_col, var_col, moderator1, moderator2,
+                          valid_groups_list, Qt_overall=None, has_fold_change=False,
+                          n_jobs=1, **fit_kwargs):
+    """
+    Fit the three-level model in every valid subgroup.
+
+    The data are partitioned once with build_group_segments(); the
+    fixed-effect Q-within of every group comes from segment sums over the
+    same sorted arrays, and the three-level fits run on slices of them
+    (in n_jobs worker processes if requested).
+
+    Parameters:
+    -----------
+    analysis_data : DataFrame
+        Data with 'id', effect size, variance and moderator columns
+    effect_col, var_col : str
+        Column names for effect sizes and variances
+    moderator1, moderator2 : str or None
+        Moderator column(s); moderator2 is None for a single-factor analysis
+    valid_groups_list : list
+        Output of find_valid_groups()
+    Qt_overall : float or None
+        Total Q of the overall fixed-effect model (overall_results['Qt']);
+        if None, the total Q of the rows in the valid groups is used
+    has_fold_change : bool
+        Add the back-transformed fold change (ratio measures)
+    n_jobs : int
+        Worker processes for the group fits (1 = run in this process)
+    **fit_kwargs :
+        Passed to the three-level fit (fit_method, info_type, ...); the
+        per-group variance-component CIs are not reported, so ci_method
+        defaults to None
+
+    Returns:
+    --------
+    dict : Same keys as ANALYSIS_CONFIG['subgroup_results']
+    """
+    analysis_type = 'single' if moderator2 is None else 'two_way'
+    fit_kwargs.setdefault('ci_method', None)
+
+    moderators = [moderator1] if moderator2 is None else [moderator1, moderator2]
+    analysis_data = analysis_data[['id', effect_col, var_col]].assign(
+        **{m: analysis_data[m].astype(str).str.strip() for m in moderators}
+    )
+    segments = build_group_segments(analysis_data, moderator1, moderator2, effect_col, var_col)
+    y, v = segments['y'], segments['v']
+    group_starts, k = segments['group_starts'], segments['k']
+    n = len(y)
+
+    # --- Fixed-effect Q-within of every group (one pass of segment sums) ---
+    w = 1.0 / v
+    sum_w = np.add.reduceat(w, group_starts)
+    pooled_fe = np.add.reduceat(w * y, group_starts) / sum_w
+    Q_within = np.add.reduceat(w * (y - np.repeat(pooled_fe, k))**2, group_starts)
+    mean_v = np.add.reduceat(v, group_starts) / k
+
+    # --- Match the requested groups to their blocks ---
+    group_index = {key: g for g, key in enumerate(segments['group_keys'])}
+    group_ends = np.append(group_starts[1:], n)
+    study_starts, study_group = segments['study_starts'], segments['study_group']
+    selected, tasks = [], []
+    for group_item in valid_groups_list:
+        if analysis_type == 'single':
+            key = str(group_item).strip()
+        else:
+            key = (str(group_item[0]).strip(), str(group_item[1]).strip())
+        g = group_index.get(key)
+        if g is None or k[g] < 2 or segments['n_papers'][g] < 2:
+            continue
+        start, end = group_starts[g], group_ends[g]
+        selected.append((group_item, g))
+        tasks.append((start, end, study_starts[study_group == g] - start))
+
+    all_estimates = _fit_groups(y, v, tasks, fit_kwargs, n_jobs=n_jobs)
+
+    subgroup_results_list = []
+    for (group_item, g), estimates in zip(selected, all_estimates):
+        if estimates is None:
+            continue
+        group_name = str(group_item).strip() if analysis_type == 'single' else f"{group_item[0]} x {group_item[1]}"
+
+        mu_re = estimates['mu']
+        se_re = estimates['se_mu']
+        tau_sq_re = estimates['tau_sq']
+        sigma_sq_re = estimates['sigma_sq']
+
+        # 3-Level I-squared
+        total_variance_est = tau_sq_re + sigma_sq_re + mean_v[g]
+        I_squared_re = ((tau_sq_re + sigma_sq_re) / total_variance_est) * 100 if total_variance_est > 0 else 0
+
+        if has_fold_change:
+            RR = np.exp(mu_re)
+            fold_change_re = RR if mu_re >= 0 else -1/RR
+        else:
+            fold_change_re = np.nan
+
+        result_dict = {
+            'group': group_name,
+            'k': int(k[g]),
+            'n_papers': int(segments['n_papers'][g]),
+            'pooled_effect_re': mu_re,
+            'pooled_se_re': se_re,
+            'pooled_var_re': estimates['var_mu'],
+            'ci_lower_re': mu_re - 1.96 * se_re,
+            'ci_upper_re': mu_re + 1.96 * se_re,
+            'p_value_re': 2 * (1 - norm.cdf(abs(mu_re / se_re))),
+            'I_squared': I_squared_re,
+            'tau_squared': tau_sq_re,
+            'sigma_squared': sigma_sq_re,
+            'fold_change_re': fold_change_re,
+            'Q_within': Q_within[g],
+            'df_Q': int(k[g]) - 1
+        }
+        if analysis_type == 'two_way':
+            result_dict[moderator1] = group_item[0]
+            result_dict[moderator2] = group_item[1]
+
+        subgroup_results_list.append(result_dict)
+
+    results_df = pd.DataFrame(subgroup_results_list)
+    if results_df.empty:
+        raise ValueError("No subgroups were successfully analyzed.")
+
+    # --- Heterogeneity partitioning ---
+    if Qt_overall is None:
+        rows = np.concatenate([np.arange(group_starts[g], group_ends[g]) for _, g in selected])
+        pooled_all = (w[rows] @ y[rows]) / w[rows].sum()
+        Qt_overall = float(w[rows] @ (y[rows] - pooled_all)**2)
+    Qe_sum = results_df['Q_within'].sum()
+    df_Qe = results_df['df_Q'].sum()
+    df_QM = len(results_df) - 1
+    QM = max(0, Qt_overall - Qe_sum)
+    p_value_QM = 1 - chi2.cdf(QM, df_QM) if df_QM > 0 else np.nan
+    R_squared = max(0, (QM / Qt_overall) * 100) if Qt_overall > 0 else 0
+
+    return {
+        'results_df': results_df,
+        'analysis_type': analysis_type,
+        'moderator1': moderator1,
+        'moderator2': moderator2,
+        'Qt_overall': Qt_overall,
+        'QM': QM,
+        'Qe': Qe_sum,
+        'df_QM': df_QM,
+        'df_Qe': df_Qe,
+        'p_value_QM': p_value_QM,
+        'R_squared': R_squared
+    }
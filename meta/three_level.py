@@ -0,0 +1,717 @@
+"""
+Three-level (multilevel) meta-analysis engine.
+
+Model: y_ij = μ + u_i + r_ij + e_ij, with between-study variance τ²
+(level 3), within-study variance σ² (level 2) and known sampling
+variances v_ij. Variance components are estimated by REML.
+
+The data are sorted once by study id (build_study_segments); every
+likelihood evaluation is then a handful of np.add.reduceat segment
+reductions using the Sherman-Morrison form of V_i⁻¹.
+
+Confidence intervals for τ² and σ² are profile-likelihood intervals by
+default: each profile point fixes one component and re-maximizes the
+REML likelihood over the other, warm-started from the nearest point
+already evaluated.
+"""
+
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize, OptimizeResult, brentq
+from scipy.stats import chi2
+
+from .fit_cache import cached_fit
+from .perf import instrumented_fit, perf_section, timed_likelihood
+from .heterogeneity import fit_tau_squared
+
+__all__ = [
+    'build_study_segments',
+    'get_three_level_estimates',
+    'get_three_level_score_info',
+    'fit_three_level_fisher',
+    'profile_three_level',
+    'profile_likelihood_ci',
+    'fit_three_level_segments',
+    'run_three_level_reml',
+]
+
+
+def build_study_segments(analysis_data, effect_col, var_col):
+    """
+    Sort the data ONCE by study id and return flat arrays plus segment offsets.
+
+    Every study occupies a contiguous block [seg_starts[i], seg_starts[i+1])
+    of the sorted arrays, so per-study sums can be taken for all studies at
+    once with np.add.reduceat instead of a Python loop.
+
+    Args:
+        analysis_data (DataFrame): Data with 'id', effect and variance columns
+        effect_col (str): Name of effect size column
+        var_col (str): Name of variance column
+
+    Returns:
+        tuple: (y_sorted, v_sorted, seg_starts, study_ids)
+    """
+    codes, study_ids = pd.factorize(analysis_data['id'], sort=True)
+    keep = codes >= 0  # groupby('id') drops missing ids
+    codes = codes[keep]
+    order = np.argsort(codes, kind='stable')
+
+    y_sorted = np.asarray(analysis_data[effect_col].values, dtype=float)[keep][order]
+    v_sorted = np.asarray(analysis_data[var_col].values, dtype=float)[keep][order]
+
+    counts = np.bincount(codes, minlength=len(study_ids))
+    seg_starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.intp)
+
+    return y_sorted, v_sorted, seg_starts, study_ids
+
+
+@timed_likelihood
+def get_three_level_estimates(params, y_sorted, v_sorted, seg_starts, N_total, M_studies):
+    """
+    Core function to calculate estimates given variance components.
+
+    Model: y_ij = μ + u_i + r_ij + e_ij
+           Var(y_ij) = τ² + σ² + v_ij
+           Cov(y_ij, y_ik) = τ²
+
+    V_i = (D_i + σ²I) + τ²J  (where D_i = diag(v_ij))
+
+    All studies are processed at once: the Sherman-Morrison terms only need
+    the per-study sums 1'A⁻¹1, 1'A⁻¹y, y'A⁻¹y and log|A|, which are segment
+    reductions over the id-sorted arrays from build_study_segments().
+
+    Args:
+        params (list): [tau_squared, sigma_squared]
+        y_sorted (ndarray): Effect sizes sorted by study id
+        v_sorted (ndarray): Sampling variances sorted by study id
+        seg_starts (ndarray): Start offset of each study's block
+        N_total (int): Total number of observations
+        M_studies (int): Total number of studies
+
+    Returns:
+        dict: A dictionary containing all key model estimates
+    """
+    try:
+        tau_sq, sigma_sq = params
+        if tau_sq < 0 or sigma_sq < 0:
+            return {'log_lik_reml': np.inf}
+
+        # --- Components of A = diag(v_ij + σ²) ---
+        A_diag = v_sorted + sigma_sq
+        if np.any(A_diag <= 0):
+            return {'log_lik_reml': np.inf}
+        A_inv_diag = 1.0 / A_diag
+        A_inv_y = A_inv_diag * y_sorted
+
+        # --- Per-study segment sums (one pass each, no Python loop) ---
+        log_det_A = np.add.reduceat(np.log(A_diag), seg_starts)
+        sum_A_inv_1 = np.add.reduceat(A_inv_diag, seg_starts)        # 1' * A⁻¹ * 1
+        sum_A_inv_y = np.add.reduceat(A_inv_y, seg_starts)           # 1' * A⁻¹ * y_i
+        sum_yA_inv_y = np.add.reduceat(A_inv_y * y_sorted, seg_starts)  # y_i' * A⁻¹ * y_i
+
+        term_S = 1.0 + tau_sq * sum_A_inv_1
+
+        # Handle potential singularity
+        if np.any(term_S <= 1e-10):
+            return {'log_lik_reml': np.inf}
+
+        # --- Sherman-Morrison, per study ---
+        # det(V_i) = det(A) * (1 + τ² * 1'A⁻¹1)
+        # 1'V_i⁻¹1 = 1'A⁻¹1 / term_S,  1'V_i⁻¹y = 1'A⁻¹y / term_S
+        # y'V_i⁻¹y = y'A⁻¹y - τ² * (1'A⁻¹y)² / term_S
+        sum_log_det_Vi = np.sum(log_det_A + np.log(term_S))
+        sum_S = np.sum(sum_A_inv_1 / term_S)
+        sum_Sy = np.sum(sum_A_inv_y / term_S)
+        sum_ySy = np.sum(sum_yA_inv_y - tau_sq * sum_A_inv_y**2 / term_S)
+
+        # --- Pooled Effect (μ) and Standard Error ---
+        if sum_S <= 1e-10:
+            return {'log_lik_reml': np.inf}
+
+        mu_hat = sum_Sy / sum_S
+        var_mu = 1.0 / sum_S
+        se_mu = np.sqrt(var_mu)
+
+        # --- Calculate Log-Likelihoods ---
+        # Residual sum of squares
+        residual_ss = sum_ySy - 2.0 * mu_hat * sum_Sy + mu_hat**2 * sum_S
+
+        # REML Log-Likelihood
+        log_lik_reml = -0.5 * (sum_log_det_Vi + np.log(sum_S) + residual_ss)
+        if np.isnan(log_lik_reml):
+            return {'log_lik_reml': np.inf}
+
+        # ML Log-Likelihood (for AIC/BIC)
+        log_lik_ml = -0.5 * (N_total * np.log(2.0 * np.pi) + sum_log_det_Vi + residual_ss)
+
+        return {
+            'mu': mu_hat,
+            'se_mu': se_mu,
+            'var_mu': var_mu,
+            'log_lik_reml': log_lik_reml,
+            'log_lik_ml': log_lik_ml,
+            'tau_sq': tau_sq,
+            'sigma_sq': sigma_sq,
+            'sum_log_det_Vi': sum_log_det_Vi,
+            'residual_ss': residual_ss,
+            'sum_S_XViX': sum_S # This is X'V⁻¹X
+        }
+
+    except (FloatingPointError, ValueError, np.linalg.LinAlgError):
+        # Catch numerical instability
+        return {'log_lik_reml': np.inf}
+
+def _negative_log_likelihood_reml(params, y_sorted, v_sorted, seg_starts, N_total, M_studies):
+    """Wrapper for optimizer. Returns negative REML log-likelihood."""
+    estimates = get_three_level_estimates(params, y_sorted, v_sorted, seg_starts, N_total, M_studies)
+    return -estimates['log_lik_reml']
+
+def get_three_level_score_info(params, y_sorted, v_sorted, seg_starts, N_total, M_studies,
+                                info_type='expected'):
+    """
+    Closed-form REML score and information matrix for (τ², σ²).
+
+    With P = V⁻¹ - V⁻¹1(1'V⁻¹1)⁻¹1'V⁻¹ and dV/dτ² = blockdiag(J_i), dV/dσ² = I:
+        score_j    = -½ tr(P V_j) + ½ y'P V_j P y
+        expected_jk =  ½ tr(P V_j P V_k)
+        observed_jk = -½ tr(P V_j P V_k) + y'P V_j P V_k P y
+    Every trace and quadratic form reduces to per-study sums of powers of
+    w = 1/(v_ij + σ²), so the cost is a handful of segment reductions.
+
+    Args:
+        params (list): [tau_squared, sigma_squared]
+        y_sorted, v_sorted, seg_starts: Output of build_study_segments()
+        N_total (int): Total number of observations
+        M_studies (int): Total number of studies
+        info_type (str): 'expected' (Fisher) or 'observed'
+
+    Returns:
+        tuple: (estimates dict, score (2,), information (2, 2)); score and
+               information are None if the likelihood cannot be evaluated.
+    """
+    estimates = get_three_level_estimates(params, y_sorted, v_sorted, seg_starts, N_total, M_studies)
+    if not np.isfinite(estimates['log_lik_reml']):
+        return estimates, None, None
+
+    tau_sq, sigma_sq = params
+    mu = estimates['mu']
+    r = y_sorted - mu
+    w = 1.0 / (v_sorted + sigma_sq)
+    w2 = w * w
+    w3 = w2 * w
+
+    s = np.add.reduceat(w, seg_starts)              # 1'A⁻¹1
+    t = np.add.reduceat(w2, seg_starts)             # Σ w²
+    h = np.add.reduceat(w3, seg_starts)             # Σ w³
+    u = np.add.reduceat(w * r, seg_starts)          # 1'A⁻¹r
+    wr2 = np.add.reduceat(w2 * r, seg_starts)       # Σ w² r
+    wwr2 = np.add.reduceat(w2 * r * r, seg_starts)  # Σ w² r²
+
+    g = 1.0 / (1.0 + tau_sq * s)   # V_i⁻¹1 = g_i * w
+    c = tau_sq * g                 # V_i⁻¹ = W - c_i w w'
+    sg = s * g                     # 1'V_i⁻¹1
+    S = np.sum(sg)
+
+    # e = V⁻¹r = P y;  1'e_i = E_i,  w'e_i = z_i
+    E = u * g
+    z = wr2 - c * u * t
+
+    # --- Score ---
+    tr_PVt = S - np.sum(sg**2) / S
+    tr_PVs = np.sum(s - c * t) - np.sum(g**2 * t) / S
+    quad_t = np.sum(E**2)
+    quad_s = np.sum(wwr2 - 2.0 * c * u * wr2 + c**2 * u**2 * t)
+    score = 0.5 * np.array([quad_t - tr_PVt, quad_s - tr_PVs])
+
+    # --- tr(P V_j P V_k) ---
+    qJq = np.sum(sg**2)
+    qIq = np.sum(g**2 * t)
+    tr_tt = np.sum(sg**2) - 2.0 * np.sum(sg**3) / S + qJq**2 / S**2
+    tr_ts = np.sum(g**2 * t) - 2.0 * np.sum(sg * g**2 * t) / S + qJq * qIq / S**2
+    tr_ss = (np.sum(t - 2.0 * c * h + c**2 * t**2)
+             - 2.0 * np.sum(g**2 * (h - c * t**2)) / S + qIq**2 / S**2)
+    expected = 0.5 * np.array([[tr_tt, tr_ts], [tr_ts, tr_ss]])
+
+    if info_type == 'observed':
+        # y'P V_j P V_k P y = e'V_j V⁻¹ V_k e - (e'V_j q)(q'V_k e) / S
+        Eq = np.sum(E * sg)
+        gz = np.sum(g * z)
+        ww3r2 = np.add.reduceat(w3 * r * r, seg_starts)
+        ww3r = np.add.reduceat(w3 * r, seg_starts)
+        eMe = ww3r2 - 2.0 * c * u * ww3r + c**2 * u**2 * h - c * z**2
+        q_tt = np.sum(E**2 * sg) - Eq**2 / S
+        q_ts = np.sum(E * g * z) - Eq * gz / S
+        q_ss = np.sum(eMe) - gz**2 / S
+        info = np.array([[q_tt, q_ts], [q_ts, q_ss]]) - expected
+    else:
+        info = expected
+
+    return estimates, score, info
+
+def _negative_log_likelihood_reml_and_grad(params, y_sorted, v_sorted, seg_starts, N_total, M_studies):
+    """Wrapper for jac=True optimizers. Returns (-REML log-lik, -score)."""
+    estimates, score, _ = get_three_level_score_info(
+        params, y_sorted, v_sorted, seg_starts, N_total, M_studies
+    )
+    if score is None:
+        return np.inf, np.zeros(2)
+    return -estimates['log_lik_reml'], -score
+
+def fit_three_level_fisher(initial_params, y_sorted, v_sorted, seg_starts, N_total, M_studies,
+                            info_type='expected', log_scale=False, max_iter=100, tol=1e-8):
+    """
+    Fisher scoring / Newton-Raphson for the REML variance components.
+
+    Each iteration solves info · step = score (on the log scale if requested)
+    and halves the step until the REML log-likelihood does not decrease.
+    On the natural scale, a component sitting at 0 with a non-positive score
+    is held fixed (active set), so boundary solutions are reached exactly.
+
+    Args:
+        initial_params (list): Starting [tau_squared, sigma_squared]
+        y_sorted, v_sorted, seg_starts: Output of build_study_segments()
+        N_total (int): Total number of observations
+        M_studies (int): Total number of studies
+        info_type (str): 'expected' (Fisher scoring) or 'observed' (Newton)
+        log_scale (bool): Iterate on (log τ², log σ²)
+        max_iter (int): Maximum number of scoring iterations
+        tol (float): Convergence tolerance on the parameter change
+
+    Returns:
+        OptimizeResult: Same fields as scipy.optimize.minimize (x, fun, jac,
+        nit, nfev, njev, success, message) plus 'information'.
+    """
+    lower = 1e-10 if log_scale else 0.0
+    theta = np.maximum(np.asarray(initial_params, dtype=float), lower)
+    args = (y_sorted, v_sorted, seg_starts, N_total, M_studies)
+
+    estimates, score, info = get_three_level_score_info(theta, *args, info_type=info_type)
+    nfev, njev = 1, 1
+    if score is None:
+        return OptimizeResult(x=theta, fun=np.inf, jac=None, nit=0, nfev=nfev, njev=njev,
+                              success=False, status=2, information=None,
+                              message='REML log-likelihood not finite at starting values')
+
+    success, status = False, 1
+    message = 'Maximum number of iterations reached'
+
+    for nit in range(1, max_iter + 1):
+        if log_scale:
+            grad = theta * score
+            hess = theta[:, None] * info * theta[None, :]
+            if info_type == 'observed':
+                hess = hess - np.diag(grad)
+            free = np.ones(2, dtype=bool)
+        else:
+            grad, hess = score, info
+            free = ~((theta <= 0) & (score <= 0))
+
+        step = np.zeros(2)
+        if free.any():
+            hess_free = hess[np.ix_(free, free)]
+            try:
+                step[free] = np.linalg.solve(hess_free, grad[free])
+            except np.linalg.LinAlgError:
+                step[free] = grad[free] / np.maximum(np.abs(np.diag(hess_free)), 1e-12)
+            if np.dot(step, grad) <= 0:
+                # Observed information not positive definite here: gradient step
+                step[free] = grad[free] / np.maximum(np.abs(np.diag(hess_free)), 1e-12)
+
+        # --- Step halving ---
+        ll_old = estimates['log_lik_reml']
+        improved = False
+        lam = 1.0
+        for _ in range(30):
+            if log_scale:
+                candidate = theta * np.exp(np.clip(lam * step, -10.0, 10.0))
+            else:
+                candidate = np.maximum(theta + lam * step, 0.0)
+            cand_estimates = get_three_level_estimates(candidate, *args)
+            nfev += 1
+            ll_new = cand_estimates['log_lik_reml']
+            if np.isfinite(ll_new) and ll_new >= ll_old:
+                improved = True
+                break
+            lam *= 0.5
+
+        if not improved:
+            # No ascent possible along the scoring direction: at the optimum
+            # up to rounding
+            success, status = True, 0
+            message = 'Converged (no further ascent along scoring direction)'
+            break
+
+        delta = np.max(np.abs(candidate - theta))
+        theta = candidate
+        estimates, score, info = get_three_level_score_info(theta, *args, info_type=info_type)
+        njev += 1
+
+        if delta <= tol * (1.0 + np.max(theta)):
+            success, status = True, 0
+            message = 'Converged (parameter change below tolerance)'
+            break
+
+    return OptimizeResult(x=theta, fun=-estimates['log_lik_reml'], jac=-score, nit=nit,
+                          nfev=nfev, njev=njev, success=success, status=status,
+                          message=message, information=info)
+
+_VARIANCE_COMPONENTS = ('tau_sq', 'sigma_sq')
+
+def profile_three_level(component, value, other_start, y_sorted, v_sorted, seg_starts,
+                        N_total, M_studies, max_iter=50, tol=1e-8):
+    """
+    Profile REML log-likelihood of one variance component.
+
+    Fixes params[component] at value and maximizes the REML log-likelihood
+    over the other component by one-dimensional Fisher scoring with step
+    halving, starting from other_start. The free component is held at 0
+    when it sits there with a non-positive score.
+
+    Args:
+        component (int): 0 to fix τ², 1 to fix σ²
+        value (float): Value the fixed component is held at
+        other_start (float): Starting value of the free component
+        y_sorted, v_sorted, seg_starts: Output of build_study_segments()
+        N_total (int): Total number of observations
+        M_studies (int): Total number of studies
+        max_iter (int): Maximum number of scoring iterations
+        tol (float): Convergence tolerance on the free component
+
+    Returns:
+        tuple: (profile REML log-likelihood, maximizing free component);
+               the log-likelihood is -inf if it cannot be evaluated.
+    """
+    args = (y_sorted, v_sorted, seg_starts, N_total, M_studies)
+    free = 1 - component
+    theta = np.empty(2)
+    theta[component] = value
+    theta[free] = max(other_start, 0.0)
+
+    estimates, score, info = get_three_level_score_info(theta, *args)
+    if score is None:
+        return -np.inf, theta[free]
+
+    for _ in range(max_iter):
+        grad = score[free]
+        if theta[free] <= 0 and grad <= 0:
+            break
+        curvature = info[free, free]
+        step = grad / curvature if curvature > 0 else grad
+
+        ll_old = estimates['log_lik_reml']
+        lam = 1.0
+        for _ in range(30):
+            candidate = theta.copy()
+            candidate[free] = max(theta[free] + lam * step, 0.0)
+            ll_new = get_three_level_estimates(candidate, *args)['log_lik_reml']
+            if np.isfinite(ll_new) and ll_new >= ll_old:
+                break
+            lam *= 0.5
+        else:
+            break
+
+        delta = abs(candidate[free] - theta[free])
+        theta = candidate
+        estimates, score, info = get_three_level_score_info(theta, *args)
+        if delta <= tol * (1.0 + theta[free]):
+            break
+
+    return estimates['log_lik_reml'], theta[free]
+
+def _profile_side(component, side, params, ll_max, cutoff, scale, n_grid, args):
+    """
+    One side of one profile-likelihood interval.
+
+    Finds where the profile log-likelihood drops cutoff / 2 below ll_max:
+    the upper side doubles the distance from the estimate until the
+    profile falls below the target, the lower side first checks the 0
+    boundary; the crossing is then located by Brent's method. Every
+    evaluation is warm-started from the nearest point already evaluated.
+    With n_grid > 0, n_grid evenly spaced points from the estimate to
+    1.25 times the bound are added (walking outward) for profile plots.
+
+    Returns:
+        tuple: (bound, dict {value: (profile log-lik, free component)})
+    """
+    estimate = params[component]
+    target = ll_max - 0.5 * cutoff
+    points = {estimate: (ll_max, params[1 - component])}
+
+    def excess(x):
+        if x not in points:
+            nearest = min(points, key=lambda p: abs(p - x))
+            points[x] = profile_three_level(component, x, points[nearest][1], *args)
+        # -inf (likelihood not evaluable) is kept finite for the root finder
+        return max(points[x][0] - target, -1e10)
+
+    if side < 0:
+        if estimate <= 0 or excess(0.0) >= 0:
+            bound = 0.0
+        else:
+            bound = brentq(excess, 0.0, estimate, xtol=1e-8 * scale)
+    else:
+        inner, step = estimate, scale
+        for _ in range(60):
+            outer = estimate + step
+            if excess(outer) < 0:
+                break
+            inner, step = outer, 2.0 * step
+        else:
+            outer = None
+        bound = np.inf if outer is None else brentq(excess, inner, outer, xtol=1e-8 * scale)
+
+    if n_grid > 0:
+        edge = bound if np.isfinite(bound) else max(points)
+        grid = estimate + (edge - estimate) * np.linspace(0.0, 1.25, n_grid + 1)[1:]
+        for x in np.maximum(grid, 0.0):
+            excess(x)
+
+    return bound, points
+
+# --- Parallel profile workers ---
+# Four independent tasks: (component, side) for τ² and σ², lower and upper.
+
+_PROFILE_SHARED = {}
+
+def _init_profile_worker(*shared):
+    _PROFILE_SHARED['args'] = shared
+
+def _profile_worker(task):
+    return _profile_side(*task, _PROFILE_SHARED['args'])
+
+def profile_likelihood_ci(params, y_sorted, v_sorted, seg_starts, N_total, M_studies,
+                          level=0.95, se=None, n_grid=10, n_jobs=1):
+    """
+    Profile-likelihood confidence intervals for τ² and σ².
+
+    The interval for each component is the set of values whose profile
+    REML log-likelihood is within χ²₁(level) / 2 of the maximum. Unlike
+    the Wald interval it needs no information matrix, so it stays valid
+    when an estimate is on (or near) the 0 boundary: the lower bound is
+    then exactly 0. The four bound searches are independent and run in
+    worker processes when n_jobs > 1.
+
+    Args:
+        params (list): REML estimates [tau_squared, sigma_squared]
+        y_sorted, v_sorted, seg_starts: Output of build_study_segments()
+        N_total (int): Total number of observations
+        M_studies (int): Total number of studies
+        level (float): Confidence level
+        se (tuple): Wald SEs of (τ², σ²), used only as the initial search
+                    step; default is the estimates themselves
+        n_grid (int): Extra evenly spaced profile points per side (for
+                      plot_profile_likelihood); 0 for the bounds only
+        n_jobs (int): Worker processes for the bound searches
+
+    Returns:
+        dict: 'level', 'cutoff' (χ² quantile), 'log_lik_reml' (maximum) and,
+              per component ('tau_sq', 'sigma_sq'), a dict with 'estimate',
+              'ci_lower', 'ci_upper' and the evaluated profile as sorted
+              arrays 'values', 'log_lik', 'other'.
+    """
+    params = np.maximum(np.asarray(params, dtype=float), 0.0)
+    args = (y_sorted, v_sorted, seg_starts, N_total, M_studies)
+    ll_max = get_three_level_estimates(params, *args)['log_lik_reml']
+    cutoff = chi2.ppf(level, 1)
+
+    # Initial search step: Wald SE, else the estimate, else a small
+    # fraction of the typical sampling variance
+    floor = 1e-3 * np.mean(v_sorted)
+    if se is None:
+        se = params
+    scales = [s if np.isfinite(s) and s > floor else max(p, floor) for s, p in zip(se, params)]
+
+    tasks = [(component, side, params, ll_max, cutoff, scales[component], n_grid)
+             for component in (0, 1) for side in (-1, 1)]
+    results = None
+    if n_jobs > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=min(n_jobs, len(tasks)),
+                                     initializer=_init_profile_worker,
+                                     initargs=args) as pool:
+                results = list(pool.map(_profile_worker, tasks))
+        except (OSError, RuntimeError) as e:
+            warnings.warn(f"Process pool unavailable ({e}), running sequentially")
+    if results is None:
+        results = [_profile_side(*task, args) for task in tasks]
+
+    profile = {'level': level, 'cutoff': cutoff, 'log_lik_reml': ll_max}
+    for component, name in enumerate(_VARIANCE_COMPONENTS):
+        (lower, lower_points), (upper, upper_points) = results[2 * component:2 * component + 2]
+        points = {**lower_points, **upper_points}
+        values = np.array(sorted(points))
+        profile[name] = {
+            'estimate': params[component],
+            'ci_lower': lower,
+            'ci_upper': upper,
+            'values': values,
+            'log_lik': np.array([points[x][0] for x in values]),
+            'other': np.array([points[x][1] for x in values]),
+        }
+    return profile
+
+@instrumented_fit('three_level')
+@cached_fit('three_level')
+def run_three_level_reml(analysis_data, effect_col, var_col, fit_method='fisher',
+                         info_type='expected', log_scale=False, start_params=None,
+                         min_studies=2, verbose=False, ci_method='profile', n_jobs=1):
+    """
+    Main optimization function.
+    Finds REML estimates for τ² and σ².
+
+    Args:
+        analysis_data (DataFrame): Data with 'id', effect and variance columns
+        effect_col (str): Name of effect size column
+        var_col (str): Name of variance column
+        fit_method (str): 'fisher' (scoring / Newton with the closed-form
+                          REML score) or 'lbfgs' (L-BFGS-B with analytic gradient)
+        info_type (str): 'expected' or 'observed' information, used by the
+                         scoring iterations and for the variance-component SEs
+        log_scale (bool): Fisher scoring on (log τ², log σ²)
+        start_params (tuple): Starting (τ², σ²); default is the standard
+                              REML τ² and σ² = 0.01
+        min_studies (int): Return (None, None, None) below this many studies
+        verbose (bool): Print progress messages
+        ci_method (str): CIs for τ² and σ²: 'profile' (profile likelihood,
+                         see profile_likelihood_ci), 'wald' (log-scale Wald
+                         from the information matrix) or None (no SEs/CIs)
+        n_jobs (int): Worker processes for the profile-likelihood searches
+
+    Returns:
+        tuple: (estimates dict, (y_sorted, v_sorted, seg_starts, N_total,
+               M_studies), optimizer result), or (None, None, None) on failure
+    """
+    if verbose: print("  Preparing data for optimization...")
+    y_sorted, v_sorted, seg_starts, _ = build_study_segments(analysis_data, effect_col, var_col)
+    return fit_three_level_segments(y_sorted, v_sorted, seg_starts, fit_method=fit_method,
+                                    info_type=info_type, log_scale=log_scale,
+                                    start_params=start_params, min_studies=min_studies,
+                                    verbose=verbose, ci_method=ci_method, n_jobs=n_jobs)
+
+def fit_three_level_segments(y_sorted, v_sorted, seg_starts, fit_method='fisher',
+                             info_type='expected', log_scale=False, start_params=None,
+                             min_studies=2, verbose=False, ci_method='profile', n_jobs=1):
+    """
+    REML fit of the three-level model on data already sorted by study.
+
+    Same as run_three_level_reml() but takes the output of
+    build_study_segments() (or any id-sorted slice of it) directly, so
+    callers that partition the data themselves (subgroups, LOO) fit
+    without building a DataFrame per fit.
+
+    Args:
+        y_sorted, v_sorted, seg_starts: Output of build_study_segments()
+        fit_method, info_type, log_scale, start_params, min_studies,
+        verbose, ci_method, n_jobs: As in run_three_level_reml()
+
+    Returns:
+        tuple: (estimates dict, (y_sorted, v_sorted, seg_starts, N_total,
+               M_studies), optimizer result), or (None, None, None) on failure
+    """
+    N_total = len(y_sorted)
+    M_studies = len(seg_starts)
+
+    if M_studies < min_studies:
+        if verbose: print(f"  ⚠️  Not enough studies ({M_studies}) for the three-level model.")
+        return None, None, None
+    if M_studies < 3 and verbose:
+        print("  ⚠️  WARNING: Fewer than 3 studies. REML estimates may be unstable.")
+
+    # --- Get starting values ---
+    if start_params is not None:
+        tau_sq_start, sigma_sq_start = start_params
+    else:
+        # Use standard REML for τ² starting value
+        try:
+            tau_sq_start, _ = fit_tau_squared(y_sorted, v_sorted, method='REML')
+        except Exception as e:
+            if verbose: print(f"  ⚠️  Could not calculate starting tau²: {e}. Defaulting to 0.1")
+            tau_sq_start = 0.1
+        sigma_sq_start = 0.01 # Start with small within-study variance
+
+    initial_params = [max(0, tau_sq_start), max(0, sigma_sq_start)]
+    bounds = [(0, None), (0, None)] # Variances must be non-negative
+
+    if verbose:
+        print(f"  Starting parameters: τ²={initial_params[0]:.4f}, σ²={initial_params[1]:.4f}")
+        print("  Optimizing... (This may take a moment)")
+
+    # --- Run Optimizer ---
+    data_args = (y_sorted, v_sorted, seg_starts, N_total, M_studies)
+    with perf_section('optimize'):
+        if fit_method == 'lbfgs':
+            optimizer_result = minimize(
+                _negative_log_likelihood_reml_and_grad,
+                x0=initial_params,
+                args=data_args,
+                jac=True,
+                method='L-BFGS-B',
+                bounds=bounds,
+                options={'ftol': 1e-10, 'gtol': 1e-6, 'maxiter': 500}
+            )
+        else:
+            optimizer_result = fit_three_level_fisher(
+                initial_params, *data_args, info_type=info_type, log_scale=log_scale
+            )
+
+    if not optimizer_result.success:
+        if verbose: print(f"  ❌ OPTIMIZATION FAILED: {optimizer_result.message}")
+        return None, None, None
+
+    if verbose:
+        print(f"  ✓ Optimization successful (Iterations: {optimizer_result.nit}, "
+              f"likelihood evaluations: {optimizer_result.nfev})")
+
+    # --- Get Final Estimates ---
+    tau_sq_est, sigma_sq_est = optimizer_result.x
+    final_estimates = get_three_level_estimates(
+        [tau_sq_est, sigma_sq_est],
+        y_sorted, v_sorted, seg_starts, N_total, M_studies
+    )
+
+    if ci_method is None:
+        return final_estimates, (y_sorted, v_sorted, seg_starts, N_total, M_studies), optimizer_result
+
+    # --- SEs (exact REML information) and CIs for variance components ---
+    if verbose: print("  Calculating confidence intervals for variance components...")
+    with perf_section('variance_cis'):
+        try:
+            _, _, information = get_three_level_score_info(
+                [tau_sq_est, sigma_sq_est], *data_args, info_type=info_type
+            )
+            with np.errstate(invalid='ignore'):
+                se_tau_sq, se_sigma_sq = np.sqrt(np.diag(np.linalg.inv(information)))
+        except np.linalg.LinAlgError:
+            se_tau_sq, se_sigma_sq = np.nan, np.nan
+        final_estimates['se_tau_sq'] = se_tau_sq
+        final_estimates['se_sigma_sq'] = se_sigma_sq
+        final_estimates['ci_method'] = ci_method
+
+        try:
+            if ci_method == 'profile':
+                profile = profile_likelihood_ci([tau_sq_est, sigma_sq_est], *data_args,
+                                                se=(se_tau_sq, se_sigma_sq), n_jobs=n_jobs)
+                final_estimates['profile'] = profile
+                ci_tau_sq = (profile['tau_sq']['ci_lower'], profile['tau_sq']['ci_upper'])
+                ci_sigma_sq = (profile['sigma_sq']['ci_lower'], profile['sigma_sq']['ci_upper'])
+            else:
+                # Log-scale Wald intervals; undefined for an estimate at 0
+                def wald_log_ci(est, se):
+                    if not est > 0 or not np.isfinite(se):
+                        return np.nan, np.nan
+                    half_width = 1.96 * se / est
+                    return est * np.exp(-half_width), est * np.exp(half_width)
+                ci_tau_sq = wald_log_ci(tau_sq_est, se_tau_sq)
+                ci_sigma_sq = wald_log_ci(sigma_sq_est, se_sigma_sq)
+        except (ValueError, RuntimeError) as e:
+            if verbose: print(f"  ⚠️  Could not compute CIs for variance components: {e}")
+            ci_tau_sq = ci_sigma_sq = (np.nan, np.nan)
+
+    final_estimates['ci_lower_tau_sq'], final_estimates['ci_upper_tau_sq'] = ci_tau_sq
+    final_estimates['ci_lower_sigma_sq'], final_estimates['ci_upper_sigma_sq'] = ci_sigma_sq
+
+    return final_estimates, (y_sorted, v_sorted, seg_starts, N_total, M_studies), optimizer_result